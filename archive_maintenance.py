@@ -0,0 +1,206 @@
+"""
+Maintenance of the archive of trend report PDFs (read_qc_files.py archive).
+
+A PDF is archived for each republished report, so archive_folder grows without bound, and listing it (to write
+archive_index.html) gets slower as it grows. Maintenance keeps the folder small:
+    * Identical reports are stored once. Reports are identified by a content hash that ignores the creation and
+      modification dates wkhtmltopdf writes into each PDF's metadata, and each duplicate is replaced by a hard link to
+      the stored copy, so it is still served from the archive folder.
+    * Reports older than archive_hot_days (config) are rolled into a compressed zip bundle per month
+      (bundles/YYYY-MM.zip), with one member per distinct report (named by its content hash), and removed from the
+      folder.
+The manifest (archive_manifest.json) records every report name seen by maintenance, with its content hash and archive
+time, and where each distinct report is stored (a file in the archive folder, or a bundle member).
+Archived reports are opened by name using open_report, whichever way they are stored, so links to them keep working:
+the report server (read_qc_files.py serve) serves them at archive/{report name}, and the .htaccess file written to the
+output folder proxies requests for bundled reports (no longer in the archive folder) to the report server.
+"""
+import datetime
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import zipfile
+from collections import OrderedDict
+import atomic_write
+
+MANIFEST_NAME = "archive_manifest.json"
+BUNDLE_FOLDER = "bundles"
+# Creation and modification dates in the PDF document information dictionary
+PDF_DATES = re.compile(br"/(CreationDate|ModDate)\s*\(D:[^)]*\)")
+
+
+def content_hash(report_path):
+    """
+    Return the content hash of an archived report, ignoring the creation and modification dates in its metadata.
+        :param report_path: (str) path to the report PDF
+        :return:            (str) sha1 hex digest
+    """
+    with open(report_path, "rb") as report_file:
+        return hashlib.sha1(PDF_DATES.sub(b"", report_file.read())).hexdigest()
+
+
+def read_manifest(archive_folder):
+    """
+    Read the archive manifest.
+        :param archive_folder:  (str) path to archived reports
+        :return:                (OrderedDict) "reports": report name as key, dictionary of sha1 and mtime as value.
+                                              "contents": sha1 as key, location of the report content as value -
+                                              dictionary of file (name in archive_folder), or bundle (path relative to
+                                              archive_folder) and member
+    """
+    try:
+        with open(os.path.join(archive_folder, MANIFEST_NAME)) as manifest_file:
+            return json.load(manifest_file, object_pairs_hook=OrderedDict)
+    except (IOError, OSError):
+        return OrderedDict([("reports", OrderedDict()), ("contents", OrderedDict())])
+
+
+def write_manifest(archive_folder, manifest):
+    """
+    Write the archive manifest.
+        :param archive_folder:  (str) path to archived reports
+        :param manifest:        (OrderedDict) manifest (see read_manifest)
+    """
+    atomic_write.write_atomic(os.path.join(archive_folder, MANIFEST_NAME), json.dumps(manifest, indent=1))
+
+
+def hot_reports(archive_folder):
+    """
+    Return the names of reports stored as files in the archive folder.
+        :param archive_folder:  (str) path to archived reports
+        :return:                (list) report file names
+    """
+    return [name for name in os.listdir(archive_folder) if name.endswith(".pdf")]
+
+
+def report_month(name, mtime):
+    """
+    Return the month a report was archived in, from the timestamp at the start of its name (YYMMDD_HH_MM_...), or its
+    modification time if the name has no timestamp.
+        :param name:    (str) report name
+        :param mtime:   (float) modification time of the report
+        :return:        (str) month (YYYY-MM)
+    """
+    try:
+        return datetime.datetime.strptime(name[:6], "%y%m%d").strftime("%Y-%m")
+    except ValueError:
+        return datetime.datetime.fromtimestamp(mtime).strftime("%Y-%m")
+
+
+def bundle_reports(archive_folder, bundle, members):
+    """
+    Add reports to a month's bundle. The bundle is written to a temporary copy and renamed into place (see
+    atomic_write.py), so an interrupted run leaves the previous bundle intact.
+        :param archive_folder:  (str) path to archived reports
+        :param bundle:          (str) path to the bundle, relative to archive_folder
+        :param members:         (dict) member name as key, path to the report file as value
+    """
+    bundle_path = os.path.join(archive_folder, bundle)
+    temporary_path = atomic_write.temporary_path(bundle_path)
+    if os.path.isfile(bundle_path):
+        shutil.copyfile(bundle_path, temporary_path)
+    with zipfile.ZipFile(temporary_path, "a", zipfile.ZIP_DEFLATED) as bundle_file:
+        existing = set(bundle_file.namelist())
+        for member, report_path in sorted(members.items()):
+            if member not in existing:
+                bundle_file.write(report_path, member)
+    os.rename(temporary_path, bundle_path)
+
+
+def compact(archive_folder, hot_days, now=None):
+    """
+    Replace duplicate reports in the archive folder by hard links to the stored copy, and roll reports older than
+    hot_days into monthly bundles.
+        :param archive_folder:  (str) path to archived reports
+        :param hot_days:        (int) reports archived within this many days stay in the archive folder
+        :param now:             (float or NoneType) current time (seconds since the epoch), or None for time.time()
+        :return:                (OrderedDict) number of reports deduplicated and bundled, and remaining in the archive
+                                              folder
+
+    A report's age is its modification time when maintenance first saw it (a hard link shares the modification time
+    of the stored copy). The bundles and manifest are written before any report file is linked or removed, so an
+    interrupted run loses no report.
+    """
+    now = time.time() if now is None else now
+    manifest = read_manifest(archive_folder)
+    reports, contents = manifest["reports"], manifest["contents"]
+    linked = []
+    removed = []
+    to_bundle = OrderedDict()
+    names = sorted(hot_reports(archive_folder))
+    for name in names:
+        report_path = os.path.join(archive_folder, name)
+        sha1 = content_hash(report_path)
+        mtime = reports[name]["mtime"] if name in reports else os.path.getmtime(report_path)
+        reports[name] = OrderedDict([("sha1", sha1), ("mtime", mtime)])
+        location = contents.get(sha1, {})
+        stored_path = os.path.join(archive_folder, location.get("file", name))
+        if location.get("file", name) != name and os.path.isfile(stored_path):
+            # an identical report is already stored (names are timestamped, so the first stored is the oldest)
+            if not os.path.samefile(report_path, stored_path):
+                linked.append((name, stored_path))
+        elif now - mtime > hot_days * 86400:
+            if "bundle" not in location:
+                bundle = "{}/{}.zip".format(BUNDLE_FOLDER, report_month(name, mtime))
+                to_bundle.setdefault(bundle, {})[sha1 + ".pdf"] = report_path
+                contents[sha1] = OrderedDict([("bundle", bundle), ("member", sha1 + ".pdf")])
+            removed.append(name)
+        elif "bundle" not in location:
+            contents[sha1] = OrderedDict([("file", name)])
+    if to_bundle and not os.path.isdir(os.path.join(archive_folder, BUNDLE_FOLDER)):
+        os.makedirs(os.path.join(archive_folder, BUNDLE_FOLDER))
+    for bundle, members in to_bundle.items():
+        bundle_reports(archive_folder, bundle, members)
+    write_manifest(archive_folder, manifest)
+    for name, stored_path in linked:
+        report_path = os.path.join(archive_folder, name)
+        temporary_path = atomic_write.temporary_path(report_path)
+        os.link(stored_path, temporary_path)
+        os.rename(temporary_path, report_path)
+    for name in removed:
+        os.remove(os.path.join(archive_folder, name))
+    return OrderedDict([("deduplicated", len(linked)), ("bundled", len(removed)),
+                        ("hot", len(names) - len(removed))])
+
+
+def archived_reports(archive_folder, stat=None):
+    """
+    Return every archived report, newest first: reports in the archive folder, and reports recorded in the manifest
+    (bundled or deduplicated).
+        :param archive_folder:  (str) path to archived reports
+        :param stat:            (function or NoneType) called with a list of report paths, returns their modification
+                                                       times (e.g. to stat concurrently). None to stat one by one
+        :return:                (list) (report name, mtime) tuples
+    """
+    reports = dict((name, details["mtime"]) for name, details in read_manifest(archive_folder)["reports"].items())
+    new_reports = [name for name in hot_reports(archive_folder) if name not in reports]
+    report_paths = [os.path.join(archive_folder, name) for name in new_reports]
+    reports.update(zip(new_reports, stat(report_paths) if stat else [os.path.getmtime(path) for path in report_paths]))
+    return sorted(reports.items(), key=lambda report: (-report[1], report[0]))
+
+
+def open_report(archive_folder, name):
+    """
+    Return the content of an archived report, wherever it is stored.
+        :param archive_folder:  (str) path to archived reports
+        :param name:            (str) report name
+        :return:                (bytes or NoneType) report PDF, or None if there is no such report
+    """
+    if name != os.path.basename(name) or not name.endswith(".pdf"):
+        return None
+    report_path = os.path.join(archive_folder, name)
+    if os.path.isfile(report_path):
+        with open(report_path, "rb") as report_file:
+            return report_file.read()
+    manifest = read_manifest(archive_folder)
+    if name not in manifest["reports"]:
+        return None
+    location = manifest["contents"][manifest["reports"][name]["sha1"]]
+    if "file" in location:
+        with open(os.path.join(archive_folder, location["file"]), "rb") as report_file:
+            return report_file.read()
+    with zipfile.ZipFile(os.path.join(archive_folder, location["bundle"])) as bundle_file:
+        return bundle_file.read(location["member"])
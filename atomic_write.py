@@ -0,0 +1,31 @@
+"""
+Atomic file writes, shared by everything writing a file another process may read while it is written (published html,
+metrics textfile, job results, rebuild requests, archive manifest, explain plans and trend data exports).
+
+A file is written to a temporary file in the same folder and renamed into place. A rename within a filesystem replaces
+the file atomically, so readers see the previous file or the new one, never a partially written file. Temporary files
+are named after the host and process writing them, so writers on nodes sharing a folder do not collide.
+"""
+import os
+import socket
+
+
+def temporary_path(path):
+    """
+    Return the path of the temporary file a file is written to before being renamed into place.
+        :param path:    (str) path to the file
+        :return:        (str) path to the temporary file, in the same folder
+    """
+    return "{}.{}.{}.tmp".format(path, socket.gethostname(), os.getpid())
+
+
+def write_atomic(path, data):
+    """
+    Write a file to a temporary file in the same folder and rename it into place.
+        :param path:    (str) path to the file
+        :param data:    (str or bytes) file contents. Bytes are written in binary mode
+    """
+    temporary = temporary_path(path)
+    with open(temporary, "wb" if isinstance(data, bytes) else "w") as temporary_file:
+        temporary_file.write(data)
+    os.rename(temporary, path)
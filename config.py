@@ -30,6 +30,46 @@ with open(pw_file, "r") as email_password_file:
 # wkhtmltopdf_path:            Path to html conversion utility
 # plot_order:                  Order of plots in report (top to bottom). Only plots in this list are included
 # logopath:                    Path to viapath logo
+# mmap_min_bytes:              MultiQC files of at least this size (bytes) are memory-mapped when parsed
+# figure_pool_size:            Number of figures kept for reuse per plot type (box plot, stacked bar), so each plot only
+#                              replaces the data of a configured figure rather than building a new one. 0 builds a new
+#                              figure for every plot
+# io_concurrency:              Maximum number of concurrent directory listings/file reads/stats on input and archive
+#                              folders (these are on network storage, where each operation is a round trip)
+# input_root_timeout:          Seconds to wait for the input roots to be listed. A root not listed in time (e.g. a hung
+#                              network mount) is skipped for that scan, as is a root that cannot be listed
+# s3_endpoint_url:             Endpoint of the S3-compatible object storage holding s3:// input roots (e.g. a MinIO
+#                              server), or None for AWS S3. Credentials are read by boto3 (environment or ~/.aws)
+# storage_cache_folder:        Path to the on-disk cache MultiQC files in object storage are read through (see
+#                              storage.py). Cached files persist across runs
+# storage_cache_mb:            Size (MB) the storage cache is kept under, evicting the least recently read files
+# outlier_z_threshold:         Samples with an absolute robust z-score (median/MAD, per tool and sequencer across the
+#                              runs in a report) above this are flagged as outliers in the report and email
+# backfill_processes:          Number of processes regenerating reports in parallel in backfill mode
+# serve_host:                  Address the on-demand report server (serve command) listens on
+# serve_port:                  Port the on-demand report server listens on (overridden by --port)
+# serve_cache_size:            Number of rendered reports (run type and window) held in memory by the report server
+# archive_hot_days:            Archive maintenance (archive command) rolls report PDFs archived more than this many days
+#                              ago into monthly bundles (archive_folder/bundles/YYYY-MM.zip)
+# memory_budget_mb:            Memory budget (MB resident set size) of a report run, or 0 for no budget. With a budget,
+#                              MultiQC files are read one run type at a time rather than all before the first report,
+#                              and cached file data is dropped before a run type if the budget has been exceeded
+# tick_budget_seconds:         Time budget (seconds from the start of report building) of a report run, or 0 for no
+#                              budget. Alerting run types (WES, CUSTOM_PANELS, SWIFT) are reported and emailed first;
+#                              once the budget is spent, remaining reports of other run types and PDFs are deferred to
+#                              the next run (see report_scheduler.py)
+# pdf_concurrency:             Number of report PDFs archived at a time, alongside the reports of non-alerting run types
+# explain_history:             Number of most recent run logs whose stage timings are used to estimate the cost of a
+#                              report run (--explain)
+# distributed:                 Generate reports in distributed mode: report and PDF jobs are published to queue_folder
+#                              and run by workers (read_qc_files.py --worker) on any node mounting it, as well as by the
+#                              instance that published them, which then updates archive_index.html and sends emails
+# lease_timeout:               Seconds after a distributed mode worker's last heartbeat that its job may be taken over
+#                              by another worker (the worker is assumed to have died)
+# heartbeat_interval:          Seconds between heartbeats (lease renewals) of a distributed mode worker running a job
+# queue_poll_interval:         Seconds a distributed mode worker waits before looking for jobs again when none are ready
+# export_parquet:              Also export the data behind each trend report as Parquet (requires pyarrow). CSV and
+#                              JSON-lines exports are always written
 # mokaguys_email:              General bioinformatics email, which receives all sent out emails
 # host:                        The host running the SMTP server
 # port:                        Port, where SMTP server is listening
@@ -38,11 +78,25 @@ with open(pw_file, "r") as email_password_file:
 
 # Production/development -------------------------------------------------------------------------
 # index_file:                  Path to the index.html file (used for the main trend analysis homepage)
-# input_folder:                Path to directory containing individual run folders (these contain per-run multiqc files)
+# input_folder:                Path to directory containing individual run folders (these contain per-run multiqc files),
+#                              or a list of such paths (input roots), which are listed concurrently and merged. A
+#                              runfolder in more than one root is read from the root where it was modified most recently
+#                              A root may also be a prefix in S3-compatible object storage (s3://bucket/prefix, requires
+#                              boto3, see storage.py)
 # output_folder:               Path to save location for html trend reports and archive_index.html
 # images_folder:               Path to viapath logo and plot save location
 # template_dir:                Path to html templates
 # archive_folder:              Path to archived html reports
+# run_log_folder:              Path to JSON run logs (per-stage timings) and --profile outputs
+# prometheus_textfile:         Path to .prom file read by the node_exporter textfile collector (pipeline and QC metrics)
+# backfill_folder:             Path to reports regenerated as of past dates in backfill mode (a folder per date)
+# metrics_db:                  Path to the SQLite store of QC measurements, filled during report generation and read by
+#                              the query command
+# queue_folder:                Path to the distributed mode job queue. Must be on storage shared by all worker nodes
+# rebuild_folder:              Path to report rebuild requests recorded by the ingest command, handled by the next run
+# lock_file:                   Path to the run lock. An invocation started while another is running records a rerun
+#                              request (lock_file + ".rerun") and exits; the running instance then runs once more if
+#                              new runfolders have arrived or been ingested
 # reports_hyperlink:           Link to the trend analysis homepage from which the MultiQC reports can be accessed.
 # wes_email:                   Recipient for completed WES trend analysis email alerts
 # oncology_ops_email:          Recipient for completed SWIFT trend analysis email alerts
@@ -61,11 +115,33 @@ general_config = {"general": {"run_frequency": 2,
                                              "properly_paired", "pct_off_amplicon", "fastq_total_sequences",
                                              "peddy_sex_check"],
                               "logopath": "images/viapathlogo.png",
+                              "mmap_min_bytes": 8388608,
+                              "figure_pool_size": 2,
+                              "io_concurrency": 16,
+                              "input_root_timeout": 60,
+                              "s3_endpoint_url": None,
+                              "storage_cache_folder": "/var/tmp/trend_analysis_storage_cache",
+                              "storage_cache_mb": 2048,
+                              "outlier_z_threshold": 3.5,
+                              "backfill_processes": 4,
+                              "serve_host": "localhost",
+                              "serve_port": 8080,
+                              "serve_cache_size": 16,
+                              "memory_budget_mb": 0,
+                              "archive_hot_days": 31,
+                              "tick_budget_seconds": 0,
+                              "pdf_concurrency": 2,
+                              "explain_history": 20,
+                              "distributed": False,
+                              "lease_timeout": 300,
+                              "heartbeat_interval": 30,
+                              "queue_poll_interval": 5,
+                              "export_parquet": False,
                               "mokaguys_email": "gst-tr.mokaguys@nhs.net",
                               "host": "email-smtp.eu-west-1.amazonaws.com",
                               "port": 587,
                               "sender": "moka.alerts@gstt.nhs.uk",
-                              "email_message": """The MultiQC report is available for: \n{run_list}\n\nTrend analysis report has been updated to include these runs.\nAvailable at {hyperlink}.\n\nSent using trend_analysis {version}"""
+                              "email_message": """The MultiQC report is available for: \n{run_list}\n\nTrend analysis report has been updated to include these runs.\nAvailable at {hyperlink}.{outliers}\n\nSent using trend_analysis {version}"""
                               },
                   "production": {"index_file": "/var/www/html/mokaguys/multiqc/index.html",
                                  "input_folder": "/var/www/html/mokaguys/multiqc/trend_analysis/multiqc_data",
@@ -73,6 +149,13 @@ general_config = {"general": {"run_frequency": 2,
                                  "images_folder": "/var/www/html/mokaguys/multiqc/trend_analysis/images/",
                                  "template_dir": "/usr/local/src/mokaguys/apps/trend_analysis/html_template",
                                  "archive_folder": "/var/www/html/mokaguys/multiqc/trend_analysis/archive",
+                                 "backfill_folder": "/var/www/html/mokaguys/multiqc/trend_analysis/backfill",
+                                 "run_log_folder": "/usr/local/src/mokaguys/apps/trend_analysis/run_logs",
+                                 "prometheus_textfile": "/var/lib/node_exporter/textfile_collector/trend_analysis.prom",
+                                 "queue_folder": "/var/www/html/mokaguys/multiqc/trend_analysis_queue",
+                                 "rebuild_folder": "/usr/local/src/mokaguys/apps/trend_analysis/rebuild_requests",
+                                 "lock_file": "/usr/local/src/mokaguys/apps/trend_analysis/trend_analysis.lock",
+                                 "metrics_db": "/usr/local/src/mokaguys/apps/trend_analysis/qc_metrics.sqlite",
                                  "reports_hyperlink": "https://genomics.viapath.co.uk/mokaguys/multiqc/",
                                  "wes_email": "WES@viapath.co.uk",
                                  "oncology_ops_email": "m.neat@nhs.net",
@@ -87,6 +170,17 @@ general_config = {"general": {"run_frequency": 2,
                                   "template_dir":
                                       "/usr/local/src/mokaguys/development_area/trend_analysis/html_template",
                                   "archive_folder": "/var/www/html/mokaguys/dev/multiqc/trend_analysis/archive",
+                                  "backfill_folder": "/var/www/html/mokaguys/dev/multiqc/trend_analysis/backfill",
+                                  "run_log_folder": "/usr/local/src/mokaguys/development_area/trend_analysis/run_logs",
+                                  "prometheus_textfile":
+                                      "/var/lib/node_exporter/textfile_collector/trend_analysis_dev.prom",
+                                  "queue_folder": "/var/www/html/mokaguys/dev/multiqc/trend_analysis_queue",
+                                  "rebuild_folder":
+                                      "/usr/local/src/mokaguys/development_area/trend_analysis/rebuild_requests",
+                                  "lock_file":
+                                      "/usr/local/src/mokaguys/development_area/trend_analysis/trend_analysis.lock",
+                                  "metrics_db":
+                                      "/usr/local/src/mokaguys/development_area/trend_analysis/qc_metrics.sqlite",
                                   "reports_hyperlink": "https://genomics.viapath.co.uk/mokaguys/dev/multiqc/",
                                   "wes_email": "gst-tr.mokaguys@nhs.net",
                                   "oncology_ops_email": "gst-tr.mokaguys@nhs.net",
@@ -96,6 +190,30 @@ general_config = {"general": {"run_frequency": 2,
                                   }
                   }
 
+# ==== RUN TYPE IDENTIFIERS ==================================================================
+
+# Rules used by read_qc_files.py to classify runfolder names into run types. Each runfolder name is classified once
+# into every run type whose rule it matches, so a run can appear in more than one report (e.g. WES and NEXTSEQ_MARIO).
+# Adding a new run type only requires a new entry here (plus its report_type entries in tool_settings).
+
+# include:                  Substrings that must all be present in the runfolder name
+# exclude:                  Substrings that must all be absent from the runfolder name
+# regex:                    Regular expression the runfolder name must match (re.search), or False if not required
+
+run_type_identifiers = {
+    "WES": {"include": ["WES"], "exclude": [], "regex": False},
+    "CUSTOM_PANELS": {"include": ["NGS"], "exclude": ["WES"], "regex": False},
+    "SWIFT": {"include": ["ONC"], "exclude": [], "regex": False},
+    "NEXTSEQ_LUIGI": {"include": ["NB552085"], "exclude": [], "regex": False},
+    "NEXTSEQ_MARIO": {"include": ["NB551068"], "exclude": [], "regex": False},
+    "MISEQ_ONC": {"include": ["M02353"], "exclude": [], "regex": False},
+    "MISEQ_DNA": {"include": ["M02631"], "exclude": [], "regex": False},
+    "NOVASEQ_PIKACHU": {"include": ["A01229"], "exclude": [], "regex": False},
+    "TSO500": {"include": ["TSO500"], "exclude": [], "regex": False},
+    "SNP": {"include": ["SNP"], "exclude": [], "regex": False},
+    "ADX": {"include": ["ADX"], "exclude": [], "regex": False}
+}
+
 # ==== TOOL-SPECIFIC SETTINGS ================================================================
 
 # Contains config settings per plot (see plot_order list for full list of plots). Each plot is a dictionary key
@@ -672,6 +790,15 @@ tool_settings = {
 # body_template     Template used to create the individual trend reports
 # plot_template     Template used to create html blocks for each QC plot.
 # table_template    Template used to create a html tables for each QC report.
+# outlier_template  Template used to create the html table of outlier samples (one row per outlier sample).
+# htaccess          Apache configuration written to output_folder/.htaccess (requires AllowOverride FileInfo and
+#                   mod_headers/mod_rewrite). Plot images have content-hashed names (e.g. WES_contamination.<16 hex
+#                   characters>.png), so are cached by browsers and proxies as immutable. Html is revalidated on every
+#                   request, and the pre-compressed .html.gz copy is served to browsers accepting gzip encoding.
+#                   Requests for archived reports no longer in the archive folder (bundled by archive maintenance)
+#                   are proxied to the report server (read_qc_files.py serve), which requires
+#                   mod_proxy_http. Formatted with serve_port (braces are doubled), so a server started with a
+#                   different --port is not reached through the proxy.
 
 body_template = '<div class="body" align="left">{}<br /></div>'
 
@@ -698,3 +825,54 @@ table_template = \
     </div> \
     <div class="clear">&nbsp;</div> \
     <hr width="90%" size="4" color="black">'
+
+outlier_template = \
+    '<h2>Outlier samples</h2> \
+    <div align="left"><br /><br /><br />Samples with an absolute robust z-score (median/MAD of all samples from the same \
+    sequencer in the runs in this report) above {}.</div> \
+    <div> \
+        <table border="1" width="90%" cellpadding="3" cellspacing="0">\n \
+        \t<thead>\n \
+        \t<tr style="text-align: centre;" bgcolor="#A8A8A8">\n \
+        \t\t<th>Tool</th>\n \
+        \t\t<th>Run Name</th>\n \
+        \t\t<th>Sample</th>\n \
+        \t\t<th>Sequencer</th>\n \
+        \t\t<th>Value</th>\n \
+        \t\t<th>Robust z-score</th>\n \
+        \t</tr>\n \
+        </thead>\n \
+        <tbody>\n{}\n</tbody>\n \
+        </table> \
+    </div> \
+    <div class="clear">&nbsp;</div> \
+    <hr width="90%" size="4" color="black">'
+
+htaccess = \
+    """# Written by read_qc_files.py - changes are overwritten (see config.htaccess)
+<IfModule mod_headers.c>
+    <FilesMatch "\\.[0-9a-f]{{16}}\\.png$">
+        Header set Cache-Control "public, max-age=31536000, immutable"
+    </FilesMatch>
+    <FilesMatch "\\.html(\\.gz)?$">
+        Header set Cache-Control "no-cache"
+        Header append Vary Accept-Encoding
+    </FilesMatch>
+    <FilesMatch "\\.html\\.gz$">
+        ForceType text/html
+        Header set Content-Encoding gzip
+    </FilesMatch>
+</IfModule>
+<IfModule mod_rewrite.c>
+    RewriteEngine On
+    # reports are built in hidden build folders before being published (see staged_publish.py)
+    RewriteRule (^|/)\\.build_ - [R=404,L]
+    RewriteCond %{{HTTP:Accept-Encoding}} gzip
+    RewriteCond %{{REQUEST_FILENAME}}.gz -f
+    RewriteRule ^(.+\\.html)$ $1.gz [E=no-gzip:1,L]
+    <IfModule mod_proxy_http.c>
+        RewriteCond %{{REQUEST_FILENAME}} !-f
+        RewriteRule ^archive/([^/]+\\.pdf)$ http://localhost:{serve_port}/archive/$1 [P,L]
+    </IfModule>
+</IfModule>
+"""
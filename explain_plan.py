@@ -0,0 +1,149 @@
+"""
+Cost estimates and output of the execution plan of a report run (read_qc_files.py --explain).
+
+An explain run builds the plan of a report run without running it: the run types whose reports would be rebuilt (and
+why), the runs in each report, the MultiQC files that would be read and the file requests served by a shared read,
+the plots that would be rendered or skipped, the PDFs (including those deferred by the previous run's time budget) and
+emails that would be produced, and the reports a time budget may defer. Nothing is rendered, published, archived,
+recorded or sent. Costs are estimated from the stage timings recorded in recent run logs (see profiling.py): the mean
+wall time of each stage's spans, multiplied by the number of times the plan would run the stage. File reads run
+concurrently (up to io_concurrency at once), so their estimate is the serial read time divided by the concurrency.
+Stages with no recorded spans are listed, and not included in the estimates.
+"""
+from __future__ import division
+import glob
+import json
+import os
+from collections import OrderedDict
+import atomic_write
+
+# Stages run by each item of work in a plan
+PLOT_STAGES = ["box_plot", "stacked_bar"]
+REPORT_STAGES = ["export_data", "generate_report", "publish"]
+PDF_STAGES = ["wkhtmltopdf", "generate_archive_html"]
+
+
+def stage_timings(run_log_folder, history):
+    """
+    Return the mean wall time of each stage's spans, over recent run logs.
+        :param run_log_folder:  (str) folder run logs are written to
+        :param history:         (int) number of most recent run logs to use
+        :return:                (OrderedDict) stage as key, mean wall time (seconds) per span as value, sorted by stage
+    """
+    totals = {}
+    run_log_paths = sorted(glob.glob(os.path.join(run_log_folder, "*_run_log.json")))[-history:] if history else []
+    for run_log_path in run_log_paths:
+        try:
+            with open(run_log_path) as run_log_file:
+                stages = json.load(run_log_file)["summary"]["stages"]
+        except (IOError, OSError, ValueError, KeyError):
+            continue
+        for stage, timing in stages.items():
+            count, wall = totals.get(stage, (0, 0.0))
+            totals[stage] = (count + timing["count"], wall + timing["wall"])
+    return OrderedDict((stage, wall / count) for stage, (count, wall) in sorted(totals.items()) if count)
+
+
+def estimate(counts, timings, missing):
+    """
+    Return the estimated wall time of running stages a number of times.
+        :param counts:      (list) (stage, number of spans) pairs
+        :param timings:     (dict) stage as key, mean wall time per span as value (see stage_timings)
+        :param missing:     (set) updated with the stages that have no recorded timings
+        :return:            (float) estimated seconds
+    """
+    seconds = 0.0
+    for stage, count in counts:
+        if not count:
+            continue
+        if stage in timings:
+            seconds += timings[stage] * count
+        else:
+            missing.add(stage)
+    return seconds
+
+
+def add_estimates(plan, timings, io_concurrency):
+    """
+    Attach estimated costs to a plan: per report, for the input scan and file reads, and in total.
+        :param plan:            (OrderedDict) plan built by read_qc_files.plan_run
+        :param timings:         (dict) stage as key, mean wall time per span as value (see stage_timings)
+        :param io_concurrency:  (int) maximum number of concurrent file reads
+        :return:                (OrderedDict) plan, with estimated_seconds added to the reads, deferred PDFs, each
+                                              report and the plan, may_defer added to each report, and the timings
+                                              used and stages without timings added to the plan
+
+    With a time budget, a report of a non-alerting run type estimated to start (counting from the start of report
+    building) once the budget is spent may be deferred to the next run (see report_scheduler.py).
+    """
+    missing = set()
+    plan["scan"]["estimated_seconds"] = estimate([("scan_input_root", 1)], timings, missing)
+    plan["reads"]["estimated_seconds"] = estimate([("read_multiqc_file", plan["reads"]["files"])], timings,
+                                                  missing) / max(1, min(io_concurrency, plan["reads"]["files"]))
+    plan["deferred_pdfs"]["estimated_seconds"] = estimate(
+        [(stage, len(plan["deferred_pdfs"]["run_types"])) for stage in PDF_STAGES], timings, missing)
+    total = plan["scan"]["estimated_seconds"] + plan["reads"]["estimated_seconds"]
+    building = 0.0
+    for report in plan["reports"]:
+        counts = [(plot_type, len(report["plots"].get(plot_type, []))) for plot_type in PLOT_STAGES]
+        if report["rebuild"]:
+            counts += [(stage, 1) for stage in REPORT_STAGES]
+        if report["pdf"]:
+            counts += [(stage, 1) for stage in PDF_STAGES]
+        counts.append(("send_email", 1 if report["email"] else 0))
+        report["estimated_seconds"] = estimate(counts, timings, missing)
+        report["may_defer"] = bool(plan["budget_seconds"]) and not report["alerting"] and \
+            building >= plan["budget_seconds"]
+        building += report["estimated_seconds"]
+    plan["estimated_seconds"] = total + building + plan["deferred_pdfs"]["estimated_seconds"]
+    plan["stage_timings"] = OrderedDict((stage, round(seconds, 6)) for stage, seconds in timings.items())
+    plan["stages_without_timings"] = sorted(missing)
+    return plan
+
+
+def describe(plan):
+    """
+    Describe a plan for reading at the terminal.
+        :param plan:    (OrderedDict) plan with estimates (see add_estimates)
+        :return:        (str) plan summary
+    """
+    lines = ["explain: {} ({})".format(plan["reason"], "distributed" if plan["distributed"] else "local"),
+             "input: {} runfolders (scan ~{:.1f}s)".format(plan["scan"]["runfolders"], plan["scan"]["estimated_seconds"]),
+             "reads: {} files to parse, {} of {} file requests served by a shared read (~{:.1f}s)".format(
+                 plan["reads"]["files"], plan["reads"]["cache_hits"], plan["reads"]["requests"],
+                 plan["reads"]["estimated_seconds"])]
+    for report in plan["reports"]:
+        plots = sum(len(tools) for tools in report["plots"].values())
+        lines.append("{}: {} ({} runs, newest {}) - {} plots to render, {} skipped, {}, {} (~{:.1f}s)".format(
+            report["runtype"], "rebuild, " + report["reason"] if report["rebuild"] else report["reason"],
+            len(report["runs"]), report["runs"][-1] if report["runs"] else "none", plots, len(report["plots_skipped"]),
+            "PDF archived" if report["pdf"] else "no PDF",
+            "email for {} new runs".format(len(report["new_runs"])) if report["email"] else "no email",
+            report["estimated_seconds"]) + (" - may be deferred by the time budget" if report["may_defer"] else ""))
+    if plan["deferred_pdfs"]["run_types"]:
+        lines.append("deferred PDFs: archived for {} (~{:.1f}s)".format(", ".join(plan["deferred_pdfs"]["run_types"]),
+                                                                        plan["deferred_pdfs"]["estimated_seconds"]))
+    if plan["budget_seconds"]:
+        lines.append("time budget: {}s - reports of non-alerting run types and PDFs not started within it are deferred "
+                     "to the next run ({} reports estimated to start after it)".format(
+                         plan["budget_seconds"], sum(1 for report in plan["reports"] if report["may_defer"])))
+    lines.append("total: {} reports rebuilt, {} PDFs, {} emails (~{:.1f}s estimated from {} stage timings)".format(
+        sum(1 for report in plan["reports"] if report["rebuild"]),
+        sum(1 for report in plan["reports"] if report["pdf"]) + len(plan["deferred_pdfs"]["run_types"]),
+        sum(1 for report in plan["reports"] if report["email"]), plan["estimated_seconds"],
+        len(plan["stage_timings"])))
+    if plan["stages_without_timings"]:
+        lines.append("no recorded timings for: {}".format(", ".join(plan["stages_without_timings"])))
+    return "\n".join(lines)
+
+
+def write_plan(plan, path):
+    """
+    Write a plan as JSON.
+        :param plan:    (OrderedDict) plan with estimates (see add_estimates)
+        :param path:    (str) path to the JSON plan
+    """
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    atomic_write.write_atomic(path, json.dumps(plan, indent=1))
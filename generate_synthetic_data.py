@@ -0,0 +1,192 @@
+"""
+Synthetic MultiQC data generator.
+
+Fabricates input_folder trees (one runfolder per run, containing every input_file named in config.tool_settings) for
+development, tests and benchmarks, without needing production data.
+"""
+from __future__ import division
+import argparse
+import datetime
+import os
+import random
+import config as config
+
+# Sequencer: (run identifiers used in runfolder names, number of lanes)
+SEQUENCERS = {"NB551068": (["WES", "NGS"], 4),
+              "NB552085": (["WES", "NGS"], 4),
+              "A01229": (["WES", "NGS"], 2),
+              "M02631": (["ONC"], 1),
+              "M02353": (["ONC"], 1)}
+
+# Capture kit panel lists, in the format returned by read_qc_files.get_panel_dict
+PANEL_DICT = {"vcp1_panel_list": ["Pan4119", "Pan4120", "Pan4121"],
+              "vcp2_panel_list": ["Pan4081", "Pan4082", "Pan4083"],
+              "vcp3_panel_list": ["Pan4149", "Pan4150", "Pan4151"]}
+
+# Column of interest: function returning a realistic value as a string
+COLUMN_VALUES = {"MEAN_INSERT_SIZE": lambda rng: "{:.2f}".format(rng.gauss(220, 25)),
+                 "percent_Q30": lambda rng: "{:.2f}".format(min(100.0, rng.gauss(91, 3))),
+                 "PCT_TARGET_BASES_30X": lambda rng: "{:.6f}".format(min(1.0, rng.gauss(0.95, 0.02))),
+                 "PCT_TARGET_BASES_20X": lambda rng: "{:.6f}".format(min(1.0, rng.gauss(0.97, 0.015))),
+                 "ON_BAIT_VS_SELECTED": lambda rng: "{:.6f}".format(min(1.0, rng.gauss(0.8, 0.03))),
+                 "FREEMIX": lambda rng: "{:.5f}".format(abs(rng.gauss(0.005, 0.01))),
+                 "properly paired_passed_pct": lambda rng: "{:.2f}".format(min(100.0, rng.gauss(97, 1.5))),
+                 "PCT_OFF_AMPLICON": lambda rng: "{:.6f}".format(abs(rng.gauss(0.05, 0.02))),
+                 "Total Sequences": lambda rng: "{:.1f}".format(max(0.0, rng.gauss(4e7, 6e6))),
+                 "error_sex_check": lambda rng: rng.choice(["False"] * 8 + ["True", ""])}
+
+
+def arg_parse():
+    """
+    Parses arguments supplied by the command line.
+        :return: (Namespace object) parsed command line attributes
+    """
+    parser = argparse.ArgumentParser(description="Generate a synthetic input_folder of MultiQC runfolders")
+    parser.add_argument('input_folder', help="folder to create runfolders in")
+    parser.add_argument('--runs', type=int, default=10, help="number of runfolders per sequencer")
+    parser.add_argument('--samples', type=int, default=24, help="number of samples per run")
+    parser.add_argument('--extra_columns', type=int, default=10, help="number of filler columns per MultiQC table")
+    parser.add_argument('--seed', type=int, default=1, help="random seed")
+    return parser.parse_args()
+
+
+def input_files():
+    """
+    Return every MultiQC input file named in config.tool_settings, with the columns of interest read from each.
+        :return:    (dict) input_file as key, sorted list of column_of_interest values as value
+    """
+    files = {}
+    for tool in config.tool_settings:
+        if "input_file" in config.tool_settings[tool]:
+            files.setdefault(config.tool_settings[tool]["input_file"], set()).add(
+                config.tool_settings[tool]["column_of_interest"])
+    return dict((input_file, sorted(columns)) for input_file, columns in files.items())
+
+
+def runfolder_names(runs_per_sequencer, start_date, rng):
+    """
+    Return runfolder names (e.g. 001_200101_NB551068_0001_AHXXXXXXXX_WES1) for each sequencer.
+        :param runs_per_sequencer:  (dict) sequencer as key, number of runfolders as value
+        :param start_date:          (date) date of the first run. Runs are spaced 1-7 days apart per sequencer
+        :param rng:                 (Random) random number generator
+        :return:                    (list) runfolder names
+    """
+    names = []
+    for sequencer in sorted(runs_per_sequencer):
+        identifiers = SEQUENCERS[sequencer][0]
+        run_date = start_date
+        for run_number in range(1, runs_per_sequencer[sequencer] + 1):
+            run_date += datetime.timedelta(days=rng.randint(1, 7))
+            identifier = identifiers[run_number % len(identifiers)]
+            names.append("{:03d}_{}_{}_{:04d}_AH{:08X}_{}{}".format(
+                len(names) + 1, run_date.strftime('%y%m%d'), sequencer, run_number, rng.getrandbits(32), identifier,
+                run_number))
+    return names
+
+
+def sample_names(run, samples_per_run, rng):
+    """
+    Return sample names for a run, including one negative control (NTCcon). Custom panel and SWIFT samples carry a
+    panel number from PANEL_DICT, so capture kit normalisation can be exercised.
+        :param run:                 (str) runfolder name
+        :param samples_per_run:     (int) number of samples, including the negative control
+        :param rng:                 (Random) random number generator
+        :return:                    (list) sample names
+    """
+    run_identifier = run.split("_")[-1]
+    panels = [panel for panel_list in sorted(PANEL_DICT) for panel in PANEL_DICT[panel_list]]
+    names = []
+    for sample_number in range(1, samples_per_run + 1):
+        panel = "Pan493" if "WES" in run_identifier else rng.choice(panels)
+        sample_id = "NTCcon" if sample_number == samples_per_run else "{:08d}".format(rng.randint(0, 99999999))
+        names.append("{}_{:02d}_{}_{}_{}_S{}".format(run_identifier, sample_number, sample_id,
+                                                      rng.choice(["M", "F", "U"]), panel, sample_number))
+    return names
+
+
+def write_multiqc_table(file_path, row_names, columns, extra_columns, rng):
+    """
+    Write a tab-separated MultiQC table (header line, then one row per sample or lane).
+        :param file_path:       (str) path to write the table to
+        :param row_names:       (list) first column value for each row
+        :param columns:         (list) columns of interest, populated using COLUMN_VALUES
+        :param extra_columns:   (int) number of filler columns (MultiQC tables are generally wide)
+        :param rng:             (Random) random number generator
+    """
+    filler = ["METRIC_{}".format(number) for number in range(extra_columns)]
+    with open(file_path, "w") as table:
+        table.write("\t".join(["Sample"] + columns + filler) + "\n")
+        for row_name in row_names:
+            values = [COLUMN_VALUES.get(column, lambda rng: "{:.4f}".format(rng.random()))(rng) for column in columns]
+            values += ["{:.4f}".format(rng.random()) for _ in filler]
+            table.write("\t".join([row_name] + values) + "\n")
+
+
+def write_lane_metrics(file_path, lanes, rng):
+    """
+    Write a Picard CollectIlluminaLaneMetrics file (cluster density in the first column, one row per lane).
+        :param file_path:   (str) path to write the metrics file to
+        :param lanes:       (int) number of lanes
+        :param rng:         (Random) random number generator
+    """
+    with open(file_path, "w") as metrics:
+        metrics.write("## htsjdk.samtools.metrics.StringHeader\n"
+                      "# CollectIlluminaLaneMetrics --RUN_DIRECTORY run --OUTPUT_DIRECTORY lane_metrics\n"
+                      "## htsjdk.samtools.metrics.StringHeader\n"
+                      "# Started on: Mon Jan 06 10:00:00 GMT 2020\n\n"
+                      "## METRICS CLASS\tpicard.illumina.IlluminaLaneMetrics\n"
+                      "CLUSTER_DENSITY\tLANE\n")
+        for lane in range(1, lanes + 1):
+            metrics.write("{:.2f}\t{}\n".format(rng.gauss(250000, 30000), lane))
+        metrics.write("\n\n")
+
+
+def generate_input_folder(input_folder, runs_per_sequencer=None, samples_per_run=24, extra_columns=10,
+                          start_date=datetime.date(2020, 1, 1), seed=1):
+    """
+    Fabricate an input_folder containing one runfolder per run, each containing every input_file named in
+    config.tool_settings.
+        :param input_folder:        (str) folder to create runfolders in (created if it does not exist)
+        :param runs_per_sequencer:  (dict) sequencer as key, number of runfolders as value. Defaults to 10 runs for
+                                           each sequencer in SEQUENCERS
+        :param samples_per_run:     (int) number of samples per run
+        :param extra_columns:       (int) number of filler columns per MultiQC table
+        :param start_date:          (date) date of the first run
+        :param seed:                (int) random seed, so the same tree is generated each time
+        :return:                    (list) runfolder names created
+    """
+    rng = random.Random(seed)
+    if runs_per_sequencer is None:
+        runs_per_sequencer = dict((sequencer, 10) for sequencer in SEQUENCERS)
+    runs = runfolder_names(runs_per_sequencer, start_date, rng)
+    for run in runs:
+        multiqc_folder = os.path.join(input_folder, run, "multiqc_data")
+        if not os.path.isdir(multiqc_folder):
+            os.makedirs(multiqc_folder)
+        lanes = SEQUENCERS[run.split("_")[2]][1]
+        samples = sample_names(run, samples_per_run, rng)
+        for input_file, columns in sorted(input_files().items()):
+            if input_file == "illumina_lane_metrics":
+                write_lane_metrics(os.path.join(input_folder, run, run + ".illumina_lane_metrics"), lanes, rng)
+            elif input_file == "multiqc_bcl2fastq_bylane.txt":
+                write_multiqc_table(os.path.join(multiqc_folder, input_file),
+                                    ["{} - {}".format(run.split("_")[4], lane) for lane in range(1, lanes + 1)],
+                                    columns, extra_columns, rng)
+            elif input_file == "multiqc_fastqc.txt":
+                write_multiqc_table(os.path.join(multiqc_folder, input_file),
+                                    [sample + read for sample in samples for read in ("_R1_001", "_R2_001")],
+                                    columns, extra_columns, rng)
+            else:
+                write_multiqc_table(os.path.join(multiqc_folder, input_file), samples, columns, extra_columns, rng)
+    return runs
+
+
+def main():
+    args = arg_parse()
+    runs = generate_input_folder(args.input_folder, dict((sequencer, args.runs) for sequencer in SEQUENCERS),
+                                 samples_per_run=args.samples, extra_columns=args.extra_columns, seed=args.seed)
+    print("{} runfolders written to {}".format(len(runs), args.input_folder))
+
+
+if __name__ == '__main__':
+    main()
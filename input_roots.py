@@ -0,0 +1,125 @@
+"""
+Run inventory over one or more input roots.
+
+input_folder (config) may be a single path, or a list of paths (roots), e.g. when runfolders are uploaded to more than
+one storage volume. Each root is listed in its own thread, and the listings are merged into a single run inventory of
+runfolder name: path to the runfolder. A runfolder present in more than one root is taken from the root where it was
+modified most recently. A root that cannot be listed (e.g. an unmounted volume), or is not listed within
+input_root_timeout seconds (e.g. a hung network mount), is skipped so it does not hold up the others; the listing of
+a slow root is abandoned, not cancelled, and its thread ends whenever the listing returns.
+
+A root may be a prefix in S3-compatible object storage (s3://bucket/prefix) rather than a local folder; roots are listed
+through their storage backend (see storage.py).
+
+Each root's listing is recorded as a scan_input_root span in the run log, with the root and number of runfolders
+listed, so the scan time of each root is reported per run.
+"""
+from __future__ import division
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+import config
+import profiling
+import storage
+
+
+def input_roots(input_folder):
+    """
+    Return the input roots.
+        :param input_folder:    (str or list) path to MultiQC data per run, or list of paths
+        :return:                (list) paths to the input roots
+    """
+    if isinstance(input_folder, (list, tuple)):
+        return list(input_folder)
+    return [input_folder]
+
+
+def scan_root(root):
+    """
+    List the runfolders in an input root, recording the listing as a span in the run log.
+        :param root:    (str) path to the input root
+        :return:        (tuple) runfolder names, and seconds taken to list them
+    """
+    with profiling.run_log.span("scan_input_root") as record:
+        record["root"] = root
+        started = time.time()
+        runfolders = storage.listdir(root)
+        record["runfolders"] = len(runfolders)
+    return runfolders, time.time() - started
+
+
+def scan_runfolders(input_folder, timeout=None, timings=None):
+    """
+    Return the run inventory: the runfolders in each input root, listed concurrently and merged.
+        :param input_folder:    (str or list) path to MultiQC data per run, or list of paths
+        :param timeout:         (float or NoneType) seconds to wait for the roots to be listed, or None for
+                                                    input_root_timeout in config
+        :param timings:         (dict or NoneType) populated with root as key, (number of runfolders, seconds taken to
+                                                   list them) as value, or (None, error) for a root that was skipped
+        :return:                (OrderedDict) runfolder name as key, path to the runfolder as value, sorted by name
+
+    Raises the error listing the first root if no root could be listed.
+    """
+    roots = input_roots(input_folder)
+    timeout = config.general_config["general"]["input_root_timeout"] if timeout is None else timeout
+    timings = {} if timings is None else timings
+    pool = ThreadPoolExecutor(max_workers=len(roots))
+    try:
+        scans = OrderedDict((root, pool.submit(scan_root, root)) for root in roots)
+        wait(scans.values(), timeout=timeout)
+    finally:
+        # a hung listing must not hold up the scan, so the pool is not waited on
+        pool.shutdown(wait=False)
+    listings = OrderedDict({})
+    errors = []
+    for root, scan in scans.items():
+        if not scan.done():
+            timings[root] = (None, "not listed within {}s".format(timeout))
+        elif scan.exception() is not None:
+            timings[root] = (None, str(scan.exception()))
+            errors.append(scan.exception())
+        else:
+            listings[root], seconds = scan.result()
+            timings[root] = (len(listings[root]), seconds)
+            continue
+        print("input root {} skipped: {}".format(root, timings[root][1]))
+        profiling.run_log.increment("input_roots_skipped")
+    if not listings:
+        if errors:
+            raise errors[0]
+        raise OSError("no input root listed within {}s: {}".format(timeout, ", ".join(roots)))
+    inventory = {}
+    for root, runfolders in listings.items():
+        for run in runfolders:
+            path = os.path.join(root, run)
+            if run in inventory:
+                profiling.run_log.increment("duplicate_runfolders")
+                if runfolder_mtime(path) <= runfolder_mtime(inventory[run]):
+                    continue
+            inventory[run] = path
+    return OrderedDict(sorted(inventory.items()))
+
+
+def runfolder_mtime(path):
+    """
+    Return the modification time of a runfolder, or 0 if it has been removed since its root was listed.
+        :param path:    (str) path to the runfolder
+        :return:        (float) seconds since the epoch
+    """
+    try:
+        return storage.getmtime(path)
+    except OSError:
+        return 0
+
+
+def describe_timings(timings):
+    """
+    Describe the scan of each input root.
+        :param timings:     (dict) root as key, (number of runfolders, seconds) or (None, error) as value (see
+                                   scan_runfolders)
+        :return:            (str) one line per root
+    """
+    return "\n".join("input root {}: {}".format(
+        root, "{} runfolders listed in {:.3f}s".format(runfolders, detail) if runfolders is not None
+        else "skipped ({})".format(detail)) for root, (runfolders, detail) in sorted(timings.items()))
@@ -0,0 +1,277 @@
+"""
+Job queue over a shared folder, distributing trend report work between nodes that mount the same storage.
+
+A coordinator publishes a batch of jobs as a folder of job files in the queue folder (the batch is written to a
+temporary folder and renamed into place, so workers never see a partial batch). Any node running a worker claims a job
+by creating a lease file exclusively (O_CREAT | O_EXCL, atomic on local filesystems and NFSv3+), runs it, and records
+the result in a .done (or .failed) file, written atomically (see atomic_write.py). While a job runs, the
+worker renews its lease by touching the lease file every heartbeat_interval seconds. If a worker dies, its lease
+stops being renewed and, once older than lease_timeout, is taken over by another worker, so the job is run again
+(jobs must therefore be safe to repeat). A job is only claimed once all jobs it depends on are done, and is failed if
+any of them failed.
+
+Files in a batch folder, per job (prefixed with the job's position in the batch, so jobs are claimed in order):
+    {position}_{job_id}.json        job: id, depends_on (list of job ids) and any data needed to run it
+    {position}_{job_id}.lease       worker id of the worker running the job (mtime is the last heartbeat)
+    {position}_{job_id}.done        JSON result returned by the job
+    {position}_{job_id}.failed      error raised by the job
+"""
+from __future__ import division
+import datetime
+import errno
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import traceback
+import atomic_write
+
+JOB_SUFFIX = ".json"
+
+
+def publish(queue_folder, jobs):
+    """
+    Publish a batch of jobs.
+        :param queue_folder:    (str) path to the shared queue folder
+        :param jobs:            (list) jobs (dictionaries with an id, a depends_on list of job ids and any data needed
+                                       to run the job), in the order they should be claimed
+        :return:                (str) path to the batch folder
+    """
+    batch_name = "{}_{}_{}".format(datetime.datetime.now().strftime("%y%m%d_%H%M%S_%f"), socket.gethostname(),
+                                   os.getpid())
+    temporary_folder = os.path.join(queue_folder, "." + batch_name)
+    os.makedirs(temporary_folder)
+    for position, job in enumerate(jobs):
+        with open(os.path.join(temporary_folder, "{:04d}_{}{}".format(position, job["id"], JOB_SUFFIX)), "w") as \
+                job_file:
+            json.dump(job, job_file)
+    batch_folder = os.path.join(queue_folder, batch_name)
+    os.rename(temporary_folder, batch_folder)
+    return batch_folder
+
+
+def batch_jobs(batch_folder):
+    """
+    Return the jobs in a batch, in claim order.
+        :param batch_folder:    (str) path to the batch folder
+        :return:                (list) (job file prefix, job) tuples
+    """
+    jobs = []
+    for job_file_name in sorted(os.listdir(batch_folder)):
+        if job_file_name.endswith(JOB_SUFFIX):
+            with open(os.path.join(batch_folder, job_file_name)) as job_file:
+                jobs.append((os.path.join(batch_folder, job_file_name[:-len(JOB_SUFFIX)]), json.load(job_file)))
+    return jobs
+
+
+def job_state(prefix):
+    """
+    Return the state of a job.
+        :param prefix:  (str) path to the job's files, without suffix
+        :return:        (tuple) "done", "failed" or "pending", and the job's result or error (None if pending)
+    """
+    for state in ["done", "failed"]:
+        try:
+            with open("{}.{}".format(prefix, state)) as state_file:
+                return state, json.load(state_file)
+        except (IOError, OSError) as error:
+            if error.errno != errno.ENOENT:
+                raise
+    return "pending", None
+
+
+def batch_status(batch_folder):
+    """
+    Return the results of the jobs in a batch.
+        :param batch_folder:    (str) path to the batch folder
+        :return:                (tuple) dictionaries of job id: result of done jobs and job id: error of failed jobs,
+                                        and number of pending jobs
+    """
+    results, failures, pending = {}, {}, 0
+    for prefix, job in batch_jobs(batch_folder):
+        state, result = job_state(prefix)
+        if state == "done":
+            results[job["id"]] = result
+        elif state == "failed":
+            failures[job["id"]] = result
+        else:
+            pending += 1
+    return results, failures, pending
+
+
+def remove_batch(batch_folder):
+    """
+    Remove a finished batch from the queue.
+        :param batch_folder:    (str) path to the batch folder
+    """
+    shutil.rmtree(batch_folder)
+
+
+class Worker(object):
+    """
+    A class claiming and running jobs from the queue folder.
+
+    Attributes:
+        queue_folder        (str) path to the shared queue folder
+        worker_id           (str) identifies the worker in lease files (host name and process id)
+        lease_timeout       (float) seconds after the last heartbeat a lease may be taken over by another worker
+        heartbeat_interval  (float) seconds between heartbeats (lease renewals) while a job runs
+        poll_interval       (float) seconds to wait before looking for jobs again when none can be claimed
+        jobs_run            (int) number of jobs run by this worker
+    """
+
+    def __init__(self, queue_folder, lease_timeout, heartbeat_interval, poll_interval):
+        """
+        The constructor for Worker class
+        """
+        self.queue_folder = queue_folder
+        self.worker_id = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        self.jobs_run = 0
+
+    def batches(self):
+        """
+        Return the published batches, oldest first.
+            :return:    (list) paths to batch folders
+        """
+        try:
+            return [os.path.join(self.queue_folder, name) for name in sorted(os.listdir(self.queue_folder))
+                    if not name.startswith(".")]
+        except OSError:
+            return []
+
+    def take_lease(self, prefix):
+        """
+        Try to take the lease on a job, taking over the lease of a worker that has stopped renewing it.
+            :param prefix:  (str) path to the job's files, without suffix
+            :return:        (bool) True if the lease was taken
+        """
+        lease_path = prefix + ".lease"
+        for attempt in range(2):
+            try:
+                lease_descriptor = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+            else:
+                with os.fdopen(lease_descriptor, "w") as lease_file:
+                    lease_file.write(self.worker_id + "\n")
+                return True
+            try:
+                if time.time() - os.path.getmtime(lease_path) <= self.lease_timeout:
+                    return False
+                # the lease has expired. Only one worker can rename it away, and so try to take it over
+                os.rename(lease_path, "{}.expired.{}".format(lease_path, self.worker_id))
+            except OSError:
+                return False
+            print("lease on {} expired, taking over".format(os.path.basename(prefix)))
+        return False
+
+    def claim(self, batch_folder):
+        """
+        Claim the first job in a batch that is not done, failed or leased, and whose dependencies are done. Jobs
+        depending on a failed job are failed.
+            :param batch_folder:    (str) path to the batch folder
+            :return:                (tuple or NoneType) job file prefix, job, and dictionary of dependency job id:
+                                                        result, or None if no job can be claimed
+        """
+        jobs = batch_jobs(batch_folder)
+        prefixes = dict((job["id"], prefix) for prefix, job in jobs)
+        for prefix, job in jobs:
+            if job_state(prefix)[0] != "pending":
+                continue
+            dependency_states = dict((dependency, job_state(prefixes[dependency]))
+                                     for dependency in job.get("depends_on", []))
+            failed = [dependency for dependency, (state, _) in dependency_states.items() if state == "failed"]
+            if failed:
+                atomic_write.write_atomic(prefix + ".failed",
+                                          json.dumps("dependency failed: {}".format(", ".join(failed))))
+                continue
+            if any(state != "done" for state, _ in dependency_states.values()):
+                continue
+            if self.take_lease(prefix):
+                if job_state(prefix)[0] != "pending":
+                    # finished by another worker between checking its state and taking the lease
+                    self.release(prefix)
+                    continue
+                return prefix, job, dict((dependency, result) for dependency, (_, result) in dependency_states.items())
+        return None
+
+    def release(self, prefix):
+        """
+        Release the lease on a job.
+            :param prefix:  (str) path to the job's files, without suffix
+        """
+        try:
+            os.remove(prefix + ".lease")
+        except OSError:
+            pass
+
+    def heartbeat(self, prefix, stop):
+        """
+        Renew the lease on a job every heartbeat_interval seconds until stopped (run in a thread while the job runs).
+            :param prefix:  (str) path to the job's files, without suffix
+            :param stop:    (threading.Event) set when the job has finished
+        """
+        while not stop.wait(self.heartbeat_interval):
+            try:
+                os.utime(prefix + ".lease", None)
+            except OSError:
+                print("lease on {} lost".format(os.path.basename(prefix)))
+
+    def run_job(self, prefix, job, dependency_results, handler):
+        """
+        Run a claimed job, renewing its lease while it runs, and record its result or error.
+            :param prefix:              (str) path to the job's files, without suffix
+            :param job:                 (dict) job
+            :param dependency_results:  (dict) job id as key, result of each job the job depends on as value
+            :param handler:             (function) called with the job and dependency_results, returns a result that
+                                                   can be serialised as JSON
+        """
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat, args=(prefix, stop))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            result = handler(job, dependency_results)
+        except Exception:
+            print("job {} failed on {}".format(job["id"], self.worker_id))
+            atomic_write.write_atomic(prefix + ".failed", json.dumps(traceback.format_exc()))
+        else:
+            atomic_write.write_atomic(prefix + ".done", json.dumps(result))
+        finally:
+            stop.set()
+            heartbeat.join()
+            self.release(prefix)
+            self.jobs_run += 1
+
+    def work(self, handler, batch_folder=None, exit_when_idle=False):
+        """
+        Claim and run jobs until stopped.
+            :param handler:         (function) runs a job (see run_job)
+            :param batch_folder:    (str or NoneType) only run jobs from this batch, returning once all its jobs are
+                                                      done or failed (used by the coordinator). None for all batches
+            :param exit_when_idle:  (bool) return once no batch has a pending job, rather than waiting for new batches
+        """
+        while True:
+            claimed = None
+            pending = 0
+            for batch in [batch_folder] if batch_folder else self.batches():
+                try:
+                    claimed = self.claim(batch)
+                    if claimed:
+                        break
+                    pending += batch_status(batch)[2]
+                except OSError:
+                    # the batch was removed by its coordinator
+                    continue
+            if claimed:
+                self.run_job(*(claimed + (handler,)))
+            elif (batch_folder or exit_when_idle) and not pending:
+                return
+            else:
+                time.sleep(self.poll_interval)
@@ -0,0 +1,161 @@
+"""
+Indexed local store of historical QC metrics.
+
+Every measurement parsed for a trend report (see trend_export.export_rows) is recorded in a SQLite database, indexed on
+run date, tool, sequencer and run type, so questions such as "contamination for every A01229 WES run since January"
+can be answered without opening runfolders (see the read_qc_files.py query command). The store is filled as a side
+effect of report generation, so it covers every run that has been included in a trend report.
+"""
+import csv
+import datetime
+import sqlite3
+import sys
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS measurements (
+        runtype TEXT NOT NULL,
+        run TEXT NOT NULL,
+        run_date TEXT,
+        sequencer TEXT,
+        sample TEXT,
+        tool TEXT NOT NULL,
+        value,
+        lower_lim REAL,
+        upper_lim REAL
+    )""",
+    "CREATE INDEX IF NOT EXISTS measurements_tool_date ON measurements (tool, run_date)",
+    "CREATE INDEX IF NOT EXISTS measurements_sequencer_date ON measurements (sequencer, run_date)",
+    "CREATE INDEX IF NOT EXISTS measurements_runtype_date ON measurements (runtype, run_date)",
+    "CREATE INDEX IF NOT EXISTS measurements_run ON measurements (runtype, run, tool)",
+]
+
+# Columns returned by queries, in output order
+QUERY_COLUMNS = ["run_date", "runtype", "sequencer", "run", "sample", "tool", "value", "lower_lim", "upper_lim"]
+
+
+def run_details(run):
+    """
+    Return the date and sequencer of a runfolder, parsed from the runfolder name.
+        :param run: (str) runfolder name (e.g. 001_200101_NB551068_0001_AHXXXXXXXX_WES1)
+        :return:    (tuple) run date as an ISO date string (YYYY-MM-DD) and sequencer, each None if not in the name
+    """
+    fields = run.split("_")
+    try:
+        date = datetime.datetime.strptime(fields[1], "%y%m%d").date().isoformat()
+    except (IndexError, ValueError):
+        date = None
+    sequencer = fields[2] if len(fields) > 2 else None
+    return date, sequencer
+
+
+class MetricsStore(object):
+    """
+    A class recording and querying QC measurements in a SQLite database.
+
+    Attributes:
+        db_path         (str) path to the SQLite database (created if it does not exist)
+        connection      (Connection) database connection
+    """
+
+    def __init__(self, db_path):
+        """
+        The constructor for MetricsStore class
+        """
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        with self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+    def record(self, rows):
+        """
+        Record measurements, replacing any previously recorded for the same run type, run and tool (runs are included
+        in several successive reports).
+            :param rows:    (iterable) rows returned by trend_export.export_rows
+            :return:        (int) number of measurements recorded
+        """
+        replaced = set()
+        row_count = 0
+        with self.connection:
+            for row in rows:
+                key = (row["runtype"], row["run"], row["tool"])
+                if key not in replaced:
+                    self.connection.execute("DELETE FROM measurements WHERE runtype = ? AND run = ? AND tool = ?", key)
+                    replaced.add(key)
+                date, sequencer = run_details(row["run"])
+                value = str(row["value"]) if isinstance(row["value"], bool) else row["value"]
+                self.connection.execute(
+                    "INSERT INTO measurements (runtype, run, run_date, sequencer, sample, tool, value, lower_lim, "
+                    "upper_lim) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (row["runtype"], row["run"], date, sequencer, row["sample"], row["tool"], value, row["lower_lim"],
+                     row["upper_lim"]))
+                row_count += 1
+        return row_count
+
+    def query(self, runtype=None, sequencer=None, tool=None, since=None, until=None, sample=None):
+        """
+        Return recorded measurements matching all supplied filters, ordered by run date, run, tool and sample.
+            :param runtype:     (str or NoneType) run type (e.g. WES)
+            :param sequencer:   (str or NoneType) sequencer (e.g. A01229)
+            :param tool:        (str or NoneType) tool (e.g. contamination)
+            :param since:       (str or NoneType) earliest run date (YYYY-MM-DD), inclusive
+            :param until:       (str or NoneType) latest run date (YYYY-MM-DD), inclusive
+            :param sample:      (str or NoneType) sample name pattern, with shell-style wildcards (e.g. *NTCcon*)
+            :return:            (list) tuples of QUERY_COLUMNS values
+        """
+        conditions = []
+        parameters = []
+        for condition, parameter in [("runtype = ?", runtype), ("sequencer = ?", sequencer), ("tool = ?", tool),
+                                     ("run_date >= ?", since), ("run_date <= ?", until), ("sample GLOB ?", sample)]:
+            if parameter is not None:
+                conditions.append(condition)
+                parameters.append(parameter)
+        statement = "SELECT {} FROM measurements{} ORDER BY run_date, run, tool, sample".format(
+            ", ".join(QUERY_COLUMNS), " WHERE " + " AND ".join(conditions) if conditions else "")
+        return self.connection.execute(statement, parameters).fetchall()
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        self.connection.close()
+
+
+def format_value(value):
+    """
+    Return a value as text for query output.
+        :param value:   (str, int, float or NoneType) value returned by a query
+        :return:        (str) value as text (None as an empty string)
+    """
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return repr(value)
+    return "{}".format(value)
+
+
+def write_table(rows, output=None):
+    """
+    Write query results as a fixed-width text table.
+        :param rows:    (list) tuples of QUERY_COLUMNS values returned by MetricsStore.query
+        :param output:  (file or NoneType) file to write to, or None for standard out
+    """
+    output = output or sys.stdout
+    text_rows = [QUERY_COLUMNS] + [[format_value(value) for value in row] for row in rows]
+    widths = [max(len(text_row[column]) for text_row in text_rows) for column in range(len(QUERY_COLUMNS))]
+    for text_row in text_rows:
+        output.write("  ".join(text.ljust(width) for text, width in zip(text_row, widths)).rstrip() + "\n")
+    output.write("({} rows)\n".format(len(rows)))
+
+
+def write_csv(rows, output=None):
+    """
+    Write query results as CSV, with a header line.
+        :param rows:    (list) tuples of QUERY_COLUMNS values returned by MetricsStore.query
+        :param output:  (file or NoneType) file to write to, or None for standard out
+    """
+    output = output or sys.stdout
+    csv_writer = csv.writer(output)
+    csv_writer.writerow(QUERY_COLUMNS)
+    for row in rows:
+        csv_writer.writerow([format_value(value) for value in row])
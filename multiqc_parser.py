@@ -0,0 +1,144 @@
+"""
+Streaming, bounded-memory parser for MultiQC tables.
+
+MultiQC tables are read one line at a time and only the columns of interest are kept: the first column of each data
+row (the sample or lane name, used to identify negative controls and capture kits) and the value in the column of
+interest, stored in a compact array('d') buffer for numeric columns. Memory therefore grows with the number of rows
+times the number of columns needed, not with the size of the file. Large files can be read through a memory map.
+"""
+import contextlib
+import mmap
+import os
+from array import array
+
+# Lines in MultiQC files starting with these strings contain no data
+IDENTIFIER_TUPLE = ("#", "Sample", "CLUSTER_DENSITY")
+
+
+class ColumnData(object):
+    """
+    A class holding the data rows of one column of interest from a MultiQC table.
+
+    Attributes:
+        column_index    (int) index of the column of interest in the table
+        names           (list) first column of each data row (sample or lane name)
+        values          (array or list) value in the column of interest for each data row: floats in an array('d')
+                                        buffer for numeric columns, strings for text columns
+        bounds          (dict) cache of bounds calculated from the values (see TrendReport.calculate_bounds)
+    """
+
+    def __init__(self, column_index, numeric=True):
+        """
+        The constructor for ColumnData class
+        """
+        self.column_index = column_index
+        self.names = []
+        self.values = array('d') if numeric else []
+        self.bounds = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def append(self, name, value):
+        """
+        Add a data row.
+            :param name:    (str) first column of the row
+            :param value:   (str) value in the column of interest (converted to float for numeric columns)
+        """
+        self.names.append(name)
+        self.values.append(float(value) if isinstance(self.values, array) else value)
+
+
+class MmapLines(object):
+    """
+    A class reading lines from a memory-mapped file, with the readline/iteration interface of a file object (so the
+    header can be read with TrendReport.return_column_index).
+
+    Attributes:
+        mapped_file     (mmap) memory-mapped file
+    """
+
+    def __init__(self, mapped_file):
+        """
+        The constructor for MmapLines class
+        """
+        self.mapped_file = mapped_file
+
+    def readline(self):
+        line = self.mapped_file.readline()
+        return line if isinstance(line, str) else line.decode("utf-8")
+
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+
+
+@contextlib.contextmanager
+def open_multiqc_file(file_path, mmap_min_bytes=None):
+    """
+    Context manager opening a MultiQC file for line-by-line reading.
+        :param file_path:       (str) path to the MultiQC file
+        :param mmap_min_bytes:  (int or NoneType) files of at least this size are memory-mapped. None to never use mmap
+        :return:                (file or MmapLines) object supporting readline() and iteration over lines
+    """
+    with open(file_path, 'r') as input_file:
+        file_size = os.fstat(input_file.fileno()).st_size
+        if mmap_min_bytes is None or file_size == 0 or file_size < mmap_min_bytes:
+            yield input_file
+        else:
+            mapped_file = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield MmapLines(mapped_file)
+            finally:
+                mapped_file.close()
+
+
+def header_indexes(header_line, columns):
+    """
+    Return the index of each column of interest in a header line.
+        :param header_line: (str) header line of a MultiQC table
+        :param columns:     (iterable) columns of interest
+        :return:            (dict) column as key, index as value. Columns missing from the header are omitted
+    """
+    header = header_line.rstrip('\r\n').split("\t")
+    return dict((column, header.index(column)) for column in columns if column in header)
+
+
+def parse_columns(lines, column_indexes, text_columns=()):
+    """
+    Stream data lines, extracting the first column and each column of interest of every data row.
+        :param lines:           (iterable) lines of the table after the header (e.g. file object positioned after the
+                                           header)
+        :param column_indexes:  (dict) column of interest as key, column index as value
+        :param text_columns:    (iterable) columns holding text rather than numeric values
+        :return:                (dict) column as key, ColumnData as value
+
+    Blank lines and lines starting with IDENTIFIER_TUPLE elements contain no data and are skipped. Rows with no value
+    in a column of interest are not added to that column.
+    """
+    column_data = dict((column, ColumnData(column_index, numeric=column not in text_columns))
+                       for column, column_index in column_indexes.items())
+    for line in lines:
+        if line.isspace() or line.startswith(IDENTIFIER_TUPLE):
+            continue
+        fields = line.rstrip('\r\n').split("\t")
+        for column, column_index in column_indexes.items():
+            if column_index < len(fields) and fields[column_index]:
+                column_data[column].append(fields[0], fields[column_index])
+    return column_data
+
+
+def read_columns(file_path, columns, text_columns=(), mmap_min_bytes=None):
+    """
+    Read the columns of interest from a MultiQC file in a single streaming pass.
+        :param file_path:       (str) path to the MultiQC file
+        :param columns:         (iterable) columns of interest
+        :param text_columns:    (iterable) columns holding text rather than numeric values
+        :param mmap_min_bytes:  (int or NoneType) files of at least this size are memory-mapped
+        :return:                (dict) column as key, ColumnData as value. Columns missing from the header are omitted
+    """
+    with open_multiqc_file(file_path, mmap_min_bytes) as input_file:
+        column_indexes = header_indexes(input_file.readline(), columns)
+        return parse_columns(input_file, column_indexes, text_columns)
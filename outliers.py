@@ -0,0 +1,76 @@
+"""
+Per-sample outlier detection across the run history of a trend report.
+
+For each box plot tool, the values of all samples in the runs included in a report are grouped by sequencer, and a
+robust z-score (based on the median and median absolute deviation, so not skewed by the outliers themselves) is
+calculated for every sample in a single vectorised NumPy pass per group. Samples with an absolute robust z-score above
+the threshold in config are flagged.
+"""
+from collections import OrderedDict
+import numpy as np
+
+# Scales the median absolute deviation to the standard deviation of normally distributed data (Iglewicz and Hoaglin)
+MAD_SCALE = 0.6745
+
+
+def robust_z_scores(values):
+    """
+    Return the robust z-score of each value: MAD_SCALE * (value - median) / median absolute deviation.
+        :param values:  (array) values (NaN values are ignored, and have a NaN z-score)
+        :return:        (array) robust z-scores. All zero if the median absolute deviation is zero (at least half the
+                                values are identical, so no value can be said to be an outlier)
+    """
+    median = np.nanmedian(values)
+    mad = np.nanmedian(np.abs(values - median))
+    if not mad:
+        return np.zeros(len(values))
+    return MAD_SCALE * (values - median) / mad
+
+
+def run_sequencer(run):
+    """
+    Return the sequencer of a runfolder, parsed from the runfolder name.
+        :param run: (str) runfolder name (e.g. 001_200101_NB551068_0001_AHXXXXXXXX_WES1)
+        :return:    (str) sequencer (third field of the name), or the whole name if it has no third field
+    """
+    fields = run.split("_")
+    return fields[2] if len(fields) > 2 else run
+
+
+def find_outliers(tool, tool_dict, sample_names, threshold):
+    """
+    Flag samples whose value for a tool is an outlier among all samples from the same sequencer in the run history.
+        :param tool:            (str) Name of tool
+        :param tool_dict:       (OrderedDict) run as key, list of values as value (from parse_multiqc_output)
+        :param sample_names:    (dict) run as key, sample name of each value as value
+        :param threshold:       (float) absolute robust z-score above which a sample is an outlier
+        :return:                (list) OrderedDict per outlier (tool, run, sample, sequencer, value and z_score), in run
+                                       order
+    """
+    sequencer_runs = OrderedDict({})
+    for run, values in tool_dict.items():
+        if values:
+            sequencer_runs.setdefault(run_sequencer(run), []).append(run)
+    outliers = []
+    for sequencer, runs in sequencer_runs.items():
+        run_lengths = [len(tool_dict[run]) for run in runs]
+        values = np.concatenate([np.asarray(tool_dict[run], dtype=float) for run in runs])
+        z_scores = robust_z_scores(values)
+        with np.errstate(invalid="ignore"):
+            flagged = np.flatnonzero(np.abs(z_scores) > threshold)
+        if not len(flagged):
+            continue
+        # map each flagged position in the concatenated values back to its run and sample
+        run_indexes = np.repeat(np.arange(len(runs)), run_lengths)
+        run_offsets = np.cumsum([0] + run_lengths)
+        for position in flagged:
+            run = runs[run_indexes[position]]
+            names = sample_names.get(run, [])
+            row = position - run_offsets[run_indexes[position]]
+            outliers.append(OrderedDict([("tool", tool), ("run", run),
+                                         ("sample", names[row] if row < len(names) else ""),
+                                         ("sequencer", sequencer), ("value", float(values[position])),
+                                         ("z_score", float(z_scores[position]))]))
+    run_order = dict((run, index) for index, run in enumerate(tool_dict))
+    outliers.sort(key=lambda outlier: run_order[outlier["run"]])
+    return outliers
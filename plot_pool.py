@@ -0,0 +1,126 @@
+"""
+Reusable matplotlib figures for trend report plots.
+
+Building a figure is a large part of the cost of a plot: the figure, axes, axis, tick and formatter objects are created
+and configured again for every plot. A FigurePool keeps a small number of figures per plot type (box_plot,
+stacked_bar). A figure is configured once when it is created, and when a plot has been saved only its data artists
+(lines, patches, collections, texts) and legend are removed, so the next plot of that type starts from a blank but
+configured axes. Figures are created without pyplot (which holds every open figure until it is closed), so a figure is
+freed as soon as it is dropped from the pool. A figure whose plot raised an exception is dropped rather than reused.
+"""
+from __future__ import division
+import contextlib
+import threading
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import profiling
+
+
+def new_figure():
+    """
+    Create a figure with a single axes, configured for trend report plots (plain y axis tick labels, with no offset).
+        :return:    (tuple) Figure, Axes
+    """
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot(111)
+    axes.ticklabel_format(axis='y', useOffset=False, style='plain')
+    return figure, axes
+
+
+def reset_axes(axes):
+    """
+    Remove the data artists and legend of a plot from an axes, and re-enable autoscaling of its data limits, leaving
+    the axes configured for the next plot.
+        :param axes:    (Axes) axes to reset
+    """
+    for artists in [axes.lines, axes.patches, axes.collections, axes.texts, axes.artists]:
+        for artist in list(artists):
+            artist.remove()
+    if axes.legend_ is not None:
+        axes.legend_.remove()
+        axes.legend_ = None
+    axes.relim()
+    axes.set_autoscale_on(True)
+
+
+def category_proportions(values_by_run):
+    """
+    Return the proportion of each run's values that fall into each category (e.g. True and False).
+        :param values_by_run:   (list) list of values per run
+        :return:                (tuple) categories (sorted array of the distinct values in all runs), array of
+                                        proportions with a row per category and a column per run (a run with no values
+                                        has a proportion of 0 in every category)
+    """
+    values_by_run = [np.asarray(values) for values in values_by_run]
+    categories = np.unique(np.concatenate(values_by_run))
+    proportions = np.zeros((len(categories), len(values_by_run)))
+    for column, values in enumerate(values_by_run):
+        if len(values):
+            counts = np.bincount(np.searchsorted(categories, values), minlength=len(categories))
+            proportions[:, column] = counts / len(values)
+    return categories, proportions
+
+
+class FigurePool(object):
+    """
+    A class holding figures for reuse, per plot type.
+
+    Attributes:
+        size            (int) maximum number of idle figures kept per plot type (0 creates a new figure for every plot)
+        figures         (dict) plot type as key, list of idle (Figure, Axes) as value
+        lock            (Lock) guards figures, as plots may be rendered on more than one thread
+    """
+
+    def __init__(self, size):
+        """
+        The constructor for FigurePool class
+        """
+        self.size = size
+        self.figures = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, plot_type):
+        """
+        Take an idle figure for a plot type from the pool, or create one if there is none.
+            :param plot_type:   (str) plot type (figures are only reused for plots of the same type)
+            :return:            (tuple) Figure, Axes
+        """
+        with self.lock:
+            if self.figures.get(plot_type):
+                profiling.run_log.increment("figures_reused")
+                return self.figures[plot_type].pop()
+        return new_figure()
+
+    def release(self, plot_type, figure, axes):
+        """
+        Reset a figure and return it to the pool, unless the pool for its plot type is full (when it is dropped).
+            :param plot_type:   (str) plot type the figure was used for
+            :param figure:      (Figure) figure returned by acquire
+            :param axes:        (Axes) axes returned by acquire
+        """
+        reset_axes(axes)
+        with self.lock:
+            idle_figures = self.figures.setdefault(plot_type, [])
+            if len(idle_figures) < self.size:
+                idle_figures.append((figure, axes))
+
+    @contextlib.contextmanager
+    def figure(self, plot_type):
+        """
+        Context manager lending a figure for a plot, returned to the pool when the plot is complete.
+            :param plot_type:   (str) plot type
+            :return:            (tuple) Figure, Axes
+        """
+        figure, axes = self.acquire(plot_type)
+        yield figure, axes
+        # not reached if the plot raised an exception, so a figure left part way through a plot is not reused
+        self.release(plot_type, figure, axes)
+
+    def clear(self):
+        """
+        Drop all idle figures, releasing their memory.
+        """
+        with self.lock:
+            self.figures.clear()
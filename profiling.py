@@ -0,0 +1,406 @@
+"""
+Lightweight per-stage instrumentation for read_qc_files.py.
+
+Stages of the pipeline are wrapped in timing spans (using the span context manager or the timed decorator). Each span
+records wall time, CPU time and bytes read, and inherits the run type and tool of the span it is nested within, so
+time and I/O can be attributed per run type and tool. Spans are written to a structured JSON run log at the end of
+each run. When profiling is enabled (--profile), a cProfile profiler is kept per stage and switched as spans are
+entered and exited, so each stage's .prof file contains only the time spent in that stage (excluding nested stages).
+A Chrome trace (chrome://tracing, or https://ui.perfetto.dev) of all spans is also written.
+
+When memory tracking is enabled (--memory-report), spans on the main thread also record the resident set size (RSS)
+at exit and how much the span raised the process's peak RSS, and (where tracemalloc supports resetting its peak,
+python 3.9+) the peak memory allocated by Python during the span, so peak memory can be attributed per run type and
+tool. The allocation sites holding the most memory at the end of the run are written to the run log.
+"""
+from __future__ import division
+import contextlib
+import cProfile
+import datetime
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import tracemalloc
+except ImportError:
+    # python 2: memory is tracked by RSS sampling only
+    tracemalloc = None
+
+
+def _cpu_time():
+    """
+    Return CPU time for the current thread where supported (python 3.7+), else CPU time for the process.
+        :return:    (float) CPU time in seconds
+    """
+    if hasattr(time, "thread_time"):
+        return time.thread_time()
+    process_times = os.times()
+    return process_times[0] + process_times[1]
+
+
+def rss_bytes():
+    """
+    Return the resident set size of the process (from /proc on Linux, else the peak resident set size).
+        :return:    (int) resident set size in bytes
+    """
+    try:
+        with open("/proc/self/statm") as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    """
+    Return the peak resident set size of the process.
+        :return:    (int) peak resident set size in bytes (0 if not supported on the platform)
+    """
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RunLog(object):
+    """
+    A class to record timing spans for each stage of a run, and write them to a JSON run log and profiling outputs.
+
+    Attributes:
+        started         (datetime) time the run log was created
+        spans           (list) completed spans, each an OrderedDict of stage, runtype, tool, start, wall, cpu,
+                               bytes_read and thread
+        counters        (OrderedDict) (counter name, run type) as key, count as value
+        profiling       (bool) True if a cProfile profiler is kept per stage
+        profilers       (dict) stage name as key, cProfile.Profile object as value
+        memory_tracking (bool) True if spans on the main thread record memory use
+    """
+
+    def __init__(self):
+        """
+        The constructor for RunLog class
+        """
+        self.started = datetime.datetime.now()
+        self._started_clock = time.time()
+        self.spans = []
+        self.counters = OrderedDict()
+        self.profiling = False
+        self.profilers = {}
+        self.memory_tracking = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        """
+        Return the stack of open spans for the current thread.
+            :return:    (list) open spans, innermost last
+        """
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def enable_profiling(self):
+        """
+        Keep a cProfile profiler per stage. Profilers are only switched on the main thread, as cProfile profiles the
+        thread it was enabled on.
+        """
+        self.profiling = True
+
+    def enable_memory_tracking(self):
+        """
+        Record memory use in spans on the main thread, starting tracemalloc if available.
+        """
+        self.memory_tracking = True
+        if tracemalloc is None or not hasattr(tracemalloc, "reset_peak"):
+            print("tracemalloc peak tracking is not supported by this python, memory is tracked by RSS only")
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _tracing_peaks(self):
+        """
+        Return whether the peak memory allocated during each span can be traced.
+            :return:    (bool) True if tracemalloc is tracing and supports resetting its peak
+        """
+        return tracemalloc is not None and hasattr(tracemalloc, "reset_peak") and tracemalloc.is_tracing()
+
+    def _enter_memory(self):
+        """
+        Start recording memory use for a span (main thread only).
+            :return:    (list or NoneType) peak RSS at entry, and peak allocated memory of the span so far (None if
+                                           not traced), or None if memory is not tracked
+        """
+        if not self.memory_tracking or threading.current_thread().name != "MainThread":
+            return None
+        if not hasattr(self._local, "memory_stack"):
+            self._local.memory_stack = []
+        memory_stack = self._local.memory_stack
+        memory = [peak_rss_bytes(), None]
+        if self._tracing_peaks():
+            current, peak = tracemalloc.get_traced_memory()
+            # the peak so far belongs to the enclosing span, as the peak is reset for this span
+            if memory_stack and memory_stack[-1][1] is not None:
+                memory_stack[-1][1] = max(memory_stack[-1][1], peak)
+            tracemalloc.reset_peak()
+            memory[1] = current
+        memory_stack.append(memory)
+        return memory
+
+    def _exit_memory(self, record, memory):
+        """
+        Record memory use of a span in its record.
+            :param record:  (OrderedDict) the span record
+            :param memory:  (list) returned by _enter_memory
+        """
+        memory_stack = self._local.memory_stack
+        memory_stack.pop()
+        record["rss"] = rss_bytes()
+        record["rss_peak_increase"] = peak_rss_bytes() - memory[0]
+        if memory[1] is not None and self._tracing_peaks():
+            record["traced_peak"] = max(memory[1], tracemalloc.get_traced_memory()[1])
+            if memory_stack and memory_stack[-1][1] is not None:
+                memory_stack[-1][1] = max(memory_stack[-1][1], record["traced_peak"])
+            tracemalloc.reset_peak()
+
+    def _switch_profiler(self, disable_stage, enable_stage):
+        """
+        Disable the profiler of one stage and enable the profiler of another (either may be None).
+            :param disable_stage:   (str or NoneType) stage whose profiler is disabled
+            :param enable_stage:    (str or NoneType) stage whose profiler is enabled
+        """
+        if not self.profiling or threading.current_thread().name != "MainThread":
+            return
+        if disable_stage in self.profilers:
+            self.profilers[disable_stage].disable()
+        if enable_stage is not None:
+            self.profilers.setdefault(enable_stage, cProfile.Profile()).enable()
+
+    @contextlib.contextmanager
+    def span(self, stage, runtype=None, tool=None):
+        """
+        Context manager recording a timing span for a stage.
+            :param stage:       (str) name of the stage (e.g. sorted_runs)
+            :param runtype:     (str) run type the work is for. Inherited from the enclosing span if not supplied
+            :param tool:        (str) tool the work is for. Inherited from the enclosing span if not supplied
+            :return:            (OrderedDict) the span record, which can be updated by the caller
+        """
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        record = OrderedDict([("stage", stage),
+                              ("runtype", runtype or (parent["runtype"] if parent else None)),
+                              ("tool", tool or (parent["tool"] if parent else None)),
+                              ("start", round(time.time() - self._started_clock, 6)),
+                              ("wall", 0.0),
+                              ("cpu", 0.0),
+                              ("bytes_read", 0),
+                              ("thread", threading.current_thread().name)])
+        stack.append(record)
+        self._switch_profiler(parent["stage"] if parent else None, stage)
+        memory = self._enter_memory()
+        wall_start = time.time()
+        cpu_start = _cpu_time()
+        try:
+            yield record
+        finally:
+            record["wall"] = round(time.time() - wall_start, 6)
+            record["cpu"] = round(_cpu_time() - cpu_start, 6)
+            if memory is not None:
+                self._exit_memory(record, memory)
+            stack.pop()
+            self._switch_profiler(stage, parent["stage"] if parent else None)
+            with self._lock:
+                self.spans.append(record)
+
+    def add_bytes(self, number_of_bytes):
+        """
+        Add bytes read to the innermost open span of the current thread.
+            :param number_of_bytes:     (int) number of bytes read
+        """
+        stack = self._stack()
+        if stack:
+            stack[-1]["bytes_read"] += number_of_bytes
+
+    def increment(self, name, value=1, runtype=None):
+        """
+        Increment a counter (e.g. plots_rendered), per run type.
+            :param name:        (str) counter name
+            :param value:       (int) amount to increment by
+            :param runtype:     (str) run type the count is for. Taken from the innermost open span if not supplied
+        """
+        stack = self._stack()
+        if runtype is None and stack:
+            runtype = stack[-1]["runtype"]
+        with self._lock:
+            self.counters[(name, runtype)] = self.counters.get((name, runtype), 0) + value
+
+    def counter_totals(self):
+        """
+        Return counters as a nested dictionary, for the JSON run log.
+            :return:    (OrderedDict) counter name as key, dictionary of run type (or "all") as key and count as value
+        """
+        totals = OrderedDict()
+        for (name, runtype), value in self.counters.items():
+            totals.setdefault(name, OrderedDict())[runtype or "all"] = value
+        return totals
+
+    def summary(self):
+        """
+        Summarise recorded spans per stage, and per run type and tool.
+            :return:    (OrderedDict) "stages": stage as key, dictionary of count, wall, cpu and bytes_read as value.
+                                      "runtypes": run type as key, dictionary of tool: dictionary of wall, cpu and
+                                      bytes_read as value. Wall and CPU per tool are from "tool" spans; bytes read
+                                      is the total of all spans for the run type and tool. If memory is tracked,
+                                      "memory": run type as key, dictionary of tool (or "all") as key, and the
+                                      largest rss, rss_peak_increase and traced_peak of its spans as value
+        """
+        stages = OrderedDict()
+        runtypes = OrderedDict()
+        memory = OrderedDict()
+        with self._lock:
+            spans = list(self.spans)
+        for record in sorted(spans, key=lambda span: span["start"]):
+            stage = stages.setdefault(record["stage"], OrderedDict([("count", 0), ("wall", 0.0), ("cpu", 0.0),
+                                                                    ("bytes_read", 0)]))
+            stage["count"] += 1
+            stage["wall"] += record["wall"]
+            stage["cpu"] += record["cpu"]
+            stage["bytes_read"] += record["bytes_read"]
+            if record["runtype"] and record["tool"]:
+                tool = runtypes.setdefault(record["runtype"], OrderedDict()).setdefault(
+                    record["tool"], OrderedDict([("wall", 0.0), ("cpu", 0.0), ("bytes_read", 0)]))
+                if record["stage"] == "tool":
+                    tool["wall"] += record["wall"]
+                    tool["cpu"] += record["cpu"]
+                tool["bytes_read"] += record["bytes_read"]
+            if record["runtype"] and "rss" in record:
+                tool_memory = memory.setdefault(record["runtype"], OrderedDict()).setdefault(
+                    record["tool"] or "all", OrderedDict())
+                for measure in ["rss", "rss_peak_increase", "traced_peak"]:
+                    if measure in record:
+                        tool_memory[measure] = max(tool_memory.get(measure, 0), record[measure])
+        summary = OrderedDict([("stages", stages), ("runtypes", runtypes)])
+        if self.memory_tracking:
+            summary["memory"] = memory
+        return summary
+
+    def allocation_sites(self, limit=10):
+        """
+        Return the source lines holding the most memory allocated by Python (if tracemalloc is tracing).
+            :param limit:   (int) number of allocation sites to return
+            :return:        (list) OrderedDict of location, size (bytes) and count (allocations) per site, largest
+                                   first
+        """
+        if tracemalloc is None or not tracemalloc.is_tracing():
+            return []
+        return [OrderedDict([("location", "{}:{}".format(statistic.traceback[0].filename,
+                                                          statistic.traceback[0].lineno)),
+                             ("size", statistic.size), ("count", statistic.count)])
+                for statistic in tracemalloc.take_snapshot().statistics("lineno")[:limit]]
+
+    def memory_report(self):
+        """
+        Describe peak memory per run type and tool, and the allocation sites holding the most memory.
+            :return:    (str) memory report
+        """
+        lines = ["peak RSS {:.1f} MB".format(peak_rss_bytes() / 1e6)]
+        for runtype, tools in self.summary().get("memory", {}).items():
+            for tool, tool_memory in sorted(tools.items(), key=lambda item: -item[1].get("traced_peak",
+                                                                                            item[1]["rss"])):
+                lines.append("{} {}: RSS {:.1f} MB (peak raised {:.1f} MB){}".format(
+                    runtype, tool, tool_memory["rss"] / 1e6, tool_memory["rss_peak_increase"] / 1e6,
+                    ", allocated peak {:.1f} MB".format(tool_memory["traced_peak"] / 1e6)
+                    if "traced_peak" in tool_memory else ""))
+        for site in self.allocation_sites():
+            lines.append("{:.1f} MB in {} allocations at {}".format(site["size"] / 1e6, site["count"],
+                                                                      site["location"]))
+        return "\n".join(lines)
+
+    def write_json(self, path):
+        """
+        Write the structured run log (start time, duration, summary and all spans) as JSON.
+            :param path:    (str) path to the JSON run log
+        """
+        run_log = OrderedDict([("started", self.started.strftime('%Y-%m-%d %H:%M:%S')),
+                               ("duration", round(time.time() - self._started_clock, 6)),
+                               ("summary", self.summary()),
+                               ("counters", self.counter_totals()),
+                               ("spans", sorted(self.spans, key=lambda span: span["start"]))])
+        if self.memory_tracking:
+            run_log["peak_rss"] = peak_rss_bytes()
+            run_log["allocation_sites"] = self.allocation_sites()
+        with open(path, "w") as run_log_file:
+            json.dump(run_log, run_log_file, indent=1)
+
+    def write_chrome_trace(self, path):
+        """
+        Write all spans as a Chrome trace event file (complete "X" events, timestamps in microseconds).
+            :param path:    (str) path to the trace JSON file
+        """
+        thread_ids = {}
+        events = []
+        for record in sorted(self.spans, key=lambda span: span["start"]):
+            events.append({"name": record["stage"], "cat": record["runtype"] or "general", "ph": "X",
+                           "ts": int(record["start"] * 1e6), "dur": int(record["wall"] * 1e6), "pid": os.getpid(),
+                           "tid": thread_ids.setdefault(record["thread"], len(thread_ids) + 1),
+                           "args": {"tool": record["tool"], "cpu": record["cpu"],
+                                    "bytes_read": record["bytes_read"]}})
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+
+    def dump_profiles(self, profile_folder):
+        """
+        Write one .prof file per stage (readable with pstats or snakeviz).
+            :param profile_folder:  (str) folder to write <stage>.prof files to
+        """
+        for stage, profiler in self.profilers.items():
+            profiler.dump_stats(os.path.join(profile_folder, stage + ".prof"))
+
+    def write_outputs(self, run_log_folder, name=None):
+        """
+        Write the JSON run log, and if profiling is enabled, the per-stage .prof files and Chrome trace.
+            :param run_log_folder:  (str) folder to write run logs to
+            :param name:            (str or NoneType) name added after the run start time (e.g. of a worker job), so
+                                                      run logs started in the same second are kept apart
+            :return:                (str) path to the JSON run log
+
+        Outputs are named using the run start time. Profiling outputs are written to a <timestamp>_profile folder.
+        """
+        timestamp = self.started.strftime('%y%m%d_%H_%M_%S') + ("_" + name if name else "")
+        if not os.path.isdir(run_log_folder):
+            os.makedirs(run_log_folder)
+        run_log_path = os.path.join(run_log_folder, timestamp + "_run_log.json")
+        self.write_json(run_log_path)
+        if self.profiling:
+            profile_folder = os.path.join(run_log_folder, timestamp + "_profile")
+            if not os.path.isdir(profile_folder):
+                os.makedirs(profile_folder)
+            self.dump_profiles(profile_folder)
+            self.write_chrome_trace(os.path.join(profile_folder, "trace.json"))
+        return run_log_path
+
+
+# Run log shared by all stages of the current run
+run_log = RunLog()
+
+
+def timed(stage):
+    """
+    Decorator recording a timing span in run_log for each call of the decorated function.
+        :param stage:   (str) name of the stage
+        :return:        (function) decorator
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with run_log.span(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
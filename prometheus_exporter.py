@@ -0,0 +1,141 @@
+"""
+Prometheus textfile exporter for read_qc_files.py.
+
+Writes pipeline metrics (from the run log) and the latest QC medians in the Prometheus text exposition format, for the
+node_exporter textfile collector. QC medians are exported on every run: those of run types not reported by the run
+are the medians saved with their published trend report. The file is written atomically (see atomic_write.py), so the
+collector never reads a partially written file.
+"""
+from __future__ import division
+import json
+import os
+import time
+from collections import OrderedDict
+import atomic_write
+
+
+def escape_label(value):
+    """
+    Escape a label value for the Prometheus text format.
+        :param value:   (str) label value
+        :return:        (str) escaped label value
+    """
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_metric(name, labels, value):
+    """
+    Return a sample line in the Prometheus text format.
+        :param name:    (str) metric name
+        :param labels:  (list) (label name, label value) pairs
+        :param value:   (int or float) sample value
+        :return:        (str) sample line, e.g. trend_analysis_plots_rendered{runtype="WES"} 12.0
+    """
+    label_text = ",".join('{}="{}"'.format(label, escape_label(label_value)) for label, label_value in labels)
+    return "{}{} {}".format(name, "{" + label_text + "}" if label_text else "", repr(float(value)))
+
+
+def build_metrics(run_log, success, report_ages, tool_medians):
+    """
+    Build the text of the .prom file.
+        :param run_log:         (RunLog) run log of the current run (see profiling.py)
+        :param success:         (bool) True if the run completed without raising an exception
+        :param report_ages:     (dict) run type as key, seconds since the trend report html was last written as value
+        :param tool_medians:    (dict) run type as key, dictionary of tool: median of newest run as value
+        :return:                (str) metrics in the Prometheus text format
+
+    Counters recorded in the run log (e.g. runfolders_scanned, files_parsed, plots_rendered) are exported as
+    trend_analysis_<counter> with a runtype label ("all" for counts not specific to a run type).
+    """
+    lines = []
+
+    def add(name, metric_type, help_text, samples):
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+        for labels, value in samples:
+            lines.append(format_metric(name, labels, value))
+
+    summary = run_log.summary()
+    add("trend_analysis_last_run_timestamp_seconds", "gauge", "Time the last run finished", [([], time.time())])
+    add("trend_analysis_last_run_success", "gauge", "1 if the last run completed without error, else 0",
+        [([], 1 if success else 0)])
+    add("trend_analysis_stage_duration_seconds", "gauge", "Wall time spent in each stage during the last run",
+        [([("stage", stage)], totals["wall"]) for stage, totals in summary["stages"].items()])
+    add("trend_analysis_stage_cpu_seconds", "gauge", "CPU time spent in each stage during the last run",
+        [([("stage", stage)], totals["cpu"]) for stage, totals in summary["stages"].items()])
+    add("trend_analysis_stage_calls", "gauge", "Number of times each stage ran during the last run",
+        [([("stage", stage)], totals["count"]) for stage, totals in summary["stages"].items()])
+    add("trend_analysis_stage_bytes_read", "gauge", "Bytes read in each stage during the last run",
+        [([("stage", stage)], totals["bytes_read"]) for stage, totals in summary["stages"].items()])
+    for name, counts in run_log.counter_totals().items():
+        add("trend_analysis_{}".format(name), "gauge", "Count of {} during the last run".format(name),
+            [([("runtype", runtype)], value) for runtype, value in counts.items()])
+    add("trend_analysis_report_age_seconds", "gauge", "Seconds since each run type's trend report was last written",
+        [([("runtype", runtype)], age) for runtype, age in sorted(report_ages.items())])
+    add("trend_analysis_qc_median", "gauge", "Median value of each tool for the newest run in each trend report",
+        [([("runtype", runtype), ("tool", tool)], median) for runtype in sorted(tool_medians)
+         for tool, median in tool_medians[runtype].items()])
+    return "\n".join(lines) + "\n"
+
+
+def report_ages(output_folder, run_types):
+    """
+    Return the age of each run type's trend report html.
+        :param output_folder:   (str) path to the html trend reports
+        :param run_types:       (list) run types to report
+        :return:                (dict) run type as key, seconds since the report was last modified as value (run
+                                       types with no report are omitted)
+    """
+    ages = {}
+    for runtype in run_types:
+        report_path = os.path.join(output_folder, runtype + "_trend_report.html")
+        if os.path.isfile(report_path):
+            ages[runtype] = time.time() - os.path.getmtime(report_path)
+    return ages
+
+
+def medians_path(output_folder, runtype):
+    """
+    Return the path to the QC medians saved with a run type's published trend report.
+        :param output_folder:   (str) path to the html trend reports
+        :param runtype:         (str) run type of the report
+        :return:                (str) path to the JSON medians file
+    """
+    return os.path.join(output_folder, runtype + "_qc_medians.json")
+
+
+def published_medians(output_folder, run_types, tool_medians):
+    """
+    Return the QC medians of each run type: those of the current run, else those saved with the published report, so
+    the medians of run types not reported by a run are still exported.
+        :param output_folder:   (str) path to the html trend reports
+        :param run_types:       (list) run types to report
+        :param tool_medians:    (dict) run type as key, dictionary of tool: median of newest run as value, for the run
+                                       types reported by the current run
+        :return:                (dict) run type as key, dictionary of tool: median of newest run as value (run types
+                                       with no medians are omitted)
+    """
+    medians = dict(tool_medians)
+    for runtype in run_types:
+        if runtype not in medians:
+            try:
+                with open(medians_path(output_folder, runtype)) as medians_file:
+                    medians[runtype] = json.load(medians_file, object_pairs_hook=OrderedDict)
+            except (IOError, OSError, ValueError):
+                continue
+    return medians
+
+
+def write_textfile(path, run_log, success, output_folder, run_types, tool_medians):
+    """
+    Atomically write the .prom file for the node_exporter textfile collector.
+        :param path:            (str) path to the .prom file
+        :param run_log:         (RunLog) run log of the current run
+        :param success:         (bool) True if the run completed without raising an exception
+        :param output_folder:   (str) path to the html trend reports
+        :param run_types:       (list) run types to report the age and QC medians of
+        :param tool_medians:    (dict) run type as key, dictionary of tool: median of newest run as value, for the run
+                                       types reported by the current run (see published_medians)
+    """
+    atomic_write.write_atomic(path, build_metrics(run_log, success, report_ages(output_folder, run_types),
+                                                  published_medians(output_folder, run_types, tool_medians)))
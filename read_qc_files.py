@@ -17,13 +17,49 @@ import argparse
 from shutil import copyfile
 import smtplib
 from email.message import Message
-import pandas as pd
 import time
 import importlib
 import tempfile
 import numpy as np
 import glob
+import gc
 import requests
+import re
+import heapq
+import hashlib
+import json
+import profiling
+import prometheus_exporter
+import trend_export
+import metrics_store
+import outliers
+import run_lock
+import report_server
+import job_queue
+import archive_maintenance
+import multiqc_parser
+import input_roots
+import staged_publish
+import rebuild_requests
+import plot_pool
+import explain_plan
+import report_scheduler
+import storage
+import atomic_write
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+# Cache of runfolder name: (date, run types), populated by classify_run
+_run_classifications = {}
+# Classification of the most recent runfolder listing, populated by sorted_runs
+_classified_runs_cache = {}
+# Read plan of a backfill worker process, reused across the process's jobs so each MultiQC file is parsed once per
+# process rather than once per job
+_backfill_read_plan = None
+# Run types whose reports trigger emails (see Emails.send_email), built first (see report_scheduler.py)
+ALERTING_RUN_TYPES = ["WES", "CUSTOM_PANELS", "SWIFT"]
+# Figures reused across plots (see plot_pool.py), emptied by release_memory
+_figure_pool = plot_pool.FigurePool(config.general_config["general"]["figure_pool_size"])
+
 
 def arg_parse():
     """
@@ -34,9 +70,48 @@ def arg_parse():
     created argument parser.
     """
     parser = argparse.ArgumentParser()
+    parser.add_argument('command', nargs='?', choices=['report', 'query', 'backfill', 'serve', 'archive', 'ingest'],
+                        default='report',
+                        help="report (default): generate trend reports and send emails. query: print QC measurements "
+                             "recorded in the metrics store, filtered using the query arguments. backfill: regenerate "
+                             "trend reports as of each run date between --since and --until (or as of --until only) "
+                             "in config.backfill_folder. serve: run an HTTP server rendering trend reports on demand. "
+                             "archive: hard link duplicate archived report PDFs and roll older PDFs into monthly "
+                             "bundles. "
+                             "ingest: record a finished runfolder's QC measurements in the metrics store and rebuild "
+                             "only the reports of its run types")
+    parser.add_argument('runfolder', nargs='?', help="path to the finished runfolder (ingest only)")
     parser.add_argument('-d', '--dev', action='store_true', help="uses development output file locations (ensures live"
                                                                  "reports aren't overwritten during development and "
                                                                  "testing)")
+    parser.add_argument('--force', action='store_true', help="regenerate and republish all trend reports, even if the "
+                                                             "index file has not been updated or a report's content "
+                                                             "is unchanged")
+    parser.add_argument('--profile', action='store_true', help="wraps the run in cProfile, writing per-stage .prof "
+                                                               "files and a Chrome trace timeline alongside the run "
+                                                               "log")
+    parser.add_argument('--memory-report', action='store_true', help="trace memory use (tracemalloc and RSS), "
+                                                                     "printing peak memory per run type and tool "
+                                                                     "and recording it in the run log")
+    parser.add_argument('--explain', action='store_true', help="dry run: print the plan of a report run (run types "
+                                                               "to rebuild, runs per report, files to read, plots to "
+                                                               "render or skip, PDFs and emails) with costs estimated "
+                                                               "from recent run logs, and write it as JSON alongside "
+                                                               "the run logs, without running it (report only)")
+    parser.add_argument('--worker', action='store_true', help="run as a worker in distributed mode, claiming and "
+                                                              "running report and PDF jobs from config.queue_folder "
+                                                              "until interrupted")
+    query_args = parser.add_argument_group("query and backfill arguments")
+    query_args.add_argument('--runtype', help="run type, e.g. WES")
+    query_args.add_argument('--sequencer', help="sequencer, e.g. A01229 (query only)")
+    query_args.add_argument('--tool', help="tool, e.g. contamination (query only)")
+    query_args.add_argument('--since', help="earliest run date (YYYY-MM-DD)")
+    query_args.add_argument('--until', help="latest run date (YYYY-MM-DD). Backfill defaults to today")
+    query_args.add_argument('--sample', help="sample name pattern, with shell-style wildcards, e.g. '*NTCcon*' (query "
+                                             "only)")
+    query_args.add_argument('--format', choices=['table', 'csv'], default='table', help="output format (query only)")
+    serve_args = parser.add_argument_group("serve arguments")
+    serve_args.add_argument('--port', type=int, help="port to listen on (default config.serve_port)")
     return parser.parse_args()
 
 
@@ -59,6 +134,7 @@ def get_inputs(args):
     return inputs
 
 
+@profiling.timed("get_panel_dict")
 def get_panel_dict(github_repo, github_file, kit_list):
     """
     Returns a dictionary of vcp panel lists from the automated demultiplexing config file.
@@ -72,6 +148,7 @@ def get_panel_dict(github_repo, github_file, kit_list):
     """
     panel_dict = OrderedDict({})
     get_github_file(github_repo, github_file)
+    profiling.run_log.add_bytes(os.path.getsize(os.path.join(os.getcwd(), github_file)))
     with open(os.getcwd() + "/" + github_file, 'r') as github_file:
         for line in github_file:
             for panel_list in kit_list:
@@ -81,6 +158,7 @@ def get_panel_dict(github_repo, github_file, kit_list):
     return panel_dict
 
 
+@profiling.timed("get_github_file")
 def get_github_file(github_repo, github_file):
     """
     Clones a file from a github repository.
@@ -98,6 +176,176 @@ def get_github_file(github_repo, github_file):
     shutil.rmtree(tempdirpath)
 
 
+class ReadPlanner(object):
+    """
+    A class to read each MultiQC file once per tick, across all tools and run types.
+
+    Several tools read the same input_file (e.g. the q30_percent and cluster_density tools), and the same runfolders
+    are included in several run types (e.g. WES and NEXTSEQ_MARIO), so the per-tool loops in TrendReport would open and
+    parse the same file many times. Before any report is built, the planner works out every (runfolder, input_file)
+    pair any tool/run type needs and the columns of interest required from each, reads each file once and extracts
+    every required column into compact column buffers (see multiqc_parser). The planned data is then shared with each
+    TrendReport.
+
+    input_folder is on network storage, where every directory listing and file read is a round trip, so runfolder
+    listings and file reads are run concurrently in a bounded thread pool. Each file read is submitted as soon as its
+    runfolder has been listed, and TrendReport only waits for the files it needs as it reaches them, so earlier run
+    types are built while files for later run types are still being read.
+
+    Attributes:
+        input_folder    (str or list) path to MultiQC data per run, or list of paths (see input_roots.py)
+        mmap_min_bytes  (int or NoneType) files of at least this size are memory-mapped when read
+        pool            (ThreadPoolExecutor) thread pool for runfolder listings and file reads
+        runfolders      (OrderedDict) run inventory of the plans built: run as key, path to runfolder as value
+        needed          (OrderedDict) run as key, dictionary of input_file: (set of columns of interest, set of text
+                                      columns) required from the run as value
+        listings        (dict) run as key, future of the runfolder's file paths (in os.walk order) as value
+        file_paths      (dict) (run, input_file) as key, path to file (or False if not present) as value
+        plan            (OrderedDict) file path as key, set of columns of interest required from the file as value
+        requests        (int) number of file reads the per-tool loops would make without the planner
+        reads           (dict) file path as key, future of dictionary of column: ColumnData as value
+    """
+
+    def __init__(self, input_folder, mmap_min_bytes=None, io_concurrency=1):
+        """
+        The constructor for ReadPlanner class
+        """
+        self.input_folder = input_folder
+        self.mmap_min_bytes = mmap_min_bytes
+        self.pool = ThreadPoolExecutor(max_workers=io_concurrency)
+        self.runfolders = OrderedDict({})
+        self.needed = OrderedDict({})
+        self.listings = {}
+        self.file_paths = {}
+        self.plan = OrderedDict({})
+        self.requests = 0
+        self.reads = {}
+
+    def file_path(self, run, input_file_name, run_folder):
+        """
+        Return the path to a MultiQC file in a runfolder, searching the runfolder only once per input file.
+            :param run:                 (str) runfolder name
+            :param input_file_name:     (str) MultiQC file name (from input_file in tool config)
+            :param run_folder:          (str) path to the runfolder
+            :return:                    (str or bool) path to file of interest if file exists, else False
+
+        Uses the prefetched runfolder listing if there is one, else searches the runfolder with find_file_path.
+        """
+        if (run, input_file_name) not in self.file_paths:
+            if run in self.listings:
+                matches = [path for path in self.listings[run].result()
+                           if input_file_name in os.path.basename(path)]
+                if not matches:
+                    print("no output named {} for run {}".format(input_file_name, run_folder))
+                self.file_paths[(run, input_file_name)] = matches[0] if matches else False
+            else:
+                self.file_paths[(run, input_file_name)] = find_file_path(input_file_name, run_folder)
+        return self.file_paths[(run, input_file_name)]
+
+    @profiling.timed("plan_reads")
+    def build_plan(self, run_types, plot_order, as_of=None, number_of_runs=None, runfolders=None):
+        """
+        Build the plan of runfolders and columns of interest to read, and start listing the runfolders.
+            :param run_types:       (list) run types to be reported
+            :param plot_order:      (list) tools included in the reports
+            :param as_of:           (int or NoneType) cutoff date (YYMMDD) of the reports (see sorted_runs)
+            :param number_of_runs:  (int or NoneType) number of most recent runs in the reports (see sorted_runs)
+            :param runfolders:      (OrderedDict or NoneType) run as key, path to runfolder as value, to plan reads
+                                                              from these runfolders only (see ingest_run). None to scan
+                                                              the input roots
+
+        For each run type and parse_multiqc_output tool applicable to it, record the tool's input_file and column of
+        interest as needed from each runfolder (from the correct sequencer). Listings of all needed runfolders are then
+        submitted to the thread pool.
+        """
+        if runfolders is None:
+            runfolders = input_roots.scan_runfolders(self.input_folder)
+        self.runfolders.update(runfolders)
+        run_list = list(runfolders)
+        for runtype in run_types:
+            for tool in plot_order:
+                if config.tool_settings[tool]["report_type"].get(runtype) and \
+                        config.tool_settings[tool]["function"] == "parse_multiqc_output":
+                    sequencers = config.tool_settings[tool]["report_type"][runtype].split(', ')
+                    for run in sorted_runs(run_list, runtype, as_of, number_of_runs):
+                        if any(sequencer in run for sequencer in sequencers):
+                            self.requests += 1
+                            columns, text = self.needed.setdefault(run, OrderedDict({})).setdefault(
+                                config.tool_settings[tool]["input_file"], (set(), set()))
+                            columns.add(config.tool_settings[tool]["column_of_interest"])
+                            text.update(text_columns(tool))
+        for run in self.needed:
+            if run not in self.listings:
+                self.listings[run] = self.pool.submit(list_runfolder, self.runfolders[run])
+
+    @profiling.timed("execute_read_plan")
+    def execute(self):
+        """
+        Submit a read of each needed file to the thread pool as soon as its runfolder has been listed, streaming every
+        column of interest required from it into column buffers. Returns once all reads are submitted (reads complete
+        in the background; see column_data).
+        """
+        runs = dict((self.listings[run], run) for run in self.needed)
+        for listing in as_completed(runs):
+            run = runs[listing]
+            for input_file_name, (columns, text) in self.needed[run].items():
+                file_path = self.file_path(run, input_file_name, self.runfolders[run])
+                if file_path:
+                    self.plan.setdefault(file_path, set()).update(columns)
+                    if file_path not in self.reads:
+                        self.reads[file_path] = self.pool.submit(self.read_file, file_path, columns, text)
+
+    def read_file(self, file_path, columns, text):
+        """
+        Read the columns of interest from a MultiQC file (run in the thread pool).
+            :param file_path:   (str) path to MultiQC file
+            :param columns:     (set) columns of interest
+            :param text:        (set) columns holding text rather than numeric values
+            :return:            (dict) column as key, ColumnData as value
+        """
+        with profiling.run_log.span("read_multiqc_file"):
+            profiling.run_log.add_bytes(storage.getsize(file_path))
+            profiling.run_log.increment("files_parsed")
+            return multiqc_parser.read_columns(storage.local_path(file_path), columns, text, self.mmap_min_bytes)
+
+    def column_data(self, file_path, column):
+        """
+        Return planned data for a column of interest in a file, waiting for the file's read to complete if necessary.
+            :param file_path:   (str) path to MultiQC file
+            :param column:      (str) column of interest
+            :return:            (ColumnData or NoneType) data rows of the column, or None if not planned. Columns
+                                                         missing from a file's header are not stored, so TrendReport
+                                                         falls back to reading the file itself (and reports the missing
+                                                         column as before)
+        """
+        if file_path not in self.reads:
+            return None
+        return self.reads[file_path].result().get(column)
+
+    def release(self):
+        """
+        Drop the data of completed file reads and the plan of needed files, to free memory. Files needed by a later
+        report are read directly by TrendReport, or re-read if planned again.
+        """
+        for file_path in [file_path for file_path, read in self.reads.items() if read.done()]:
+            del self.reads[file_path]
+        self.needed = OrderedDict({})
+
+    def close(self):
+        """
+        Shut down the thread pool.
+        """
+        self.pool.shutdown(wait=True)
+
+    def report(self):
+        """
+        Describe how many file reads the plan saved.
+            :return:    (str) summary of planned reads
+        """
+        return "read plan: {} files read for {} tool/run type file requests ({} reads saved)".format(
+            len(self.plan), self.requests, self.requests - len(self.plan))
+
+
 class TrendReport(object):
     """
     A class to create a trend report. A html trend report is generated for each runtype specified in config.py
@@ -107,7 +355,7 @@ class TrendReport(object):
         plots_html        (list) list for which plot html is appended to, to be added to final generated trend report
         runtype           (str) run type from list of run_types defined in config
         panel_dict        (OrderedDict) populated with lists of panels that use each type of capture kit
-        input_folder      (str) path to MultiQC data per run
+        input_folder      (str or list) path to MultiQC data per run, or list of paths (see input_roots.py)
         output_folder     (str) path to save location for html trend reports and archive_index.html
         images_folder     (str) path to viapath logo images and saved plots
         template_dir      (str) path to html templates
@@ -115,10 +363,30 @@ class TrendReport(object):
         logopath          (str) path to viapath logo
         plot_order        (str) Order of plots in report (top to bottom). Only plots in this list are included
         wkhtmltopdf_path  (str) Path to html conversion utility
+        read_plan         (ReadPlanner or NoneType) MultiQC data read once for all run types, or None to read files
+                                                    directly
+        tool_medians      (OrderedDict) tool as key, median value of the newest run with data as value (box plots only)
+        data_digests      (OrderedDict) tool as key, digest of the parsed data as value (see report_fingerprint)
+        sample_names      (OrderedDict) tool as key, dictionary of run: sample (or lane) name of each measurement as
+                                        value (tools parsed from MultiQC outputs only)
+        metrics_store     (MetricsStore or NoneType) store the parsed measurements are recorded in, or None
+        as_of             (int or NoneType) cutoff date (YYMMDD) - the report is generated as it would have been on this
+                                            date (see sorted_runs). None for the current report
+        outliers          (list) outlier samples of box plot tools (see outliers.find_outliers)
+        number_of_runs    (int or NoneType) number of most recent runs to include, or None for number_of_runs_to_include
+                                            in config
+        archive           (bool) save a PDF of the report to archive_folder and update archive_index.html
+        published         (bool) True once the report has been republished (False if unchanged)
+        force             (bool) republish the report even if its fingerprint is unchanged
+        runfolders        (OrderedDict or NoneType) run inventory the report is built from (run as key, path to
+                                                    runfolder as value), or None until the input roots are scanned
+        stage             (ReportStage or NoneType) build folders the report is staged in while it is built for
+                                                    publishing (see staged_publish.py), else None
    """
 
     def __init__(self, runtype, panel_dict, input_folder, output_folder, images_folder, template_dir, archive_folder,
-                 logopath, plot_order, wkhtmltopdf_path):
+                 logopath, plot_order, wkhtmltopdf_path, read_plan=None, force=False, metrics_store=None,
+                 as_of=None, number_of_runs=None, archive=True):
         """
         The constructor for TrendReport class
         """
@@ -134,6 +402,19 @@ class TrendReport(object):
         self.logopath = logopath
         self.plot_order = plot_order
         self.wkhtmltopdf_path = wkhtmltopdf_path
+        self.read_plan = read_plan
+        self.tool_medians = OrderedDict({})
+        self.data_digests = OrderedDict({})
+        self.sample_names = OrderedDict({})
+        self.metrics_store = metrics_store
+        self.as_of = as_of
+        self.outliers = []
+        self.number_of_runs = number_of_runs
+        self.archive = archive
+        self.published = False
+        self.force = force
+        self.runfolders = None
+        self.stage = None
 
     def call_tools(self, methods):
         """
@@ -146,23 +427,249 @@ class TrendReport(object):
                     Return method object (parse data), add to tool dictionary (key = run name, values = values) (eg if
                     config.tool_settings[tool]["function"] == parse_multiqc_output, call parse_multiqc_output and return
                     dictionary)
-                    If dictionary populated (may not find expected input files for parsing), build plot for tool
-                    If plot constructed, create html module and append to self.plots_html (list of plots html for tool)
-        After looping through all tools, generate report and append to archived reports html
+                    Flag outlier samples (box plot tools)
+        Record the parsed measurements in the metrics store.
+        If the report fingerprint (included runs, data digests and template version) matches that of the published
+        report, the report is unchanged and is not republished or re-archived (unless self.force). Otherwise, the
+        report is built in build folders (see staged_publish.py): export the parsed data (see trend_export.py), then
+        for each tool:
+            If dictionary populated (may not find expected input files for parsing), build plot for tool
+            If plot constructed, create html module and append to self.plots_html (list of plots html for tool)
+            Release the tool's parsed data
+        If any samples were flagged as outliers, add a table of outliers to the top of the report.
+        After looping through all tools, generate report, then publish the staged plots, exports, QC medians, html and
+        fingerprint together. Archive the published report as pdf and append it to archived reports html, and remove
+        plots no longer used
+        """
+        self.parse_tools(methods)
+        self.store_data()
+        fingerprint = self.report_fingerprint()
+        if not self.force and fingerprint == self.published_fingerprint():
+            print("{} trend report unchanged, not republished".format(self.runtype))
+            profiling.run_log.increment("reports_unchanged")
+            return
+        self.stage = staged_publish.ReportStage(self.output_folder, self.images_folder, self.runtype)
+        try:
+            self.export_data()
+            for tool in self.dictionary:
+                with profiling.run_log.span("tool", runtype=self.runtype, tool=tool):
+                    if self.dictionary[tool]:
+                        self.build_plot(tool)
+                    else:
+                        profiling.run_log.increment("plots_skipped")
+                    if any(key in self.dictionary[tool] for key in ["table_text", "image_location"]):
+                        html_plot_module = self.populate_html_template(tool)
+                        self.plots_html.append(html_plot_module)
+                    self.release_tool_data(tool)
+            if self.outliers:
+                self.plots_html.insert(0, self.outlier_table())
+            with profiling.run_log.span("report", runtype=self.runtype):
+                self.generate_report()
+            self.write_medians()
+            self.write_fingerprint(fingerprint)
+            with profiling.run_log.span("publish", runtype=self.runtype):
+                keep_images = self.stage.publish(last=[os.path.basename(self.report_path()),
+                                                       os.path.basename(self.fingerprint_path())])
+        finally:
+            self.stage.discard()
+            self.stage = None
+        if self.archive:
+            with profiling.run_log.span("report", runtype=self.runtype):
+                self.archive_pdf()
+                self.generate_archive_html()
+        self.remove_unused_images(keep_images)
+        self.published = True
+
+    def parse_tools(self, methods):
+        """
+        Parse the data of each tool applicable to the run type, in plot order.
+            :param methods: (list) Members of the TrendReport class in a list of (name, value) pairs sorted by name
+
+        For each tool applicable to the run type, call the method named by function in the tool config to populate the
+        tool dictionary (key = run name, values = values), flag outlier samples (box plot tools) and record a digest of
+        the data for the report fingerprint.
         """
         for tool in self.plot_order:
             if config.tool_settings[tool]["report_type"][self.runtype]:
                 print('{} {}'.format(tool, self.runtype))
-                for name, obj in methods:
-                    if config.tool_settings[tool]["function"] in name:
-                        self.dictionary[tool] = obj(tool)
-                        if self.dictionary[tool]:
-                            self.build_plot(tool)
-                        if any(key in self.dictionary[tool] for key in ["table_text", "image_location"]):
-                            html_plot_module = self.populate_html_template(tool)
-                            self.plots_html.append(html_plot_module)
-        self.generate_report()
-        self.generate_archive_html()
+                with profiling.run_log.span("tool", runtype=self.runtype, tool=tool):
+                    for name, obj in methods:
+                        if config.tool_settings[tool]["function"] in name:
+                            self.dictionary[tool] = obj(tool)
+                            self.record_median(tool)
+                            self.detect_outliers(tool)
+                            self.record_digest(tool)
+
+    def plan_report(self, methods):
+        """
+        Return the plan of the report for an explain run (see explain_plan.py). The tools are parsed and the report
+        fingerprint compared with that of the published report, but no plot is built and nothing is published,
+        archived or recorded.
+            :param methods: (list) Members of the TrendReport class in a list of (name, value) pairs sorted by name
+            :return:        (OrderedDict) runtype, runs included, rebuild (bool) and the reason, plots to render (plot
+                                          type as key, list of tools as value), plots skipped (no data, or report
+                                          unchanged) and pdf (bool, a PDF would be archived)
+        """
+        self.parse_tools(methods)
+        published_fingerprint = self.published_fingerprint()
+        if self.force:
+            reason = "forced"
+        elif published_fingerprint is None:
+            reason = "not yet published"
+        elif self.report_fingerprint() != published_fingerprint:
+            reason = "content changed"
+        else:
+            reason = "unchanged"
+        rebuild = reason != "unchanged"
+        plots = OrderedDict({})
+        plots_skipped = []
+        for tool in self.dictionary:
+            plot_type = config.tool_settings[tool]["plot_type"]
+            if plot_type in ["box_plot", "stacked_bar"]:
+                if rebuild and self.dictionary[tool]:
+                    plots.setdefault(plot_type, []).append(tool)
+                else:
+                    plots_skipped.append(tool)
+        return OrderedDict([("runtype", self.runtype),
+                            ("runs", sorted_runs(list(self.scan_runfolders()), self.runtype, self.as_of,
+                                                 self.number_of_runs)),
+                            ("rebuild", rebuild), ("reason", reason), ("plots", plots),
+                            ("plots_skipped", plots_skipped), ("pdf", rebuild and self.archive)])
+
+    def release_tool_data(self, tool):
+        """
+        Release the parsed data of a tool once its html module has been built. Only the image location is kept (used
+        by remove_unused_images).
+            :param tool: (str) Name of tool (allows access to tool-specific config settings in tool_settings dictionary)
+        """
+        self.dictionary[tool] = OrderedDict([(key, value) for key, value in self.dictionary[tool].items()
+                                             if key == "image_location"])
+        self.sample_names.pop(tool, None)
+
+    def record_median(self, tool):
+        """
+        Record the median value of the newest run with data for box plot tools, for export as a QC trend metric.
+            :param tool: (str) Name of tool (allows access to tool-specific config settings in tool_settings dictionary)
+        """
+        if config.tool_settings[tool]["plot_type"] == "box_plot":
+            runs_with_data = [values for values in self.dictionary[tool].values() if values]
+            if runs_with_data:
+                self.tool_medians[tool] = float(np.median(runs_with_data[-1]))
+
+    @profiling.timed("detect_outliers")
+    def detect_outliers(self, tool):
+        """
+        Flag outlier samples for box plot tools, by robust z-score per sequencer across the runs in the report.
+            :param tool: (str) Name of tool (allows access to tool-specific config settings in tool_settings dictionary)
+        """
+        if config.tool_settings[tool]["plot_type"] == "box_plot":
+            tool_outliers = outliers.find_outliers(tool, self.dictionary[tool], self.sample_names.get(tool, {}),
+                                                   config.general_config["general"]["outlier_z_threshold"])
+            self.outliers.extend(tool_outliers)
+            profiling.run_log.increment("outliers_flagged", len(tool_outliers), runtype=self.runtype)
+
+    def outlier_table(self):
+        """
+        Build html module listing outlier samples, using the outlier template in config.
+            :return:    (str) populated html template
+        """
+        table_row_html = "<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{:.4g}</td><td>{:.2f}</td></tr>"
+        rows_html = "".join(table_row_html.format(config.tool_settings[outlier["tool"]]["plot_title"], outlier["run"],
+                                                  outlier["sample"], outlier["sequencer"], outlier["value"],
+                                                  outlier["z_score"]) for outlier in self.outliers)
+        return config.outlier_template.format(config.general_config["general"]["outlier_z_threshold"], rows_html)
+
+    def record_digest(self, tool):
+        """
+        Record a digest of the parsed data for a tool and the tool's settings (which include the plot limits), for the
+        report fingerprint.
+            :param tool: (str) Name of tool (allows access to tool-specific config settings in tool_settings dictionary)
+        """
+        threshold = config.general_config["general"]["outlier_z_threshold"]
+        tool_data = json.dumps([self.dictionary[tool], config.tool_settings[tool], threshold], sort_keys=True)
+        self.data_digests[tool] = hashlib.sha1(tool_data.encode("utf-8")).hexdigest()
+
+    def scan_runfolders(self):
+        """
+        Return the run inventory the report is built from, scanning the input roots the first time it is needed, so
+        every tool in the report is built from the same runfolders.
+            :return:    (OrderedDict) run as key, path to runfolder as value (see input_roots.scan_runfolders)
+        """
+        if self.runfolders is None:
+            self.runfolders = input_roots.scan_runfolders(self.input_folder)
+        return self.runfolders
+
+    def report_fingerprint(self):
+        """
+        Return the report fingerprint, identifying the content of the report.
+            :return:    (str) SHA-1 digest of the run type, included runs, data digest of each tool and template version
+        """
+        fingerprint = hashlib.sha1()
+        for item in [self.runtype, template_version(self.template_dir)] + \
+                sorted_runs(list(self.scan_runfolders()), self.runtype, self.as_of, self.number_of_runs) + \
+                ["{}:{}".format(tool, digest) for tool, digest in self.data_digests.items()]:
+            fingerprint.update(item.encode("utf-8") + b"\n")
+        return fingerprint.hexdigest()
+
+    @profiling.timed("store_data")
+    def store_data(self):
+        """
+        Record the parsed measurements in the metrics store (if supplied), for the query command.
+        """
+        if self.metrics_store:
+            self.metrics_store.record(trend_export.export_rows(self.runtype, self.dictionary, self.sample_names))
+
+    @profiling.timed("export_data")
+    def export_data(self):
+        """
+        Export the parsed data (run, sample, tool, value and limits) as CSV and JSON-lines (and Parquet if
+        export_parquet in config) alongside the report html.
+        """
+        trend_export.write_exports(self.stage.build_folder if self.stage else self.output_folder, self.runtype,
+                                   trend_export.export_rows(self.runtype, self.dictionary, self.sample_names),
+                                   config.general_config["general"]["export_parquet"])
+
+    def staged(self, path):
+        """
+        Return the path to build an output file at.
+            :param path:    (str) path to the published file in output_folder
+            :return:        (str) path in the build folder while the report is staged (see staged_publish.py), else path
+        """
+        return self.stage.path(os.path.basename(path)) if self.stage else path
+
+    def fingerprint_path(self):
+        """
+        Return the path to the fingerprint of the published report (saved alongside the report html).
+            :return:    (str) path to the fingerprint file
+        """
+        return os.path.join(self.output_folder, self.runtype + "_trend_report.fingerprint")
+
+    def published_fingerprint(self):
+        """
+        Return the fingerprint of the published report.
+            :return:    (str or NoneType) fingerprint, or None if the report html or fingerprint file is missing
+        """
+        if not os.path.isfile(os.path.join(self.output_folder, self.runtype + "_trend_report.html")) or \
+                not os.path.isfile(self.fingerprint_path()):
+            return None
+        with open(self.fingerprint_path(), "r") as fingerprint_file:
+            return fingerprint_file.read().strip()
+
+    def write_fingerprint(self, fingerprint):
+        """
+        Save the fingerprint of the published report.
+            :param fingerprint: (str) fingerprint returned by report_fingerprint
+        """
+        with open(self.staged(self.fingerprint_path()), "w") as fingerprint_file:
+            fingerprint_file.write(fingerprint + "\n")
+
+    def write_medians(self):
+        """
+        Save the QC medians of the report, published with it, so they are exported on runs that do not report the run
+        type (see prometheus_exporter.published_medians).
+        """
+        with open(self.staged(prometheus_exporter.medians_path(self.output_folder, self.runtype)), "w") as medians_file:
+            json.dump(self.tool_medians, medians_file)
 
     def build_plot(self, tool):
         """
@@ -173,14 +680,17 @@ class TrendReport(object):
         """
         if config.tool_settings[tool]["plot_type"] == "box_plot":
             self.box_plot(tool)
-            self.dictionary[tool]["image_location"] = self.return_image_paths(tool)[1]
+            self.dictionary[tool]["image_location"] = self.publish_image(tool)
+            profiling.run_log.increment("plots_rendered")
         elif config.tool_settings[tool]["plot_type"] == "stacked_bar":
             self.stacked_bar(tool)
-            self.dictionary[tool]["image_location"] = self.return_image_paths(tool)[1]
+            self.dictionary[tool]["image_location"] = self.publish_image(tool)
+            profiling.run_log.increment("plots_rendered")
         elif config.tool_settings[tool]["plot_type"] == "table":
             # table function returns the table html
             self.dictionary[tool]["table_text"] = self.table(tool)
 
+    @profiling.timed("box_plot")
     def box_plot(self, tool):
         """
         Build box plot from dictionary input. Save image to location defined in config.
@@ -189,49 +699,54 @@ class TrendReport(object):
 
         Plot data from tool dictionary (key = run name, values = values), using labels generated by self.x_labels. Add
         horizontal lines to define cutoffs if specified in config, and labels to legends. Generate image path and save
-        figure at this location.
-        """
-        plt.close()
-        plt.boxplot(self.dictionary[tool].values(), labels=self.x_labels(tool))
-        xmin, xmax, ymin, ymax = plt.axis()
-        if config.tool_settings[tool]["upper_lim"]:
-            plt.hlines(config.tool_settings[tool]["upper_lim"], xmin, xmax,
-                       label=config.tool_settings[tool]["upper_lim_label"],
-                       linestyles=config.tool_settings[tool]["upper_lim_linestyle"],
-                       colors=config.tool_settings[tool]["upper_lim_linecolour"])
-        if config.tool_settings[tool]["lower_lim"]:
-            plt.hlines(config.tool_settings[tool]["lower_lim"], xmin, xmax,
-                       label=config.tool_settings[tool]["lower_lim_label"],
-                       linestyles=config.tool_settings[tool]["lower_lim_linestyle"],
-                       colors=config.tool_settings[tool]["lower_lim_linecolour"])
-        if (config.tool_settings[tool]["lower_lim_label"] is not False) or (
-                config.tool_settings[tool]["upper_lim_label"] is not False):
-            plt.legend(bbox_to_anchor=(1.05, 1.0), loc='upper left')
-        plt.xticks()
-        plt.ticklabel_format(axis='y', useOffset=False, style='plain')
-        image_path, _ = self.return_image_paths(tool)
-        plt.savefig(image_path, bbox_inches="tight", dpi=200)
-
+        figure at this location. The figure is taken from the figure pool, and returned to it once saved (see
+        plot_pool.py).
+        """
+        with _figure_pool.figure("box_plot") as (figure, axes):
+            axes.boxplot(list(self.dictionary[tool].values()), labels=self.x_labels(tool))
+            xmin, xmax, ymin, ymax = axes.axis()
+            if config.tool_settings[tool]["upper_lim"]:
+                axes.hlines(config.tool_settings[tool]["upper_lim"], xmin, xmax,
+                            label=config.tool_settings[tool]["upper_lim_label"],
+                            linestyles=config.tool_settings[tool]["upper_lim_linestyle"],
+                            colors=config.tool_settings[tool]["upper_lim_linecolour"])
+            if config.tool_settings[tool]["lower_lim"]:
+                axes.hlines(config.tool_settings[tool]["lower_lim"], xmin, xmax,
+                            label=config.tool_settings[tool]["lower_lim_label"],
+                            linestyles=config.tool_settings[tool]["lower_lim_linestyle"],
+                            colors=config.tool_settings[tool]["lower_lim_linecolour"])
+            if (config.tool_settings[tool]["lower_lim_label"] is not False) or (
+                    config.tool_settings[tool]["upper_lim_label"] is not False):
+                axes.legend(bbox_to_anchor=(1.05, 1.0), loc='upper left')
+            image_path, _ = self.return_image_paths(tool)
+            figure.savefig(image_path, bbox_inches="tight", dpi=200)
+
+    @profiling.timed("stacked_bar")
     def stacked_bar(self, tool):
         """
         Build stacked bar chart from dictionary input. Save image to location defined in config.
             :param tool:    (str) Name of tool to be plotted (allows access to tool-specific config settings in
                                   tool_settings dictionary)
 
-        Convert tool dictionary (key = run name, values = values) to pandas dataframe with counts of true and false
-        values for each run. Plot as stacked bar chart (x labels generated by self.x_labels). Generate image path and
-        save figure at this location.
-        """
-        plt.close()
-        df = pd.DataFrame.from_dict(self.dictionary[tool],
-                                    orient='index').apply(lambda x: pd.value_counts(x, normalize=True), axis=1).T
-        df.columns = self.x_labels(tool)
-        df.T.plot.bar(stacked=True)
-        plt.xticks()
-        plt.legend(bbox_to_anchor=(1.05, 1.0), loc='upper left')
-        plt.ticklabel_format(axis='y', useOffset=False, style='plain')
-        image_path, _ = self.return_image_paths(tool)
-        plt.savefig(image_path, bbox_inches="tight", dpi=200)
+        Count the proportion of true and false values (or other categories) for each run in tool dictionary (key = run
+        name, values = values) with NumPy. Plot as stacked bar chart, a bar segment per category (x labels generated by
+        self.x_labels). Generate image path and save figure at this location. The figure is taken from the figure
+        pool, and returned to it once saved (see plot_pool.py).
+        """
+        categories, proportions = plot_pool.category_proportions(list(self.dictionary[tool].values()))
+        positions = np.arange(proportions.shape[1])
+        with _figure_pool.figure("stacked_bar") as (figure, axes):
+            bottom = np.zeros(len(positions))
+            for index, category in enumerate(categories):
+                axes.bar(positions, proportions[index], 0.5, bottom=bottom, label=str(category),
+                         color="C{}".format(index % 10))
+                bottom = bottom + proportions[index]
+            axes.set_xlim(-0.5, len(positions) - 0.5)
+            axes.set_xticks(positions)
+            axes.set_xticklabels(self.x_labels(tool), rotation=90)
+            axes.legend(bbox_to_anchor=(1.05, 1.0), loc='upper left')
+            image_path, _ = self.return_image_paths(tool)
+            figure.savefig(image_path, bbox_inches="tight", dpi=200)
 
     def x_labels(self, tool):
         """
@@ -250,18 +765,54 @@ class TrendReport(object):
                 xlabels.append(str(value))
         return xlabels
 
-    def return_image_paths(self, tool):
+    def return_image_paths(self, tool, digest=None):
         """
         Return image paths using values defined in config: images_folder, runtype (e.g. WES), and tool name.
             :param tool:                (str) Name of tool to be plotted (allows access to tool-specific config settings
                                               in tool_settings dictionary)
+            :param digest:              (str or NoneType) content hash of the published image, or None for the path
+                                                          the plot is saved to before publishing
             :return html_image_path:    (str) relative image path for use in html
-            :return image_path:         (str) path to the saved plot
+            :return image_path:         (str) path to the saved plot (in the images build folder while the report is
+                                              staged, see staged_publish.py)
         """
-        image_path = os.path.join(self.images_folder, self.runtype + "_" + tool + ".png")
-        html_image_path = "images/" + self.runtype + "_" + tool + ".png"
+        image_name = self.runtype + "_" + tool + ("." + digest if digest else "") + ".png"
+        image_path = self.stage.image_path(image_name) if self.stage else os.path.join(self.images_folder, image_name)
+        html_image_path = "images/" + image_name
         return image_path, html_image_path
 
+    def publish_image(self, tool):
+        """
+        Rename a saved plot to a content-hashed filename (e.g. images/WES_contamination.<digest>.png). An image name
+        therefore always refers to the same content, so can be cached by browsers and proxies as immutable (see
+        config.htaccess), and a changed plot is always fetched by its new name.
+            :param tool:    (str) Name of tool to be plotted (allows access to tool-specific config settings in
+                                  tool_settings dictionary)
+            :return:        (str) relative path of the published image for use in html
+        """
+        image_path, _ = self.return_image_paths(tool)
+        with open(image_path, "rb") as image_file:
+            digest = hashlib.sha1(image_file.read()).hexdigest()[:16]
+        published_path, html_image_path = self.return_image_paths(tool, digest)
+        os.rename(image_path, published_path)
+        return html_image_path
+
+    def remove_unused_images(self, keep=()):
+        """
+        Delete images of this run type not used by the published report: previous content hashes, plots of tools with
+        no data, and images saved under fixed names by earlier releases.
+            :param keep:    (set) names of other images not to delete (images of the previous report, which a reader may
+                                  still be loading, see staged_publish.ReportStage.publish)
+        """
+        used_images = set(self.dictionary[tool]["image_location"].rsplit("/", 1)[-1] for tool in self.dictionary
+                          if self.dictionary[tool] and self.dictionary[tool].get("image_location")) | set(keep)
+        image_pattern = re.compile(r"^{}_({})(\.[0-9a-f]{{16}})?\.png$".format(
+            re.escape(self.runtype), "|".join(re.escape(tool) for tool in config.tool_settings)))
+        for image_name in os.listdir(self.images_folder):
+            if image_pattern.match(image_name) and image_name not in used_images:
+                os.remove(os.path.join(self.images_folder, image_name))
+                profiling.run_log.increment("images_removed")
+
     def table(self, tool):
         """
         Build html table using template in config file and run names in tool dictionary.
@@ -289,9 +840,8 @@ class TrendReport(object):
             :return:        (html string) Populated html template
 
         Load html template from config (plot or table template), define html content.
-        If html content is an image, append a GET value (UNIX timestamp) to the image URL. Ensures a new image is used
-        when plot is generated (bypasses browser caching), as forces browser to think image is dynamic (reloaded every
-        time the modification date changes).
+        If html content is an image, use the content-hashed image path (a new plot always has a new image name, so
+        cached images are never shown out of date).
         Returns populated template for plot.
         """
         if config.tool_settings[tool]["plot_type"] == "table":
@@ -300,54 +850,58 @@ class TrendReport(object):
         elif config.tool_settings[tool]["plot_type"] in ["box_plot", "stacked_bar"]:
             template = config.plot_template
             if self.dictionary[tool]["image_location"]:
-                html_content = os.path.join(self.dictionary[tool]["image_location"] + '?" . filemtime(' +
-                                            self.dictionary[tool]["image_location"] + ') . "')
+                html_content = self.dictionary[tool]["image_location"]
         return template.format(config.tool_settings[tool]["plot_title"], config.tool_settings[tool]["plot_text"],
                                html_content)
 
+    @profiling.timed("generate_report")
     def generate_report(self):
         """
         Insert plot-specific html segments into report template.
 
-        Load report html template as python object. Create new file at generated_report_path location and write html
-        template to file, filling placeholders (upon html rendering) with placeholder values in place_holder_values
-        dictionary. Save html file as pdf for long-term records using pdfkit package and wkhtmltopdf software
+        Load report html template as python object. Create new file at generated_report_path location (in the build
+        folder while the report is staged) and write html template to file (with a pre-compressed .html.gz copy),
+        filling placeholders (upon html rendering) with placeholder values in place_holder_values dictionary. The
+        report is archived as pdf once published (see archive_pdf)
         """
         html_template_dir = Environment(loader=FileSystemLoader(self.template_dir))
         html_template = html_template_dir.get_template("internal_report_template.html")
-        generated_report_path = os.path.join(self.output_folder, self.runtype + "_trend_report.html")
+        generated_report_path = self.staged(self.report_path())
         place_holder_values = {"reports": config.body_template.format("\n".join(self.plots_html)),
                                "logo_path": self.logopath,
                                "timestamp": datetime.datetime.now().strftime('%d-%B-%Y %H:%M'),
                                "app_version": git_tag()}
-        with open(generated_report_path, "wb") as html_file:
-            html_file.write(html_template.render(place_holder_values))
+        write_html(generated_report_path, html_template.render(place_holder_values))
+
+    def report_path(self):
+        """
+        Return the path to the html trend report.
+            :return:    (str) output_folder/{runtype}_trend_report.html
+        """
+        return os.path.join(self.output_folder, self.runtype + "_trend_report.html")
+
+    def archive_pdf(self):
+        """
+        Save the html trend report as pdf in archive_folder for long-term records, using pdfkit package and wkhtmltopdf
+        software.
+        """
         # specify pdfkit options to turn off standard out and also allow access to the images
         # pdfkit needs the path tp wkhtmltopdf binary file - defined in config
         pdfkit_options = {'enable-local-file-access': None, "quiet": ''}
         pdfkit_config = pdfkit.configuration(wkhtmltopdf=self.wkhtmltopdf_path)
-        pdfkit.from_file(generated_report_path, os.path.join(self.archive_folder, str(
-                        datetime.datetime.now().strftime('%y%m%d_%H_%M')) + "_" + self.runtype + "_trend_report.pdf"),
-                        configuration=pdfkit_config, options=pdfkit_options)
+        with profiling.run_log.span("wkhtmltopdf"):
+            pdfkit.from_file(self.report_path(), os.path.join(self.archive_folder, str(
+                            datetime.datetime.now().strftime('%y%m%d_%H_%M')) + "_" + self.runtype +
+                                                                                 "_trend_report.pdf"),
+                             configuration=pdfkit_config, options=pdfkit_options)
+        profiling.run_log.increment("pdfs_generated")
 
     def generate_archive_html(self):
         """
         Add created trend report as link to archive_index.html - archived version accessible after live report updated
-        with more recent runs. Create list of all archived reports, sort by time last modified descending, cut
-        filepaths down to filenames, add links to html.
-        """
-        html_path = os.path.join(self.output_folder, "archive_index.html")
-        report_pdfs = []
-        sorted_descending = []
-        for report in os.listdir(self.archive_folder):
-            report_pdfs.append(os.path.join(self.archive_folder, report))
-        sorted_by_mtime_descending = sorted(report_pdfs, key=lambda t: -os.stat(t).st_mtime)
-        for filepath in sorted_by_mtime_descending:
-            sorted_descending.append(filepath.rsplit("/", 1)[-1])
-        with open(html_path, "wb") as html_file:
-            html_file.write('<html><head align="center">ARCHIVED TREND ANALYSIS REPORTS</head><body><ul>')
-            html_file.writelines(['<li><a href="archive/%s">%s</a></li>' % (f, f) for f in sorted_descending])
-            html_file.write('</ul></body></html>')
+        with more recent runs (see write_archive_index).
+        """
+        write_archive_index(self.output_folder, self.archive_folder)
 
       #  sorted_by_mtime_descending = sorted(files, key=lambda t: -os.stat(t).st_mtime)
 
@@ -361,7 +915,7 @@ class TrendReport(object):
         Acquire date-sorted tool-specific run name list from sorted_runs, build dictionary using numbers as keys and
         values from sorted_run_list as values. "Oldest" and "newest" added to keynames for oldest/newest runs
         """
-        sorted_run_list = sorted_runs(os.listdir(self.input_folder), self.runtype)
+        sorted_run_list = sorted_runs(list(self.scan_runfolders()), self.runtype, self.as_of, self.number_of_runs)
         run_name_dictionary = {}
         for value in range(1, len(sorted_run_list) + 1):
             if value == 1:
@@ -388,43 +942,61 @@ class TrendReport(object):
         """
         input_file_name = config.tool_settings[tool]["input_file"]
         tool_dict = OrderedDict({})
-        sorted_run_list = sorted_runs(os.listdir(self.input_folder), self.runtype)
+        self.sample_names[tool] = OrderedDict({})
+        sorted_run_list = sorted_runs(list(self.scan_runfolders()), self.runtype, self.as_of, self.number_of_runs)
         for run in sorted_run_list:
             if any(sequencer in run
                    for sequencer in config.tool_settings[tool]["report_type"][self.runtype].split(', ')):
-                file_path = find_file_path(input_file_name, os.path.join(self.input_folder, run))
+                if self.read_plan:
+                    file_path = self.read_plan.file_path(run, input_file_name, self.runfolders[run])
+                else:
+                    file_path = find_file_path(input_file_name, self.runfolders[run])
                 if file_path:
-                    tool_dict[run] = self.return_columns(file_path, tool)
+                    self.sample_names[tool][run] = []
+                    tool_dict[run] = self.return_columns(file_path, tool, self.sample_names[tool][run])
                 else:
                     tool_dict[run] = []
             else:
                 tool_dict[run] = []
         return tool_dict
 
-    def return_columns(self, file_path, tool):
+    @profiling.timed("return_columns")
+    def return_columns(self, file_path, tool, sample_names=None):
         """
         Returns data from column of interest in file as a list.
-            :param file_path:   (str) File to parse
-            :param tool:        (str) Name of tool to be plotted (allows access to tool-specific config settings in
-                                      tool_settings dictionary)
-            :return to_return:  (list) Measurements from column of interest
+            :param file_path:       (str) File to parse
+            :param tool:            (str) Name of tool to be plotted (allows access to tool-specific config settings in
+                                          tool_settings dictionary)
+            :param sample_names:    (list or NoneType) if supplied, the sample (or lane) name of each measurement is
+                                                       appended
+            :return to_return:      (list) Measurements from column of interest
 
-        Open file, and return lines of interest as a list (lines contain data in the column of interest, and do not
-        start with identifier_tuple elements (these are lines with no data)).
-        For each line in this list, calculate the required measurement and return these as a list.
+        If the file was read by the read plan, use the planned column data. Else open file (memory-mapped if larger than
+        mmap_min_bytes in config), read the header using return_column_index and stream the remaining lines, keeping
+        only the first column and the column of interest of lines containing data (see multiqc_parser.parse_columns).
+        For each data row, calculate the required measurement and return these as a list.
         """
-        identifier_tuple = ("#", "Sample", "CLUSTER_DENSITY")
         to_return = []
-        input_line_list = []
-        with open(file_path, 'r') as input_file:
-            column_index = self.return_column_index(input_file, tool)
-            for line in input_file.readlines():
-                if line.split("\t")[column_index] and not (line.isspace() or line.startswith(identifier_tuple)):
-                    input_line_list.append(line)
-            for line in input_line_list:
-                measurement = self.calculate_measurement(input_line_list, line, column_index, tool)
-                if measurement is not None:
-                    to_return.append(measurement)
+        column = config.tool_settings[tool]["column_of_interest"]
+        column_data = None
+        if self.read_plan:
+            column_data = self.read_plan.column_data(file_path, column)
+        if column_data is not None:
+            profiling.run_log.increment("files_cached")
+        else:
+            profiling.run_log.add_bytes(storage.getsize(file_path))
+            profiling.run_log.increment("files_parsed")
+            with multiqc_parser.open_multiqc_file(
+                    storage.local_path(file_path), config.general_config["general"]["mmap_min_bytes"]) as input_file:
+                column_index = self.return_column_index(input_file, tool)
+                column_data = multiqc_parser.parse_columns(input_file, {column: column_index},
+                                                           text_columns(tool))[column]
+        for row in range(len(column_data)):
+            measurement = self.calculate_measurement(column_data, row, tool)
+            if measurement is not None:
+                to_return.append(measurement)
+                if sample_names is not None:
+                    sample_names.append(column_data.names[row])
         return to_return
 
     def return_column_index(self, input_file, tool):
@@ -435,50 +1007,50 @@ class TrendReport(object):
                                           tool_settings dictionary)
             :return column_index:   (int) Index of the column of interest
         """
-        header_line = [input_file.readline().strip('\n').split("\t")]
+        header_line = [input_file.readline().rstrip('\r\n').split("\t")]
         column_index = header_line[0].index(config.tool_settings[tool]["column_of_interest"])
         return column_index
 
-    def calculate_measurement(self, input_line_list, line, column_index, tool):
+    def calculate_measurement(self, column_data, row, tool):
         """
-        Conducts required calculation on lines from input file.
-            :param input_line_list: (str) list of all data-containing lines from multiqc input file
-            :param line:            (str) one data-containing line from the input file
-            :param column_index:    (int) index of column of interest containing relevant data for plotting
+        Conducts required calculation on a data row from input file.
+            :param column_data:     (ColumnData) all data rows of the column of interest from multiqc input file
+            :param row:             (int) index of one data row
             :param tool:            (str) Name of tool to be plotted (allows access to tool-specific config settings in
                                           tool_settings dictionary)
             :return to_return:      (list) Measurements from column of interest
 
         Calculation differs by plot type (specified in config). Cluster density = /1000 to give cluster density.
         Contamination, and target bases plots = conversion to %. properly_paired and pct_off_amplicon = remove -ve
-        controls. peddy_sex_check = exclude blank elements (not all lines contain sex check data).
-        fastq_total_sequences = normalise by capture kit. All other plots no calculation required.
+        controls (identified by sample name). peddy_sex_check = exclude blank elements (not all lines contain sex check
+        data, these rows are not stored by the parser). fastq_total_sequences = normalise by capture kit. All other
+        plots no calculation required.
         """
+        value = column_data.values[row]
         if config.tool_settings[tool]["calculation"] == "divide_by_1000":
-            to_return = float(line.split("\t")[column_index]) / 1000
+            to_return = value / 1000
         elif config.tool_settings[tool]["calculation"] == "convert_to_percent":
-            to_return = float(line.split("\t")[column_index]) * 100
+            to_return = value * 100
         elif config.tool_settings[tool]["calculation"] == "remove_negative_controls":
             ntcon = ("NTCcon", "NTCCon")
-            if any(string in line for string in ntcon):
+            if any(string in column_data.names[row] for string in ntcon):
                 to_return = None
             else:
-                to_return = float(line.split("\t")[column_index])
+                to_return = value
         elif config.tool_settings[tool]["calculation"] == "exclude_blank_elements":
-            to_return = line.split("\t")[column_index]
+            to_return = value
         elif config.tool_settings[tool]["calculation"] == "normalise_by_capture_kit":
             # returns a list of True and false values per run
-            to_return = self.normalise_by_kit(input_line_list, line, column_index)
+            to_return = self.normalise_by_kit(column_data, row)
         else:
-            to_return = float(line.split("\t")[column_index])
+            to_return = value
         return to_return
 
-    def normalise_by_kit(self, input_line_list, line, column_index):
+    def normalise_by_kit(self, column_data, row):
         """
-        Output True/False value for line dependent on whether value is within bounds.
-            :param input_line_list: (str) list of all data-containing lines from multiqc input file
-            :param line:            (str) one data-containing line from the input file
-            :param column_index:    (int) index of column of interest containing relevant data for plotting
+        Output True/False value for data row dependent on whether value is within bounds.
+            :param column_data:     (ColumnData) all data rows of the column of interest from multiqc input file
+            :param row:             (int) index of one data row
             :return to_return:      (boolean or NoneType) True or False values, or None
 
         If value of interest is within bounds, 'True' returned, else 'False' returned.
@@ -486,21 +1058,25 @@ class TrendReport(object):
         Panel runs: normalisation required. For each capture kit type used by samples within run, upper/lower bounds
         calculated and samples within run compared to kit-specific bounds. For samples within run not using specified
         capture kit (panel number not in panel_dict list), those samples are discounted (return 'None').
+        Run type and panel number are identified from the sample name (first column).
         """
         upper_bound = lower_bound = None
-        if "WES" in line:
+        sample_name = column_data.names[row]
+        value = column_data.values[row]
+        to_return = None
+        if "WES" in sample_name:
             capture_kit = False
-            upper_bound, lower_bound = self.calculate_bounds(input_line_list, capture_kit, 0.20, column_index)
-            if lower_bound <= float(line.split("\t")[column_index]) <= upper_bound:
+            upper_bound, lower_bound = self.calculate_bounds(column_data, capture_kit, 0.20)
+            if lower_bound <= value <= upper_bound:
                 to_return = True
             else:
                 to_return = False
         else:
             for capture_kit in self.panel_dict:
-                if any(pan_number in line for pan_number in self.panel_dict[capture_kit]):
-                    upper_bound, lower_bound = self.calculate_bounds(input_line_list, capture_kit, 0.20, column_index)
+                if any(pan_number in sample_name for pan_number in self.panel_dict[capture_kit]):
+                    upper_bound, lower_bound = self.calculate_bounds(column_data, capture_kit, 0.20)
                 if None not in (upper_bound, lower_bound):
-                    if lower_bound <= float(line.split("\t")[column_index]) <= upper_bound:
+                    if lower_bound <= value <= upper_bound:
                         to_return = True
                     else:
                         to_return = False
@@ -508,32 +1084,35 @@ class TrendReport(object):
                     to_return = None
         return to_return
 
-    def calculate_bounds(self, input_line_list, capture_kit, proportion, column_index):
+    def calculate_bounds(self, column_data, capture_kit, proportion):
         """
         Calculate upper and lower bound for capture kit for input file
-            :param input_line_list:             (str) list of all data-containing lines from multiqc input file
+            :param column_data:                 (ColumnData) all data rows of the column of interest from multiqc input
+                                                             file
             :param capture_kit:                 (str) Name of capture kit
             :param proportion:                  (int) proportion value
-            :param column_index:                (int) index of column of interest containing relevant data for plotting
             :return upper_bound, lower_bound:   (int or boolean) Upper and lower bound values, or True or False values.
 
         If capture kit supplied, append all values from samples using that kit to list, else append all values to list.
         If list not empty, calculates upper and lower bound and returns these. If list empty, return False.
+        Bounds are cached on the column data, as they are the same for every row of the file.
         """
-        values_list = []
-        for line in input_line_list:
-            if capture_kit:
-                if any(pan_number in line.split("\t")[0] for pan_number in self.panel_dict[capture_kit]):
-                    values_list.append(float(line.split("\t")[column_index]))
+        if (capture_kit, proportion) not in column_data.bounds:
+            values_list = []
+            for sample_name, value in zip(column_data.names, column_data.values):
+                if capture_kit:
+                    if any(pan_number in sample_name for pan_number in self.panel_dict[capture_kit]):
+                        values_list.append(value)
+                else:
+                    values_list.append(value)
+            if values_list:
+                average = sum(values_list) / len(values_list)
+                upper_bound = average * (1.0+proportion)
+                lower_bound = average * (1.0-proportion)
             else:
-                values_list.append(float(line.split("\t")[column_index]))
-        if values_list:
-            average = sum(values_list) / len(values_list)
-            upper_bound = average * (1.0+proportion)
-            lower_bound = average * (1.0-proportion)
-        else:
-            upper_bound = lower_bound = False
-        return upper_bound, lower_bound
+                upper_bound = lower_bound = False
+            column_data.bounds[(capture_kit, proportion)] = (upper_bound, lower_bound)
+        return column_data.bounds[(capture_kit, proportion)]
 
 
 class Emails(object):
@@ -541,7 +1120,7 @@ class Emails(object):
     A class to handle email sending and logs. Determines new runs, sends emails and creates logfiles
 
     Attributes:
-        input_folder        (str) path to MultiQC data per run
+        input_folder        (str or list) path to MultiQC data per run, or list of paths (see input_roots.py)
         runtype             (str) run type from list of run_types defined in config
         wes_email           (str) recipient for completed WES trend analysis email alerts
         oncology_ops_email  (str) recipient for completed SWIFT trend analysis email alerts
@@ -550,10 +1129,13 @@ class Emails(object):
         email_subject       (str) email subject, with placeholders for inserting per-run information
         email_message       (str) email body, with placeholders for inserting per-run information
         hyperlink           (str) link to MultiQC reports
+        outliers            (list) outlier samples flagged in the trend report (see outliers.find_outliers)
+        runfolders          (OrderedDict) run as key, path to runfolder as value (see input_roots.scan_runfolders),
+                                          set by the caller to the run inventory of the run, else scanned by call_tools
     """
 
     def __init__(self, input_folder, runtype, wes_email, oncology_ops_email, custom_panels_email, mokaguys_email,
-                 email_subject, email_message, hyperlink):
+                 email_subject, email_message, hyperlink, outliers=None):
         self.input_folder = input_folder
         self.runtype = runtype
         self.wes_email = wes_email
@@ -563,6 +1145,8 @@ class Emails(object):
         self.email_subject = email_subject
         self.email_message = email_message
         self.hyperlink = hyperlink
+        self.outliers = outliers or []
+        self.runfolders = OrderedDict({})
 
     def call_tools(self):
         """
@@ -571,11 +1155,14 @@ class Emails(object):
         If runs of runtype are new, send trend report alert email to relevant team, and create logfile to record email
         sending.
         """
-        run_list = sorted_runs(os.listdir(self.input_folder), self.runtype)
-        new_runs = self.check_sent(run_list)
-        if new_runs:
-            self.send_email(new_runs)
-            self.create_email_logfile(new_runs)
+        with profiling.run_log.span("emails", runtype=self.runtype):
+            if not self.runfolders:
+                self.runfolders = input_roots.scan_runfolders(self.input_folder)
+            run_list = sorted_runs(list(self.runfolders), self.runtype)
+            new_runs = self.check_sent(run_list)
+            if new_runs:
+                self.send_email(new_runs)
+                self.create_email_logfile(new_runs)
 
     def check_sent(self, run_list):
         """
@@ -588,14 +1175,14 @@ class Emails(object):
         """
         new_runs = []
         for run in run_list:
-            run_folder = os.path.join(self.input_folder + '/' + run)
-            email_logfile_path = find_file_path("email_logfile", run_folder)
-            if email_logfile_path and ("email sent" in open(email_logfile_path, "r").read()):
+            email_logfile_path = find_file_path("email_logfile", self.runfolders[run])
+            if email_logfile_path and ("email sent" in open(storage.local_path(email_logfile_path), "r").read()):
                 pass
             else:
                 new_runs.append(run)
         return new_runs
 
+    @profiling.timed("send_email")
     def send_email(self, new_runs):
         """
         Send email (using smtplib) per runtype for newly analysed runs to notify users of new trend report.
@@ -603,7 +1190,8 @@ class Emails(object):
 
         Set recipients based on runtype. Create message object, set email priority, subject, recipients, sender, body.
         """
-        place_holder_values = {"run_list": "\n".join(new_runs), "hyperlink": self.hyperlink, "version": git_tag()}
+        place_holder_values = {"run_list": "\n".join(new_runs), "hyperlink": self.hyperlink, "version": git_tag(),
+                               "outliers": self.describe_outliers(new_runs)}
         message_body = self.email_message.format(**place_holder_values)
 
         if self.runtype == "WES":
@@ -613,7 +1201,7 @@ class Emails(object):
         if self.runtype == "SWIFT":
             recipients = [self.oncology_ops_email, self.mokaguys_email]
 
-        if self.runtype in ["WES", "CUSTOM_PANELS", "SWIFT"]:
+        if self.runtype in ALERTING_RUN_TYPES:
             m = Message()
             m["X-Priority"] = str("3")
             m["Subject"] = self.email_subject.format(self.runtype)
@@ -628,6 +1216,23 @@ class Emails(object):
             server.ehlo()
             server.login(config.user, config.pw)
             server.sendmail(config.general_config["general"]["sender"], recipients, m.as_string())
+            profiling.run_log.increment("emails_sent")
+
+    def describe_outliers(self, new_runs):
+        """
+        Describe outlier samples in newly analysed runs, for the email body.
+            :param new_runs:    (list) Runs not yet analysed
+            :return:            (str) list of outlier samples (tool, run, sample, value and robust z-score), or an
+                                      empty string if there are none
+        """
+        new_outliers = [outlier for outlier in self.outliers if outlier["run"] in new_runs]
+        if not new_outliers:
+            return ""
+        return "\n\nOutlier samples in these runs (absolute robust z-score above {}):\n{}".format(
+            config.general_config["general"]["outlier_z_threshold"],
+            "\n".join("{} - {} {}: {:.4g} (z-score {:.2f})".format(
+                config.tool_settings[outlier["tool"]]["plot_title"], outlier["run"], outlier["sample"],
+                outlier["value"], outlier["z_score"]) for outlier in new_outliers))
 
     def create_email_logfile(self, new_runs):
         """
@@ -635,65 +1240,201 @@ class Emails(object):
             :param new_runs:   (list) Runs not yet analysed
         """
         for run in new_runs:
-            logfile_path = os.path.join(self.input_folder + '/{}/email_logfile').format(run)
-            with open(logfile_path, "w") as logfile_path:
-                logfile_path.write(datetime.datetime.now().strftime(
-                    '%d-%B-%Y %H:%M') + ": Run has been analysed and notification email sent")
+            storage.write_text(os.path.join(self.runfolders[run], "email_logfile"), datetime.datetime.now().strftime(
+                '%d-%B-%Y %H:%M') + ": Run has been analysed and notification email sent")
 
 
-def sorted_runs(run_list, runtype):
+@profiling.timed("generate_archive_html")
+def write_archive_index(output_folder, archive_folder):
     """
-    Filter runs of correct run type, order in date order (oldest to newest).
-        :param run_list:    (list) Run folders to include in trend analysis
-        :param runtype:     (str) run type from list of run_types defined in config
-        :return             (list) x (defined in config) most recent runfolder names, ordered oldest to newest
+    Write archive_index.html, linking to each archived report. Create list of all archived reports (including those
+    bundled by archive maintenance, see archive_maintenance.py), sort by time last modified
+    descending, add links to html.
+        :param output_folder:   (str) path to save location for html trend reports and archive_index.html
+        :param archive_folder:  (str) path to archived reports
+    """
+    html_path = os.path.join(output_folder, "archive_index.html")
+    # stat archived reports not in the manifest concurrently (each stat is a round trip on network storage)
+    with ThreadPoolExecutor(max_workers=config.general_config["general"]["io_concurrency"]) as pool:
+        sorted_descending = [name for name, mtime in archive_maintenance.archived_reports(
+            archive_folder, lambda report_paths: list(pool.map(os.path.getmtime, report_paths)))]
+    write_html(html_path, '<html><head align="center">ARCHIVED TREND ANALYSIS REPORTS</head><body><ul>' +
+               "".join(['<li><a href="archive/%s">%s</a></li>' % (f, f) for f in sorted_descending]) +
+               '</ul></body></html>')
 
-    Take list of runfolders (e.g. 002_YYMMDD_[*WES*,*NGS*,*ONC*]), filter runs of correct runtype by substrings in run
-    names, add to dictionary with name as value and date as key (cannot add date as key as dictionaries do not allow
-    duplicate keys), sort in date order by value, return x most recent runs.
+
+def template_version(template_dir):
+    """
+    Return the version of the report templates, so that reports are republished when a template or the script release
+    changes.
+        :param template_dir:    (str) path to html templates
+        :return:                (str) SHA-1 digest of the report html template, html templates in config and script
+                                      release version
+    """
+    version = hashlib.sha1()
+    with open(os.path.join(template_dir, "internal_report_template.html"), "rb") as template_file:
+        version.update(template_file.read())
+    for template in [config.body_template, config.plot_template, config.table_template, config.outlier_template,
+                     str(git_tag())]:
+        version.update(template.encode("utf-8"))
+    return version.hexdigest()
+
+
+def write_html(html_path, html):
+    """
+    Write a html file, and a pre-compressed copy (html_path + ".gz") served to browsers accepting gzip encoding (see
+    config.htaccess). Each file is written atomically (see atomic_write.py), so a partially written file is never
+    served.
+        :param html_path:   (str) path to the html file
+        :param html:        (str) html
+    """
+    html = html.encode("utf-8")
+    atomic_write.write_atomic(html_path, html)
+    atomic_write.write_atomic(html_path + ".gz", report_server.gzip_bytes(html))
+
+
+def write_htaccess(output_folder, serve_port):
+    """
+    Write the Apache configuration for the trend reports (cache headers, pre-compressed html and the archive proxy to
+    the report server) from config.htaccess, if changed.
+        :param output_folder:   (str) path to the html trend reports
+        :param serve_port:      (int) port of the report server archived reports are proxied to
+    """
+    htaccess = config.htaccess.format(serve_port=serve_port)
+    htaccess_path = os.path.join(output_folder, ".htaccess")
+    if os.path.isfile(htaccess_path):
+        with open(htaccess_path, "r") as htaccess_file:
+            if htaccess_file.read() == htaccess:
+                return
+    with open(htaccess_path, "w") as htaccess_file:
+        htaccess_file.write(htaccess)
+
+
+def text_columns(tool):
+    """
+    Return the columns of interest of a tool that hold text rather than numeric values.
+        :param tool:    (str) Name of tool (allows access to tool-specific config settings in tool_settings dictionary)
+        :return:        (set) column of interest if its values are used as text (exclude_blank_elements), else empty
     """
-    dates = {}
+    if config.tool_settings[tool].get("calculation") == "exclude_blank_elements":
+        return set([config.tool_settings[tool]["column_of_interest"]])
+    return set()
+
+
+def run_date(run):
+    """
+    Return the date of a runfolder as an integer (YYMMDD), parsed from the runfolder name.
+        :param run:     (str) runfolder name (e.g. 002_YYMMDD_[*WES*,*NGS*,*ONC*])
+        :return:        (int or NoneType) date of the run, or None if the name does not contain a date
+
+    Parsed dates are cached with the run type classification in _run_classifications, so each name is parsed once.
+    """
+    return classify_run(run)[0]
+
+
+def classify_run(run):
+    """
+    Classify a runfolder name into every run type whose identifier rule it matches.
+        :param run:     (str) runfolder name (e.g. 002_YYMMDD_[*WES*,*NGS*,*ONC*])
+        :return:        (tuple) date of the run (int YYMMDD, or None if unparseable) and tuple of matching run types
+
+    Rules are defined in config.run_type_identifiers: all include substrings present, no exclude substrings present,
+    and regex (if specified) found in the name. Results are cached per runfolder name, as the same folder names are
+    classified many times per tick.
+    """
+    if run not in _run_classifications:
+        try:
+            date = int(run.split("_")[1])
+        except (IndexError, ValueError):
+            date = None
+        runtypes = []
+        for runtype, rule in config.run_type_identifiers.items():
+            if all(identifier in run for identifier in rule["include"]) and \
+                    not any(identifier in run for identifier in rule["exclude"]) and \
+                    (not rule["regex"] or re.search(rule["regex"], run)):
+                runtypes.append(runtype)
+        _run_classifications[run] = (date, tuple(runtypes))
+    return _run_classifications[run]
+
+
+def classify_runs(run_list, number_of_runs, as_of=None):
+    """
+    Classify runfolders into run types, and select the x most recent runs of each run type.
+        :param run_list:        (list) Run folders to classify
+        :param number_of_runs:  (int) x most recent runs to keep per run type
+        :param as_of:           (int or NoneType) cutoff date (YYMMDD). Runs after this date are excluded, to select the
+                                                  runs as they were on that date. None for no cutoff
+        :return:                (dict) run type as key, list of x most recent runfolder names (oldest to newest) as
+                                       value
+
+    Each runfolder name is classified once into all matching run types. Runs with no parseable date are excluded. A
+    bounded heap selection (heapq.nlargest) keeps the x most recent runs per run type instead of sorting every run.
+    Date ties are broken on runfolder name so the selection is deterministic.
+    """
+    dated_runs = {}
     for run in run_list:
-        if runtype == "WES" and "WES" in run:
-            dates[run] = int(run.split("_")[1])
-        if runtype == "CUSTOM_PANELS" and "NGS" in run and "WES" not in run:
-            dates[run] = int(run.split("_")[1])
-        if runtype == "SWIFT" and "ONC" in run:
-            dates[run] = int(run.split("_")[1])
-        if runtype == "NEXTSEQ_LUIGI" and "NB552085" in run:
-            dates[run] = int(run.split("_")[1])
-        if runtype == "NEXTSEQ_MARIO" and "NB551068" in run:
-            dates[run] = int(run.split("_")[1])
-        if runtype == "MISEQ_ONC" and "M02353" in run:
-            dates[run] = int(run.split("_")[1])
-        if runtype == "MISEQ_DNA" and "M02631" in run:
-            dates[run] = int(run.split("_")[1])
-        if runtype == "NOVASEQ_PIKACHU" and "A01229" in run:
-            dates[run] = int(run.split("_")[1])
-        if runtype == "TSO500" and "TSO500" in run:
-            dates[run] = int(run.split("_")[1])
-        if runtype == "SNP" and "SNP" in run:
-            dates[run] = int(run.split("_")[1])
-        if runtype == "ADX" and "ADX" in run:
-            dates[run] = int(run.split("_")[1])
-
-    sortedruns = []
-    for date in sorted(dates, key=dates.get):
-        sortedruns.append(date)
-    return sortedruns[-config.general_config["general"]["number_of_runs_to_include"]:]
+        date, runtypes = classify_run(run)
+        if date is None or (as_of is not None and date > as_of):
+            continue
+        for runtype in runtypes:
+            dated_runs.setdefault(runtype, []).append((date, run))
+    classified = {}
+    for runtype, runs in dated_runs.items():
+        classified[runtype] = [run for date, run in sorted(heapq.nlargest(number_of_runs, runs))]
+    return classified
+
+
+@profiling.timed("sorted_runs")
+def sorted_runs(run_list, runtype, as_of=None, number_of_runs=None):
+    """
+    Filter runs of correct run type, order in date order (oldest to newest).
+        :param run_list:        (list) Run folders to include in trend analysis
+        :param runtype:         (str) run type from list of run_types defined in config
+        :param as_of:           (int or NoneType) cutoff date (YYMMDD) - runs after this date are excluded (used to
+                                                  regenerate reports as they would have been on that date). None for
+                                                  all runs
+        :param number_of_runs:  (int or NoneType) x most recent runs to return. None for number_of_runs_to_include in
+                                                  config
+        :return                 (list) x (defined in config) most recent runfolder names, ordered oldest to newest
+
+    Take list of runfolders (e.g. 002_YYMMDD_[*WES*,*NGS*,*ONC*]), classify into run types using the identifier rules
+    in config.run_type_identifiers and return the x most recent runs of the requested run type. sorted_runs is called
+    for every tool of every run type with the same folder listing, so the classification of the last listing is
+    cached and reused.
+    """
+    number_of_runs = number_of_runs or config.general_config["general"]["number_of_runs_to_include"]
+    cache_key = (tuple(run_list), number_of_runs, as_of)
+    if _classified_runs_cache.get("key") != cache_key:
+        _classified_runs_cache["key"] = cache_key
+        _classified_runs_cache["runs"] = classify_runs(run_list, number_of_runs, as_of)
+    return list(_classified_runs_cache["runs"].get(runtype, []))
 
 
+@profiling.timed("list_runfolder")
+def list_runfolder(path):
+    """
+    Return paths of all files in a runfolder (recursively: in os.walk order for a local runfolder, or listed in bulk for
+    a runfolder in object storage, see storage.py).
+        :param path:    (str) path to the folder containing all QC files for that run
+        :return:        (list) file paths
+    """
+    profiling.run_log.increment("runfolders_scanned")
+    return storage.list_files(path)
+
+
+@profiling.timed("find_file_path")
 def find_file_path(name, path):
     """
-    Recursively search for file (os.walk) through all files in folder and return path. If not present, print a message.
+    Recursively search for file (see storage.list_files) through all files in folder and return path. If not present,
+    print a message.
         :param name:    (str) filename
         :param path:    (str) path to the folder containing all QC files for that run
         :return:        (str or bool) path to file of interest if file exists, else False.
     """
-    for root, dirs, files in os.walk(path):
-        for filename in files:
-            if name in filename:
-                return os.path.join(root, filename)
+    profiling.run_log.increment("runfolders_scanned")
+    for file_path in storage.list_files(path):
+        if name in os.path.basename(file_path):
+            return file_path
     print("no output named {} for run {}".format(name, path))
     return False
 
@@ -733,28 +1474,835 @@ def check_for_update(index_file, run_frequency):
 def main():
     args = arg_parse()
     inputs = get_inputs(args)
+    if args.command == "query":
+        query(args, inputs)
+        return
+    if args.command == "backfill":
+        try:
+            backfill(args, inputs)
+        finally:
+            write_run_log(inputs)
+        return
+    if args.command == "serve":
+        serve(args, inputs)
+        return
+    if args.command == "archive":
+        # archive maintenance moves and removes archived reports, so does not run alongside a report run (which
+        # archives reports and lists the archive) or another archive run
+        lock = run_lock.RunLock(inputs["lock_file"])
+        if not lock.acquire(request_rerun=False):
+            print("trend analysis already running (lock held on {}), archive maintenance skipped".format(
+                inputs["lock_file"]))
+            return
+        try:
+            archive(inputs)
+        finally:
+            write_run_log(inputs)
+            lock.release()
+        return
+    if args.explain:
+        explain(args, inputs)
+        return
+    if args.command == "ingest":
+        # the rebuilds requested are run by the next run, or by the running instance if the run lock is held. Nothing
+        # else is scanned or rebuilt here
+        try:
+            ingest(args, inputs)
+        finally:
+            write_run_log(inputs)
+        notify_running_instance(inputs)
+        return
+    if args.worker:
+        worker(inputs)
+        return
+    # Only one instance runs at a time. Overlapping invocations record a rerun request for the running instance and
+    # exit without writing a run log or metrics (which would overwrite those of the running instance)
+    lock = run_lock.RunLock(inputs["lock_file"])
+    if not lock.acquire():
+        print("trend analysis already running (lock held on {}), rerun requested".format(inputs["lock_file"]))
+        return
+    if args.profile:
+        profiling.run_log.enable_profiling()
+    if args.memory_report:
+        profiling.run_log.enable_memory_tracking()
+    tool_medians = {}
+    success = False
+    try:
+        with profiling.run_log.span("main"):
+            run_coalesced(args, inputs, lock, tool_medians)
+        success = True
+    finally:
+        try:
+            write_run_log(inputs)
+            if args.memory_report:
+                print(profiling.run_log.memory_report())
+            # metrics export never fails a run (or hides the exception the run raised)
+            try:
+                prometheus_exporter.write_textfile(inputs["prometheus_textfile"], profiling.run_log, success,
+                                                   inputs["output_folder"], inputs["run_types"], tool_medians)
+            except (IOError, OSError) as error:
+                print("metrics not written to {}: {}".format(inputs["prometheus_textfile"], error))
+        finally:
+            lock.release()
+
+
+def write_run_log(inputs, name=None):
+    """
+    Write the run log (and any --profile outputs) to the run log folder.
+        :param inputs:  (OrderedDict) Dictionary with config setting name as key and setting as value
+        :param name:    (str or NoneType) name added to the run log name (see profiling.RunLog.write_outputs)
+    """
+    run_log_path = profiling.run_log.write_outputs(inputs["run_log_folder"], name)
+    print("run log written to {}".format(run_log_path))
+
+
+def notify_running_instance(inputs):
+    """
+    Record a rerun request if an instance is running (holds the run lock), so it handles rebuild requests recorded
+    since it started when it finishes (see run_coalesced). Otherwise they are handled by the next run.
+        :param inputs:  (OrderedDict) Dictionary with config setting name as key and setting as value
+    """
+    lock = run_lock.RunLock(inputs["lock_file"])
+    if lock.acquire():
+        lock.release()
+        print("rebuilds will run with the next trend analysis run")
+    else:
+        print("trend analysis running (lock held on {}), rerun requested".format(inputs["lock_file"]))
+
+
+def query(args, inputs):
+    """
+    Print QC measurements recorded in the metrics store, filtered using the query arguments.
+        :param args:    (Namespace object) parsed command line attributes
+        :param inputs:  (OrderedDict) Dictionary with config setting name as key and setting as value
+    """
+    store = metrics_store.MetricsStore(inputs["metrics_db"])
+    try:
+        rows = store.query(runtype=args.runtype, sequencer=args.sequencer, tool=args.tool, since=args.since,
+                           until=args.until, sample=args.sample)
+    finally:
+        store.close()
+    if args.format == "csv":
+        metrics_store.write_csv(rows)
+    else:
+        metrics_store.write_table(rows)
+
+
+def yymmdd(date_text):
+    """
+    Convert a date supplied on the command line to the date format of runfolder names.
+        :param date_text:   (str) date (YYYY-MM-DD)
+        :return:            (int) date (YYMMDD)
+    """
+    return int(datetime.datetime.strptime(date_text, "%Y-%m-%d").strftime("%y%m%d"))
+
+
+def backfill_dates(run_list, runtype, since, until):
+    """
+    Return the dates to regenerate a run type's report as of: the date of each run of the run type between since and
+    until (the dates the live report would have changed), or until alone if since is None.
+        :param run_list:    (list) Run folders
+        :param runtype:     (str) run type from list of run_types defined in config
+        :param since:       (int or NoneType) earliest date (YYMMDD), inclusive
+        :param until:       (int) latest date (YYMMDD), inclusive
+        :return:            (list) dates (YYMMDD), oldest first
+    """
+    if since is None:
+        return [until]
+    return sorted(set(date for date, runtypes in (classify_run(run) for run in run_list)
+                      if date is not None and runtype in runtypes and since <= date <= until))
+
+
+@profiling.timed("backfill")
+def backfill(args, inputs):
+    """
+    Regenerate trend reports as of past dates, without sending emails, recording measurements or changing the live
+    reports and archive. Reports are written to a folder per date in backfill_folder (config).
+        :param args:    (Namespace object) parsed command line attributes
+        :param inputs:  (OrderedDict) Dictionary with config setting name as key and setting as value
+
+    Each (run type, as-of date) report is a job in a process pool of backfill_processes (config) processes. Jobs are
+    submitted oldest date first, so each process tends to work on neighbouring dates, whose reports share most of their
+    runs, and reuses the MultiQC data it has already parsed (see backfill_report). The input roots are scanned once, and
+    every job is built from that run inventory.
+    """
+    until = yymmdd(args.until) if args.until else int(datetime.datetime.now().strftime("%y%m%d"))
+    since = yymmdd(args.since) if args.since else None
+    runfolders = input_roots.scan_runfolders(inputs["input_folder"])
+    run_types = [args.runtype] if args.runtype else inputs["run_types"]
+    jobs = sorted((as_of, runtype) for runtype in run_types
+                  for as_of in backfill_dates(list(runfolders), runtype, since, until))
     panel_dict = get_panel_dict(github_repo="https://github.com/moka-guys/automate_demultiplex",
                                 github_file="automate_demultiplex_config.py",
                                 kit_list=["vcp1_panel_list", "vcp2_panel_list", "vcp3_panel_list"])
+    print("backfilling {} reports with {} processes".format(len(jobs), inputs["backfill_processes"]))
+    with ProcessPoolExecutor(max_workers=inputs["backfill_processes"]) as pool:
+        futures = [pool.submit(backfill_report, runtype, as_of, inputs, panel_dict, args.force, runfolders)
+                   for as_of, runtype in jobs]
+        for future in as_completed(futures):
+            output_folder, runtype = future.result()
+            print("{} trend report regenerated in {}".format(runtype, output_folder))
+            profiling.run_log.increment("reports_backfilled", runtype=runtype)
+
+
+def backfill_report(runtype, as_of, inputs, panel_dict, force=False, runfolders=None):
+    """
+    Regenerate a trend report as of a past date (run in a backfill worker process).
+        :param runtype:     (str) run type from list of run_types defined in config
+        :param as_of:       (int) cutoff date (YYMMDD) - runs after this date are excluded
+        :param inputs:      (OrderedDict) Dictionary with config setting name as key and setting as value
+        :param panel_dict:  (OrderedDict) Dictionary of capture kit panel lists
+        :param force:       (bool) regenerate the report even if an unchanged report was already backfilled
+        :param runfolders:  (OrderedDict or NoneType) run inventory of the backfill (see backfill), or None to scan
+                                                      the input roots
+        :return:            (tuple) folder the report was written to, and run type
+
+    The report, its images and archived PDF are written to backfill_folder/YYYY-MM-DD (with a copy of the logo, so the
+    report and PDF render). MultiQC files are read through a read plan kept for the life of the worker process, so
+    files already read for an earlier job (e.g. runs included in the report of a neighbouring date) are not re-read.
+    """
+    global _backfill_read_plan
+    if _backfill_read_plan is None:
+        _backfill_read_plan = ReadPlanner(inputs["input_folder"], inputs["mmap_min_bytes"], inputs["io_concurrency"])
+    if runfolders is None:
+        runfolders = input_roots.scan_runfolders(inputs["input_folder"])
+    _backfill_read_plan.build_plan([runtype], inputs["plot_order"], as_of, runfolders=runfolders)
+    _backfill_read_plan.execute()
+    output_folder = os.path.join(inputs["backfill_folder"],
+                                 datetime.datetime.strptime("{:06d}".format(as_of), "%y%m%d").strftime("%Y-%m-%d"))
+    images_folder = os.path.join(output_folder, "images")
+    archive_folder = os.path.join(output_folder, "archive")
+    for folder in [images_folder, archive_folder]:
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # created by another worker process
+            if not os.path.isdir(folder):
+                raise
+    logo = os.path.join(inputs["images_folder"], os.path.basename(inputs["logopath"]))
+    if os.path.isfile(logo) and not os.path.isfile(os.path.join(images_folder, os.path.basename(logo))):
+        copyfile(src=logo, dst=os.path.join(images_folder, os.path.basename(logo)))
+    trend_report = TrendReport(input_folder=inputs["input_folder"], output_folder=output_folder,
+                               images_folder=images_folder, runtype=runtype, panel_dict=panel_dict,
+                               template_dir=inputs["template_dir"], archive_folder=archive_folder,
+                               logopath=inputs["logopath"], plot_order=inputs["plot_order"],
+                               wkhtmltopdf_path=inputs["wkhtmltopdf_path"], read_plan=_backfill_read_plan,
+                               force=force, as_of=as_of)
+    trend_report.runfolders = runfolders
+    trend_report.call_tools(inspect.getmembers(trend_report, predicate=inspect.ismethod))
+    return output_folder, runtype
+
+
+def serve(args, inputs):
+    """
+    Run an HTTP server rendering trend reports on demand (see report_server.py), without sending emails, recording
+    measurements or changing the published reports and archive.
+        :param args:    (Namespace object) parsed command line attributes
+        :param inputs:  (OrderedDict) Dictionary with config setting name as key and setting as value
+
+    MultiQC files are read through a read plan shared by all renders, so files already read for one report (or window)
+    are not re-read for another. The read plan is replaced when the run inventory changes.
+    """
+    panel_dict = get_panel_dict(github_repo="https://github.com/moka-guys/automate_demultiplex",
+                                github_file="automate_demultiplex_config.py",
+                                kit_list=["vcp1_panel_list", "vcp2_panel_list", "vcp3_panel_list"])
+    read_plans = {}
+
+    def render(runtype, window):
+        inventory = report_server.run_inventory(inputs["input_folder"])
+        if inventory not in read_plans:
+            for read_plan in read_plans.values():
+                read_plan.close()
+            read_plans.clear()
+            read_plans[inventory] = ReadPlanner(inputs["input_folder"], inputs["mmap_min_bytes"],
+                                                inputs["io_concurrency"])
+        return render_report(runtype, window, inputs, panel_dict, read_plans[inventory])
+
+    cache = report_server.RenderCache(render, inputs["serve_cache_size"])
+    try:
+        report_server.serve(inputs["serve_host"], args.port or inputs["serve_port"], cache, inputs["input_folder"],
+                            inputs["images_folder"], inputs["archive_folder"], inputs["run_types"],
+                            lambda: template_version(inputs["template_dir"]))
+    finally:
+        for read_plan in read_plans.values():
+            read_plan.close()
+
+
+def render_report(runtype, window, inputs, panel_dict, read_plan):
+    """
+    Render a trend report in a temporary folder, and return its html and images.
+        :param runtype:     (str) run type from list of run_types defined in config
+        :param window:      (int or NoneType) number of most recent runs to include, or None for
+                                              number_of_runs_to_include in config
+        :param inputs:      (OrderedDict) Dictionary with config setting name as key and setting as value
+        :param panel_dict:  (OrderedDict) Dictionary of capture kit panel lists
+        :param read_plan:   (ReadPlanner) MultiQC data shared between renders
+        :return:            (tuple) report html (bytes), and dictionary of image name as key, image (bytes) as value
+
+    No PDF is archived. Each render is recorded in a new run log (the server runs indefinitely, so a single run log
+    would grow without bound), written to run_log_folder (config) once the render is finished, and its wall time
+    printed.
+    """
+    profiling.run_log = profiling.RunLog()
+    output_folder = tempfile.mkdtemp(prefix="trend_report_")
+    try:
+        images_folder = os.path.join(output_folder, "images")
+        os.mkdir(images_folder)
+        with profiling.run_log.span("render", runtype=runtype) as span:
+            read_plan.build_plan([runtype], inputs["plot_order"], number_of_runs=window)
+            read_plan.execute()
+            trend_report = TrendReport(input_folder=inputs["input_folder"], output_folder=output_folder,
+                                       images_folder=images_folder, runtype=runtype, panel_dict=panel_dict,
+                                       template_dir=inputs["template_dir"], archive_folder=output_folder,
+                                       logopath=inputs["logopath"], plot_order=inputs["plot_order"],
+                                       wkhtmltopdf_path=inputs["wkhtmltopdf_path"], read_plan=read_plan,
+                                       number_of_runs=window, archive=False)
+            trend_report.call_tools(inspect.getmembers(trend_report, predicate=inspect.ismethod))
+        with open(os.path.join(output_folder, runtype + "_trend_report.html"), "rb") as html_file:
+            html = html_file.read()
+        images = {}
+        for image_name in os.listdir(images_folder):
+            with open(os.path.join(images_folder, image_name), "rb") as image_file:
+                images[image_name] = image_file.read()
+    finally:
+        shutil.rmtree(output_folder)
+        write_run_log(inputs, "render_" + runtype)
+    print("{} trend report ({} runs) rendered in {:.2f}s".format(
+        runtype, window or inputs["number_of_runs_to_include"], span["wall"]))
+    return html, images
+
+
+@profiling.timed("archive_maintenance")
+def archive(inputs):
+    """
+    Deduplicate archived report PDFs and roll PDFs older than archive_hot_days (config) into monthly bundles, then
+    rewrite archive_index.html.
+        :param inputs:  (OrderedDict) Dictionary with config setting name as key and setting as value
+    """
+    counts = archive_maintenance.compact(inputs["archive_folder"], inputs["archive_hot_days"])
+    for name, count in counts.items():
+        profiling.run_log.increment("archive_reports_" + name, count)
+    print("archive maintenance: {deduplicated} duplicate reports linked, {bundled} reports bundled, {hot} reports "
+          "left in {archive_folder}".format(archive_folder=inputs["archive_folder"], **counts))
+    write_archive_index(inputs["output_folder"], inputs["archive_folder"])
+
+
+def ingest(args, inputs):
+    """
+    Ingest a finished runfolder (see ingest_run).
+        :param args:    (Namespace object) parsed command line attributes
+        :param inputs:  (OrderedDict) Dictionary with config setting name as key and setting as value
+    """
+    if not args.runfolder:
+        raise ValueError("ingest requires the path to a finished runfolder")
+    panel_dict = get_panel_dict(github_repo="https://github.com/moka-guys/automate_demultiplex",
+                                github_file="automate_demultiplex_config.py",
+                                kit_list=["vcp1_panel_list", "vcp2_panel_list", "vcp3_panel_list"])
+    ingest_run(args.runfolder, inputs, panel_dict)
+
+
+@profiling.timed("ingest")
+def ingest_run(runfolder, inputs, panel_dict, store=None):
+    """
+    Ingest a finished runfolder: classify it into run types, record its QC measurements in the metrics store, and
+    request rebuilds of the reports of its run types only (see rebuild_requests.py). Called by the upstream pipeline
+    (read_qc_files.py ingest <runfolder>, or from Python) when a runfolder's MultiQC outputs are complete, so new
+    runs are picked up without waiting for the index file to change.
+        :param runfolder:   (str) path to the runfolder (in one of the input roots)
+        :param inputs:      (OrderedDict) Dictionary with config setting name as key and setting as value
+        :param panel_dict:  (OrderedDict) Dictionary of capture kit panel lists
+        :param store:       (MetricsStore or NoneType) store to record measurements in, or None for metrics_db (config)
+        :return:            (list) run types whose reports were requested to be rebuilt
+
+    Only the runfolder itself is listed and read - the input roots are not scanned. Ingesting a runfolder again
+    replaces its recorded measurements.
+    """
+    if not storage.isdir(runfolder):
+        raise ValueError("{} is not a runfolder".format(runfolder))
+    run = os.path.basename(os.path.normpath(runfolder))
+    date, run_types = classify_run(run)
+    run_types = [runtype for runtype in inputs["run_types"] if runtype in run_types]
+    if date is None or not run_types:
+        print("{} is not a dated runfolder of a reported run type, not ingested".format(run))
+        return []
+    runfolders = OrderedDict([(run, storage.abspath(runfolder))])
+    read_plan = ReadPlanner(inputs["input_folder"], inputs["mmap_min_bytes"], inputs["io_concurrency"])
+    close_store = store is None
+    if close_store:
+        store = metrics_store.MetricsStore(inputs["metrics_db"])
+    try:
+        read_plan.build_plan(run_types, inputs["plot_order"], runfolders=runfolders)
+        read_plan.execute()
+        for runtype in run_types:
+            trend_report = TrendReport(input_folder=inputs["input_folder"], output_folder=inputs["output_folder"],
+                                       images_folder=inputs["images_folder"], runtype=runtype, panel_dict=panel_dict,
+                                       template_dir=inputs["template_dir"], archive_folder=inputs["archive_folder"],
+                                       logopath=inputs["logopath"], plot_order=inputs["plot_order"],
+                                       wkhtmltopdf_path=inputs["wkhtmltopdf_path"], read_plan=read_plan,
+                                       metrics_store=store)
+            trend_report.runfolders = runfolders
+            for tool in inputs["plot_order"]:
+                if config.tool_settings[tool]["report_type"].get(runtype) and \
+                        config.tool_settings[tool]["function"] == "parse_multiqc_output":
+                    trend_report.dictionary[tool] = trend_report.parse_multiqc_output(tool)
+            trend_report.store_data()
+            rebuild_requests.request_rebuild(inputs["rebuild_folder"], runtype, run)
+    finally:
+        read_plan.close()
+        if close_store:
+            store.close()
+    profiling.run_log.increment("runs_ingested")
+    print("{} ingested, rebuild requested for {}".format(run, ", ".join(run_types)))
+    return run_types
+
+
+def explain(args, inputs):
+    """
+    Print the plan of a report run with estimated costs, and write it as JSON to the run log folder, without running
+    it (see explain_plan.py).
+        :param args:    (Namespace object) parsed command line attributes
+        :param inputs:  (OrderedDict) Dictionary with config setting name as key and setting as value
+        :return:        (OrderedDict) plan with estimates
+    """
+    panel_dict = get_panel_dict(github_repo="https://github.com/moka-guys/automate_demultiplex",
+                                github_file="automate_demultiplex_config.py",
+                                kit_list=["vcp1_panel_list", "vcp2_panel_list", "vcp3_panel_list"])
+    plan = plan_run(args, inputs, panel_dict)
+    explain_plan.add_estimates(plan, explain_plan.stage_timings(inputs["run_log_folder"], inputs["explain_history"]),
+                               inputs["io_concurrency"])
+    print(explain_plan.describe(plan))
+    plan_path = os.path.join(inputs["run_log_folder"],
+                             datetime.datetime.now().strftime('%y%m%d_%H_%M_%S') + "_explain.json")
+    explain_plan.write_plan(plan, plan_path)
+    print("plan written to {}".format(plan_path))
+    return plan
+
+
+def plan_run(args, inputs, panel_dict):
+    """
+    Build the plan of a report run, deciding which run types are reported as run does.
+        :param args:        (Namespace object) parsed command line attributes
+        :param inputs:      (OrderedDict) Dictionary with config setting name as key and setting as value
+        :param panel_dict:  (OrderedDict) Dictionary of capture kit panel lists
+        :return:            (OrderedDict) reason for the run, distributed (bool), time budget (tick_budget_seconds
+                                          in config), input scan (number of runfolders), reads (files to read, tool/run
+                                          type file requests and requests served by a shared read), run types whose
+                                          PDFs deferred by the previous run's time budget would be archived, and a plan
+                                          per reported run type (see TrendReport.plan_report), including the new runs
+                                          an email would be sent for and whether it is an alerting run type
+
+    The input roots are scanned and the MultiQC files needed are read (so the report fingerprints can be compared),
+    but no report is built, and nothing is published, archived, recorded or sent.
+    """
+    requests = rebuild_requests.pending_rebuilds(inputs["rebuild_folder"])
+    pdf_requests = rebuild_requests.pending_pdfs(inputs["rebuild_folder"])
+    run_types = inputs["run_types"]
+    if args.force:
+        reason = "all reports republished (--force)"
+    elif args.dev:
+        reason = "development mode"
+    elif check_for_update(inputs["index_file"], inputs["run_frequency"]):
+        reason = "index file updated in the last {} hours".format(inputs["run_frequency"])
+    elif requests:
+        reason = "rebuild requested for ingested runs"
+        run_types = [runtype for runtype in run_types if runtype in requests]
+    elif pdf_requests:
+        reason = None
+        run_types = []
+    else:
+        reason = "nothing to do (index file not updated in the last {} hours, no rebuild or PDF requests)".format(
+            inputs["run_frequency"])
+        run_types = []
+    if pdf_requests:
+        # PDFs deferred by the previous run are archived by any run with work to do (see run_report_types)
+        pdf_reason = "PDFs deferred by the time budget archived for {}".format(", ".join(pdf_requests))
+        reason = "{}, {}".format(reason, pdf_reason) if reason else pdf_reason
+    run_types = report_scheduler.prioritise(run_types, ALERTING_RUN_TYPES)
+    runfolders = input_roots.scan_runfolders(inputs["input_folder"])
+    read_plan = ReadPlanner(inputs["input_folder"], inputs["mmap_min_bytes"], inputs["io_concurrency"])
+    reports = []
+    try:
+        read_plan.build_plan(run_types, inputs["plot_order"], runfolders=runfolders)
+        read_plan.execute()
+        for runtype in run_types:
+            trend_report = TrendReport(input_folder=inputs["input_folder"], output_folder=inputs["output_folder"],
+                                       images_folder=inputs["images_folder"], runtype=runtype, panel_dict=panel_dict,
+                                       template_dir=inputs["template_dir"], archive_folder=inputs["archive_folder"],
+                                       logopath=inputs["logopath"], plot_order=inputs["plot_order"],
+                                       wkhtmltopdf_path=inputs["wkhtmltopdf_path"], read_plan=read_plan,
+                                       force=args.force)
+            trend_report.runfolders = runfolders
+            report = trend_report.plan_report(inspect.getmembers(trend_report, predicate=inspect.ismethod))
+            email = Emails(input_folder=inputs["input_folder"], runtype=runtype, wes_email=inputs["wes_email"],
+                           oncology_ops_email=inputs["oncology_ops_email"],
+                           custom_panels_email=inputs["custom_panels_email"], mokaguys_email=inputs["mokaguys_email"],
+                           email_subject=inputs["email_subject"], email_message=inputs["email_message"],
+                           hyperlink=inputs["reports_hyperlink"])
+            email.runfolders = runfolders
+            report["new_runs"] = email.check_sent(report["runs"])
+            report["alerting"] = runtype in ALERTING_RUN_TYPES
+            report["email"] = bool(report["new_runs"]) and report["alerting"]
+            reports.append(report)
+    finally:
+        read_plan.close()
+    return OrderedDict([("reason", reason), ("distributed", inputs["distributed"]),
+                        ("budget_seconds", inputs["tick_budget_seconds"]),
+                        ("scan", OrderedDict([("runfolders", len(runfolders))])),
+                        ("reads", OrderedDict([("files", len(read_plan.plan)), ("requests", read_plan.requests),
+                                               ("cache_hits", read_plan.requests - len(read_plan.plan))])),
+                        ("deferred_pdfs", OrderedDict([("run_types", list(pdf_requests))])),
+                        ("reports", reports)])
+
+
+def run_coalesced(args, inputs, lock, tool_medians):
+    """
+    Run, then run again while reruns were requested (by invocations started during the run) and runfolders have been
+    ingested, or new runfolders have arrived in the input folder, since the previous run started.
+        :param args:            (Namespace object) parsed command line attributes
+        :param inputs:          (OrderedDict) Dictionary with config setting name as key and setting as value
+        :param lock:            (RunLock) run lock held by this instance
+        :param tool_medians:    (dict) populated with run type as key, TrendReport.tool_medians as value
+    """
+    force_update = False
+    # The input roots are scanned once per run, once the run has work to do (so an idle run lists nothing), and the
+    # run inventory shared by every report, read and email of the run. A rerun is made from the inventory scanned to
+    # look for new runfolders
+    runfolders = None
+    while True:
+        runfolders = run(args, inputs, tool_medians, force_update, runfolders)
+        if not lock.take_rerun_request():
+            break
+        if runfolders is None:
+            # the run had nothing to do, so there is no inventory to compare with. Run again as a new run would
+            print("rerun requested, running again")
+            profiling.run_log.increment("reruns")
+            continue
+        rescanned = scan_inventory(inputs)
+        if rebuild_requests.pending_rebuilds(inputs["rebuild_folder"]):
+            # runfolders were ingested during the run. Only the reports of their run types are rebuilt
+            print("rerun requested and runfolders have been ingested, running again")
+            profiling.run_log.increment("reruns")
+            runfolders = rescanned
+            continue
+        new_runfolders = set(rescanned) - set(runfolders)
+        if not new_runfolders:
+            print("rerun requested, but no new runfolders have arrived")
+            break
+        print("rerun requested and {} new runfolders have arrived, running again".format(len(new_runfolders)))
+        profiling.run_log.increment("reruns")
+        runfolders = rescanned
+        force_update = True
+
+
+def scan_inventory(inputs):
+    """
+    Scan the input roots for the run inventory, printing the time taken to list each root.
+        :param inputs:  (OrderedDict) Dictionary with config setting name as key and setting as value
+        :return:        (OrderedDict) run as key, path to runfolder as value (see input_roots.scan_runfolders)
+    """
+    timings = {}
+    runfolders = input_roots.scan_runfolders(inputs["input_folder"], timings=timings)
+    print(input_roots.describe_timings(timings))
+    return runfolders
+
+
+def run(args, inputs, tool_medians, force_update=False, runfolders=None):
+    """
+    Generate trend reports and send emails for each run type, if required.
+        :param args:            (Namespace object) parsed command line attributes
+        :param inputs:          (OrderedDict) Dictionary with config setting name as key and setting as value
+        :param tool_medians:    (dict) populated with run type as key, TrendReport.tool_medians as value
+        :param force_update:    (bool) generate reports even if the index file has not been updated recently (used
+                                       when rerunning because new runfolders have arrived)
+        :param runfolders:      (OrderedDict or NoneType) run inventory of the run (see scan_inventory), shared by
+                                                          every report, read and email. None to scan the input roots
+                                                          if there is work to do
+        :return:                (OrderedDict or NoneType) run inventory the run was made from, or None if there was
+                                                          nothing to do (and the input roots were not scanned)
+    """
+    panel_dict = get_panel_dict(github_repo="https://github.com/moka-guys/automate_demultiplex",
+                                github_file="automate_demultiplex_config.py",
+                                kit_list=["vcp1_panel_list", "vcp2_panel_list", "vcp3_panel_list"])
+    # Rebuilds requested by ingesting runfolders (see ingest_run) are handled by this run. Requests recorded during
+    # the run are left for the next run
+    requests = rebuild_requests.pending_rebuilds(inputs["rebuild_folder"])
     # If (run in dev mode), or (run in prod mode AND index file has been updates since last run (denoting new run uploaded)):
+    update = args.dev or args.force or force_update or check_for_update(inputs["index_file"], inputs["run_frequency"])
+    if not update and not requests and not rebuild_requests.pending_pdfs(inputs["rebuild_folder"]):
+        return None
+    if not update:
+        # only the reports of run types with newly ingested runs (or deferred by the previous run) are rebuilt
+        inputs = dict(inputs, run_types=[runtype for runtype in inputs["run_types"] if runtype in requests])
+        print("rebuilding reports of ingested runs: {}".format(", ".join(inputs["run_types"])))
+    # alerting run types are read and reported first
+    inputs = dict(inputs, run_types=report_scheduler.prioritise(inputs["run_types"], ALERTING_RUN_TYPES))
+    if runfolders is None:
+        runfolders = scan_inventory(inputs)
+    if inputs["distributed"]:
+        # Report and PDF jobs are run by workers on any node mounting queue_folder, as well as by this instance
+        run_distributed(inputs, panel_dict, tool_medians, args.force, runfolders)
+    else:
+        # Read each MultiQC file needed by any run type once, before the per run type reports are built
+        # Runfolder listings and file reads run concurrently, and reports wait only for the files they need
+        # With a memory budget, files are planned and read per run type instead (see run_report_types)
+        read_plan = ReadPlanner(inputs["input_folder"], inputs["mmap_min_bytes"], inputs["io_concurrency"])
+        if not inputs["memory_budget_mb"]:
+            read_plan.build_plan(inputs["run_types"], inputs["plot_order"], runfolders=runfolders)
+            read_plan.execute()
+        try:
+            run_reports(inputs, panel_dict, read_plan, tool_medians, args.force, runfolders)
+        finally:
+            read_plan.close()
+        profiling.run_log.increment("reads_saved", read_plan.requests - len(read_plan.plan))
+        print(read_plan.report())
+    rebuild_requests.clear_requests(requests)
+    return runfolders
+
+
+def run_reports(inputs, panel_dict, read_plan, tool_medians, force=False, runfolders=None):
+    """
+    Generate the trend report and send emails for each run type.
+        :param inputs:          (OrderedDict) Dictionary with config setting name as key and setting as value
+        :param panel_dict:      (OrderedDict) Dictionary of capture kit panel lists
+        :param read_plan:       (ReadPlanner) MultiQC data read once for all run types
+        :param tool_medians:    (dict) populated with run type as key, TrendReport.tool_medians as value
+        :param force:           (bool) republish reports even if their content is unchanged
+        :param runfolders:      (OrderedDict or NoneType) run inventory of the run, or None to scan the input roots
+    """
+    write_htaccess(inputs["output_folder"], inputs["serve_port"])
+    if runfolders is None:
+        runfolders = input_roots.scan_runfolders(inputs["input_folder"])
+    store = metrics_store.MetricsStore(inputs["metrics_db"])
+    try:
+        run_report_types(inputs, panel_dict, read_plan, tool_medians, force, store, runfolders)
+    finally:
+        store.close()
+
+
+def run_report_types(inputs, panel_dict, read_plan, tool_medians, force, store, runfolders):
+    """
+    Generate the trend report and send emails for each run type, recording measurements in the metrics store.
+        :param inputs:          (OrderedDict) Dictionary with config setting name as key and setting as value
+        :param panel_dict:      (OrderedDict) Dictionary of capture kit panel lists
+        :param read_plan:       (ReadPlanner) MultiQC data read once for all run types
+        :param tool_medians:    (dict) populated with run type as key, TrendReport.tool_medians as value
+        :param force:           (bool) republish reports even if their content is unchanged
+        :param store:           (MetricsStore) store the parsed measurements are recorded in
+        :param runfolders:      (OrderedDict) run inventory every report, read and email of the run is built from
+    """
     # 1. Create instance of TrendReport class, retrieve methods of TrendReport class, then call call_tools (member
     # function of TrendReport instance) to generate the trend report
     # 2. Create instance of Emails class, then call call_tools (member function of Emails instance) to send emails
-    if args.dev or check_for_update(inputs["index_file"],inputs["run_frequency"]):
-        for runtype in inputs["run_types"]:
+    # Alerting run types are reported and emailed first. PDFs (including those deferred by the previous run) are
+    # archived once they are done, alongside the remaining reports. With a time budget, remaining non-alerting reports
+    # and PDFs are deferred to the next run once it is spent (see report_scheduler.py)
+    # With a memory budget, run type files are planned and read one run type at a time, and cached data is dropped
+    # before a run type if the budget has been exceeded
+    memory_budget = inputs["memory_budget_mb"] * 1024 * 1024
+    scheduler = report_scheduler.TickScheduler(ALERTING_RUN_TYPES, inputs["tick_budget_seconds"],
+                                               inputs["pdf_concurrency"])
+    pdf_requests = rebuild_requests.pending_pdfs(inputs["rebuild_folder"])
+    try:
+        for runtype in pdf_requests:
+            scheduler.queue_pdf(runtype, lambda runtype=runtype: archive_published_pdf(runtype, inputs))
+        for runtype in scheduler.order(inputs["run_types"]):
+            if not scheduler.start_report(runtype):
+                continue
+            if memory_budget:
+                if profiling.rss_bytes() > memory_budget:
+                    release_memory(read_plan)
+                read_plan.build_plan([runtype], inputs["plot_order"], runfolders=runfolders)
+                read_plan.execute()
             trend_report = TrendReport(input_folder=inputs["input_folder"], output_folder=inputs["output_folder"],
                                        images_folder=inputs["images_folder"], runtype=runtype, panel_dict=panel_dict,
                                        template_dir=inputs["template_dir"], archive_folder=inputs["archive_folder"],
                                        logopath=inputs["logopath"], plot_order=inputs["plot_order"],
-                                       wkhtmltopdf_path=inputs["wkhtmltopdf_path"])
+                                       wkhtmltopdf_path=inputs["wkhtmltopdf_path"], read_plan=read_plan, force=force,
+                                       metrics_store=store, archive=False)
+            trend_report.runfolders = runfolders
             methods = inspect.getmembers(trend_report, predicate=inspect.ismethod)
             trend_report.call_tools(methods)
+            tool_medians[runtype] = trend_report.tool_medians
+            if trend_report.published:
+                scheduler.queue_pdf(runtype, trend_report.archive_pdf)
             email = Emails(input_folder=inputs["input_folder"], runtype=runtype, wes_email=inputs["wes_email"],
                            oncology_ops_email=inputs["oncology_ops_email"],
                            custom_panels_email=inputs["custom_panels_email"], mokaguys_email=inputs["mokaguys_email"],
                            email_subject=inputs["email_subject"], email_message=inputs["email_message"],
-                           hyperlink=inputs["reports_hyperlink"])
+                           hyperlink=inputs["reports_hyperlink"], outliers=trend_report.outliers)
+            email.runfolders = runfolders
+            email.call_tools()
+        archived = scheduler.finish()
+    finally:
+        scheduler.close()
+    if archived:
+        write_archive_index(inputs["output_folder"], inputs["archive_folder"])
+    rebuild_requests.clear_requests(pdf_requests)
+    for work, runtype in scheduler.deferred:
+        if work == "report":
+            rebuild_requests.request_rebuild(inputs["rebuild_folder"], runtype,
+                                             "deferred_" + datetime.datetime.now().strftime('%y%m%d_%H_%M_%S'),
+                                             reason="(report deferred by the time budget)")
+        else:
+            rebuild_requests.request_pdf(inputs["rebuild_folder"], runtype)
+
+
+def archive_published_pdf(runtype, inputs):
+    """
+    Archive the PDF of a run type's published report (for PDFs deferred by the previous run).
+        :param runtype: (str) run type from list of run_types defined in config
+        :param inputs:  (OrderedDict) Dictionary with config setting name as key and setting as value
+    """
+    trend_report = TrendReport(input_folder=inputs["input_folder"], output_folder=inputs["output_folder"],
+                               images_folder=inputs["images_folder"], runtype=runtype, panel_dict=None,
+                               template_dir=inputs["template_dir"], archive_folder=inputs["archive_folder"],
+                               logopath=inputs["logopath"], plot_order=inputs["plot_order"],
+                               wkhtmltopdf_path=inputs["wkhtmltopdf_path"], archive=False)
+    if os.path.isfile(trend_report.report_path()):
+        trend_report.archive_pdf()
+
+
+def release_memory(read_plan):
+    """
+    Drop cached data to bring memory use back within the memory budget: file data held by the read plan, cached
+    runfolder classifications, idle figures in the figure pool and any open matplotlib figures.
+        :param read_plan:   (ReadPlanner) MultiQC data read for the run types reported so far
+    """
+    rss_before = profiling.rss_bytes()
+    read_plan.release()
+    _run_classifications.clear()
+    _classified_runs_cache.clear()
+    _figure_pool.clear()
+    plt.close("all")
+    gc.collect()
+    profiling.run_log.increment("memory_releases")
+    print("memory budget exceeded ({:.1f} MB), cached data dropped ({:.1f} MB after)".format(
+        rss_before / 1e6, profiling.rss_bytes() / 1e6))
+
+
+def run_distributed(inputs, panel_dict, tool_medians, force=False, runfolders=None):
+    """
+    Coordinate generation of the trend reports by workers sharing queue_folder (config), then update
+    archive_index.html, record measurements in the metrics store and send emails for each run type.
+        :param inputs:          (OrderedDict) Dictionary with config setting name as key and setting as value
+        :param panel_dict:      (OrderedDict) Dictionary of capture kit panel lists
+        :param tool_medians:    (dict) populated with run type as key, TrendReport.tool_medians as value
+        :param force:           (bool) republish reports even if their content is unchanged
+        :param runfolders:      (OrderedDict or NoneType) run inventory the emails are sent from, or None to scan the
+                                                          input roots (report jobs scan the roots on their own node)
+
+    A batch of jobs is published: a report job per run type (parse MultiQC data, plot and publish the html), then a PDF
+    job per run type depending on its report job. The PDF jobs are queued after every report job, so reports are
+    published first. This instance runs jobs alongside the workers until the batch is finished. Emails are sent for
+    every run type whose report was generated. If any job failed, a RuntimeError listing the failures is raised once
+    the rest of the batch is finished.
+    """
+    if runfolders is None:
+        runfolders = input_roots.scan_runfolders(inputs["input_folder"])
+    write_htaccess(inputs["output_folder"], inputs["serve_port"])
+    jobs = [{"id": runtype + "_report", "stage": "report", "runtype": runtype, "force": force,
+             "panel_dict": panel_dict, "depends_on": []} for runtype in inputs["run_types"]]
+    jobs.extend({"id": runtype + "_pdf", "stage": "pdf", "runtype": runtype, "depends_on": [runtype + "_report"]}
+                for runtype in inputs["run_types"])
+    batch_folder = job_queue.publish(inputs["queue_folder"], jobs)
+    print("published {} jobs to {}".format(len(jobs), batch_folder))
+    coordinator = job_queue.Worker(inputs["queue_folder"], inputs["lease_timeout"], inputs["heartbeat_interval"],
+                                   inputs["queue_poll_interval"])
+    with profiling.run_log.span("distributed_jobs"):
+        coordinator.work(lambda job, dependency_results: run_job(job, dependency_results, inputs), batch_folder)
+    results, failures, _ = job_queue.batch_status(batch_folder)
+    job_queue.remove_batch(batch_folder)
+    print("{} jobs finished, {} run by this instance, {} failed".format(len(results) + len(failures),
+                                                                       coordinator.jobs_run, len(failures)))
+    if any(result["archived"] for job_id, result in results.items() if job_id.endswith("_pdf")):
+        write_archive_index(inputs["output_folder"], inputs["archive_folder"])
+    store = metrics_store.MetricsStore(inputs["metrics_db"])
+    try:
+        for runtype in inputs["run_types"]:
+            result = results.get(runtype + "_report")
+            if result is None:
+                continue
+            tool_medians[runtype] = result["tool_medians"]
+            if result["published"]:
+                # unchanged reports were recorded when they were last published
+                with open(trend_export.export_paths(inputs["output_folder"], runtype)["jsonl"]) as export_file:
+                    store.record(json.loads(line) for line in export_file)
+            email = Emails(input_folder=inputs["input_folder"], runtype=runtype, wes_email=inputs["wes_email"],
+                           oncology_ops_email=inputs["oncology_ops_email"],
+                           custom_panels_email=inputs["custom_panels_email"], mokaguys_email=inputs["mokaguys_email"],
+                           email_subject=inputs["email_subject"], email_message=inputs["email_message"],
+                           hyperlink=inputs["reports_hyperlink"], outliers=result["outliers"])
+            email.runfolders = runfolders
             email.call_tools()
+    finally:
+        store.close()
+    if failures:
+        profiling.run_log.increment("jobs_failed", len(failures))
+        raise RuntimeError("distributed jobs failed:\n" + "\n".join(
+            "{}: {}".format(job_id, error) for job_id, error in sorted(failures.items())))
+
+
+def run_job(job, dependency_results, inputs):
+    """
+    Run a distributed report or PDF job (see run_distributed).
+        :param job:                 (dict) job: id, stage (report or pdf) and runtype (and force and panel_dict for
+                                           report jobs)
+        :param dependency_results:  (dict) job id as key, result of each job the job depends on as value
+        :param inputs:              (OrderedDict) Dictionary with config setting name as key and setting as value
+        :return:                    (dict) report jobs: published (bool), tool_medians and outliers. PDF jobs: archived
+                                           (bool) - PDFs are only archived for republished reports
+
+    Report jobs read the MultiQC files of their run type through a read plan of their own (the read plan is not shared
+    between nodes).
+    """
+    runtype = job["runtype"]
+    trend_report = TrendReport(input_folder=inputs["input_folder"], output_folder=inputs["output_folder"],
+                               images_folder=inputs["images_folder"], runtype=runtype,
+                               panel_dict=job.get("panel_dict"), template_dir=inputs["template_dir"],
+                               archive_folder=inputs["archive_folder"], logopath=inputs["logopath"],
+                               plot_order=inputs["plot_order"], wkhtmltopdf_path=inputs["wkhtmltopdf_path"],
+                               force=job.get("force", False), archive=False)
+    if job["stage"] == "pdf":
+        if not dependency_results[runtype + "_report"]["published"]:
+            return {"archived": False}
+        trend_report.archive_pdf()
+        return {"archived": True}
+    trend_report.read_plan = ReadPlanner(inputs["input_folder"], inputs["mmap_min_bytes"], inputs["io_concurrency"])
+    try:
+        trend_report.read_plan.build_plan([runtype], inputs["plot_order"])
+        trend_report.read_plan.execute()
+        trend_report.call_tools(inspect.getmembers(trend_report, predicate=inspect.ismethod))
+    finally:
+        trend_report.read_plan.close()
+    return {"published": trend_report.published, "tool_medians": trend_report.tool_medians,
+            "outliers": trend_report.outliers}
+
+
+def worker(inputs):
+    """
+    Run as a distributed mode worker, claiming and running jobs from queue_folder (config) until interrupted.
+        :param inputs:  (OrderedDict) Dictionary with config setting name as key and setting as value
+
+    Each job is recorded in a new run log (a worker runs indefinitely, so a single run log would grow without bound),
+    written to run_log_folder (config) named after the job once it is finished, and its wall time printed.
+    """
+    def timed_job(job, dependency_results):
+        profiling.run_log = profiling.RunLog()
+        try:
+            with profiling.run_log.span(job["stage"], runtype=job["runtype"]) as span:
+                result = run_job(job, dependency_results, inputs)
+        finally:
+            write_run_log(inputs, job["id"])
+        print("{} job run in {:.2f}s".format(job["id"], span["wall"]))
+        return result
+
+    job_worker = job_queue.Worker(inputs["queue_folder"], inputs["lease_timeout"], inputs["heartbeat_interval"],
+                                  inputs["queue_poll_interval"])
+    print("worker {} waiting for jobs in {}".format(job_worker.worker_id, inputs["queue_folder"]))
+    try:
+        job_worker.work(timed_job)
+    except KeyboardInterrupt:
+        print("worker {} stopped after {} jobs".format(job_worker.worker_id, job_worker.jobs_run))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,111 @@
+"""
+Report rebuild requests recorded by ingestion (read_qc_files.py ingest).
+
+When a runfolder is ingested, a request marker file is written to rebuild_folder for each run type the run is
+classified into ({runtype}.{run}.request). The next report run rebuilds only the reports of run types with pending
+requests (unless the index file has been updated, when every report is checked), then clears the requests it has
+handled. Requests recorded while a report run is in progress are left for the next run, so no ingested run is missed.
+Marker files are written atomically (see atomic_write.py), so a report run never sees a partial request.
+
+Work deferred by a report run's time budget (see report_scheduler.py) is recorded the same way: a rebuild request for
+each deferred report, and a PDF request ({runtype}.{timestamp}.pdf_request) for each report published without its
+PDF being archived. The next run archives the requested PDFs of the published reports, even if no report is rebuilt.
+"""
+import datetime
+import os
+from collections import OrderedDict
+import atomic_write
+
+REQUEST_SUFFIX = ".request"
+PDF_REQUEST_SUFFIX = ".pdf_request"
+
+
+def write_marker(rebuild_folder, marker_name, text):
+    """
+    Write a request marker file.
+        :param rebuild_folder:  (str) path to the rebuild request folder (created if it does not exist)
+        :param marker_name:     (str) name of the marker file
+        :param text:            (str) description of the request, written to the marker file
+        :return:                (str) path to the marker file
+    """
+    if not os.path.isdir(rebuild_folder):
+        os.makedirs(rebuild_folder)
+    request_path = os.path.join(rebuild_folder, marker_name)
+    atomic_write.write_atomic(request_path, "{}: {}\n".format(datetime.datetime.now().strftime('%d-%B-%Y %H:%M'),
+                                                              text))
+    return request_path
+
+
+def pending_markers(rebuild_folder, suffix):
+    """
+    Return the pending request marker files with a suffix.
+        :param rebuild_folder:  (str) path to the rebuild request folder
+        :param suffix:          (str) marker file suffix (REQUEST_SUFFIX or PDF_REQUEST_SUFFIX)
+        :return:                (OrderedDict) run type as key, list of paths to its marker files as value, sorted by run
+                                              type
+    """
+    try:
+        request_names = sorted(name for name in os.listdir(rebuild_folder) if name.endswith(suffix))
+    except OSError:
+        return OrderedDict({})
+    requests = OrderedDict({})
+    for request_name in request_names:
+        requests.setdefault(request_name.split(".", 1)[0], []).append(os.path.join(rebuild_folder, request_name))
+    return requests
+
+
+def request_rebuild(rebuild_folder, runtype, run, reason="ingested"):
+    """
+    Record a request to rebuild a run type's report, following ingestion of a run (or deferral of the report).
+        :param rebuild_folder:  (str) path to the rebuild request folder (created if it does not exist)
+        :param runtype:         (str) run type whose report should be rebuilt
+        :param run:             (str) ingested runfolder name (or other unique name of the request)
+        :param reason:          (str) reason for the request, written to the marker file
+        :return:                (str) path to the request marker file
+    """
+    return write_marker(rebuild_folder, "{}.{}{}".format(runtype, run, REQUEST_SUFFIX), "{} {}".format(run, reason))
+
+
+def pending_rebuilds(rebuild_folder):
+    """
+    Return the pending rebuild requests.
+        :param rebuild_folder:  (str) path to the rebuild request folder
+        :return:                (OrderedDict) run type as key, list of paths to its request marker files as value, sorted
+                                              by run type
+    """
+    return pending_markers(rebuild_folder, REQUEST_SUFFIX)
+
+
+def request_pdf(rebuild_folder, runtype):
+    """
+    Record a request to archive the PDF of a run type's published report, deferred by a report run's time budget.
+        :param rebuild_folder:  (str) path to the rebuild request folder (created if it does not exist)
+        :param runtype:         (str) run type whose published report should be archived
+        :return:                (str) path to the request marker file
+    """
+    return write_marker(rebuild_folder, "{}.{}{}".format(runtype, datetime.datetime.now().strftime('%y%m%d_%H_%M_%S'),
+                                                         PDF_REQUEST_SUFFIX), "PDF archival deferred")
+
+
+def pending_pdfs(rebuild_folder):
+    """
+    Return the pending PDF requests.
+        :param rebuild_folder:  (str) path to the rebuild request folder
+        :return:                (OrderedDict) run type as key, list of paths to its PDF request marker files as value,
+                                              sorted by run type
+    """
+    return pending_markers(rebuild_folder, PDF_REQUEST_SUFFIX)
+
+
+def clear_requests(requests):
+    """
+    Remove handled rebuild (or PDF) requests.
+        :param requests:    (dict) run type as key, list of paths to request marker files as value (see
+                                   pending_rebuilds and pending_pdfs)
+    """
+    for request_paths in requests.values():
+        for request_path in request_paths:
+            try:
+                os.remove(request_path)
+            except OSError:
+                pass
@@ -0,0 +1,154 @@
+"""
+Priority scheduling of the work of a report run (tick).
+
+Emails are only sent for the alerting run types (WES, CUSTOM_PANELS and SWIFT, see Emails.send_email), so a slow report
+of another run type listed earlier in run_types would delay the alert. A TickScheduler orders the work of a tick:
+    1. The reports of the alerting run types are built (parse, plot and publish the html) and their emails sent, first
+       and in order. Their MultiQC files are also planned and read first (files are read in run type order).
+    2. PDF archival is deferred until the alerting run types are done. PDFs are then archived in a thread pool
+       (wkhtmltopdf runs as a separate process), alongside the reports of the remaining run types.
+With a time budget, work that has not started once the budget is spent rolls to the next tick: the remaining
+non-alerting reports and PDFs are recorded as deferred, and read_qc_files.py records a rebuild or PDF request for each
+(see rebuild_requests.py). Alerting reports and emails are never deferred.
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import profiling
+
+
+def prioritise(run_types, alerting_run_types):
+    """
+    Order run types by priority: the alerting run types first, then the others (each in their configured order).
+        :param run_types:           (list) run types to be reported
+        :param alerting_run_types:  (list) run types whose reports trigger emails
+        :return:                    (list) run types in the order their reports are built
+    """
+    return [runtype for runtype in run_types if runtype in alerting_run_types] + \
+        [runtype for runtype in run_types if runtype not in alerting_run_types]
+
+
+class TickScheduler(object):
+    """
+    A class ordering the reports and PDFs of a tick by priority, and deferring low-priority work to the next tick once
+    the tick's time budget is spent.
+
+    Attributes:
+        alerting_run_types  (list) run types whose reports trigger emails, built first and never deferred
+        budget              (float) seconds after the start of the tick after which low-priority work is deferred, or 0
+                                    for no budget
+        started             (float) time the tick started (time.time())
+        pool                (ThreadPoolExecutor) thread pool PDFs are archived in
+        pdfs                (OrderedDict) run type as key, function archiving its PDF as value, for PDFs queued until
+                                          the alerting run types are done
+        futures             (list) futures of whether each started PDF was archived
+        pdfs_released       (bool) True once the alerting run types are done, and PDFs are archived as queued
+        deferred            (list) (work, run type) of the work deferred to the next tick, where work is report or pdf
+        lock                (Lock) guards deferred, as PDFs are deferred from the thread pool
+    """
+
+    def __init__(self, alerting_run_types, budget=0, pdf_concurrency=1):
+        """
+        The constructor for TickScheduler class
+        """
+        self.alerting_run_types = alerting_run_types
+        self.budget = budget
+        self.started = time.time()
+        self.pool = ThreadPoolExecutor(max_workers=pdf_concurrency)
+        self.pdfs = OrderedDict({})
+        self.futures = []
+        self.pdfs_released = False
+        self.deferred = []
+        self.lock = threading.Lock()
+
+    def order(self, run_types):
+        """
+        Order run types by priority (see prioritise).
+            :param run_types:   (list) run types to be reported
+            :return:            (list) run types in the order their reports are built
+        """
+        return prioritise(run_types, self.alerting_run_types)
+
+    def out_of_time(self):
+        """
+        Return whether the tick's time budget has been spent.
+            :return:    (bool) True if there is a budget and it has been spent
+        """
+        return bool(self.budget) and time.time() - self.started >= self.budget
+
+    def defer(self, work, runtype):
+        """
+        Record work deferred to the next tick.
+            :param work:        (str) report or pdf
+            :param runtype:     (str) run type the work is for
+        """
+        with self.lock:
+            self.deferred.append((work, runtype))
+        print("time budget of {}s spent, {} {} deferred to the next run".format(self.budget, runtype, work))
+        profiling.run_log.increment("work_deferred", runtype=runtype)
+
+    def start_report(self, runtype):
+        """
+        Decide whether to build a run type's report now. Once the alerting run types are done, queued PDFs are
+        released to the thread pool. A non-alerting report is deferred if the time budget has been spent.
+            :param runtype:     (str) run type whose report is next (in the order returned by order)
+            :return:            (bool) True if the report should be built now, False if it has been deferred
+        """
+        if runtype in self.alerting_run_types:
+            return True
+        self.release_pdfs()
+        if self.out_of_time():
+            self.defer("report", runtype)
+            return False
+        return True
+
+    def queue_pdf(self, runtype, archive_pdf):
+        """
+        Queue the archival of a run type's PDF, replacing any PDF queued but not yet started for the run type (e.g. a PDF
+        deferred by the previous tick, of a report since republished). PDFs are started once the alerting run types are
+        done.
+            :param runtype:     (str) run type of the report
+            :param archive_pdf: (function) archives the PDF of the run type's published report
+        """
+        if self.pdfs_released:
+            self.futures.append(self.pool.submit(self.archive, runtype, archive_pdf))
+        else:
+            self.pdfs[runtype] = archive_pdf
+
+    def release_pdfs(self):
+        """
+        Start archiving the queued PDFs in the thread pool (called once the alerting run types are done).
+        """
+        if not self.pdfs_released:
+            self.pdfs_released = True
+            for runtype, archive_pdf in self.pdfs.items():
+                self.futures.append(self.pool.submit(self.archive, runtype, archive_pdf))
+            self.pdfs = OrderedDict({})
+
+    def archive(self, runtype, archive_pdf):
+        """
+        Archive a PDF, unless the time budget has been spent (run in the thread pool).
+            :param runtype:     (str) run type of the report
+            :param archive_pdf: (function) archives the PDF of the run type's published report
+            :return:            (bool) True if the PDF was archived, False if it was deferred
+        """
+        if self.out_of_time():
+            self.defer("pdf", runtype)
+            return False
+        archive_pdf()
+        return True
+
+    def finish(self):
+        """
+        Archive any PDFs still queued and wait for all PDFs to finish.
+            :return:    (bool) True if any PDF was archived
+        """
+        self.release_pdfs()
+        return any([future.result() for future in self.futures])
+
+    def close(self):
+        """
+        Shut down the thread pool, waiting for PDFs already started.
+        """
+        self.pool.shutdown(wait=True)
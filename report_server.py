@@ -0,0 +1,286 @@
+"""
+On-demand trend report server (read_qc_files.py serve).
+
+Rather than pre-rendering every run type's report on each tick, reports are rendered when requested and kept in an
+in-memory LRU cache of rendered html and plot images. Each cached report is tagged with the run inventory (the
+runfolders in the input roots, see input_roots.py) and the template version it was rendered from, and is re-rendered
+when either changes. Reports are served with an ETag derived from the inventory, the report requested and the template
+version, so a browser revalidating an unchanged report gets a 304 response without the report being rendered again.
+
+Reports are requested as {runtype}_trend_report.html (the published report names), or using the runtype query
+parameter, with an optional window query parameter (number of most recent runs to include, e.g.
+WES_trend_report.html?window=20). Archived report PDFs are served at archive/{report name}, including those bundled by
+archive maintenance (see archive_maintenance.py). Requests are handled one at a time, as matplotlib's pyplot interface
+is not thread-safe.
+"""
+import gzip
+import hashlib
+import io
+import os
+from collections import OrderedDict
+import archive_maintenance
+import input_roots
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import urlparse, parse_qs
+
+REPORT_SUFFIX = "_trend_report.html"
+
+
+def run_inventory(input_folder):
+    """
+    Return a token identifying the runfolders in the input roots, which changes whenever a runfolder arrives, is
+    removed, or is taken from a different root.
+        :param input_folder:    (str or list) path to MultiQC data per run, or list of paths
+        :return:                (str) digest of the sorted runfolder names and paths
+    """
+    return hashlib.sha1("\n".join("{}\t{}".format(run, path) for run, path in input_roots.scan_runfolders(
+        input_folder).items()).encode("utf-8")).hexdigest()
+
+
+def report_etag(key, inventory, version):
+    """
+    Return the ETag of a report. A report is rendered from the runfolders in the inventory using the report templates,
+    so is unchanged while these are unchanged (the rendering timestamp aside).
+        :param key:         (tuple) run type and window (number of runs, or None for the default) of the report
+        :param inventory:   (str) run inventory token (see run_inventory)
+        :param version:     (str) template version (see read_qc_files.template_version)
+        :return:            (str) quoted ETag
+    """
+    return '"{}"'.format(hashlib.sha1("{}\n{}\n{}\n{}".format(key[0], key[1], inventory, version).encode(
+        "utf-8")).hexdigest())
+
+
+def gzip_bytes(data):
+    """
+    Return gzip-compressed data (with a fixed mtime, so compressing the same data always gives the same bytes).
+        :param data:    (bytes) data to compress
+        :return:        (bytes) compressed data
+    """
+    compressed = io.BytesIO()
+    with gzip.GzipFile("", "wb", 9, compressed, mtime=0) as gzip_file:
+        gzip_file.write(data)
+    return compressed.getvalue()
+
+
+class RenderCache(object):
+    """
+    A class holding rendered reports in a least recently used cache, each tagged with the run inventory and template
+    version it was rendered from.
+
+    Attributes:
+        render          (function) called with run type and window, returns (html bytes, dictionary of image name:
+                                   image bytes)
+        max_entries     (int) maximum number of reports held. The least recently used report is evicted first
+        entries         (OrderedDict) (run type, window) as key, dictionary of inventory, version, html, html_gz and
+                                      images as value, least recently used first
+        renders         (int) number of reports rendered
+        hits            (int) number of requests served from the cache
+    """
+
+    def __init__(self, render, max_entries):
+        """
+        The constructor for RenderCache class
+        """
+        self.render = render
+        self.max_entries = max_entries
+        self.entries = OrderedDict({})
+        self.renders = 0
+        self.hits = 0
+
+    def get(self, key, inventory, version=None):
+        """
+        Return a rendered report, rendering it if it is not cached or was rendered from a different run inventory or
+        template version.
+            :param key:         (tuple) run type and window of the report
+            :param inventory:   (str) current run inventory token (see run_inventory)
+            :param version:     (str) current template version (see read_qc_files.template_version)
+            :return:            (dict) inventory, version, html, html_gz (gzip-compressed html) and images (image name
+                                       as key, image bytes as value)
+        """
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry["inventory"] == inventory and entry["version"] == version:
+            self.hits += 1
+        else:
+            html, images = self.render(*key)
+            self.renders += 1
+            entry = {"inventory": inventory, "version": version, "html": html, "html_gz": gzip_bytes(html),
+                     "images": images}
+        self.entries[key] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
+
+    def image(self, image_name):
+        """
+        Return a plot image of a cached report. Image names are content-hashed, so any cached copy is current.
+            :param image_name:  (str) image file name
+            :return:            (bytes or NoneType) image, or None if not held by any cached report
+        """
+        for entry in self.entries.values():
+            if image_name in entry["images"]:
+                return entry["images"][image_name]
+        return None
+
+
+class ReportServer(HTTPServer):
+    """
+    An HTTP server rendering trend reports on demand.
+
+    Attributes:
+        cache           (RenderCache) rendered reports
+        input_folder    (str or list) path to MultiQC data per run, or list of paths
+        images_folder   (str) path to viapath logo (static images not rendered with a report are served from here)
+        archive_folder  (str) path to archived report PDFs
+        run_types       (list) run types that can be requested
+        version         (function) returns the current template version (see read_qc_files.template_version)
+    """
+
+    def __init__(self, address, cache, input_folder, images_folder, archive_folder, run_types, version):
+        """
+        The constructor for ReportServer class
+        """
+        HTTPServer.__init__(self, address, ReportRequestHandler)
+        self.cache = cache
+        self.input_folder = input_folder
+        self.images_folder = images_folder
+        self.archive_folder = archive_folder
+        self.run_types = run_types
+        self.version = version
+
+
+class ReportRequestHandler(BaseHTTPRequestHandler):
+    """
+    A class handling requests to the report server: the index of reports, reports, images and archived reports.
+    """
+
+    def do_GET(self):
+        """
+        Route a GET request to the index, a report, an image or an archived report.
+        """
+        url = urlparse(self.path)
+        parameters = parse_qs(url.query)
+        path = url.path.lstrip("/")
+        if path.startswith("images/"):
+            self.send_image(path[len("images/"):])
+        elif path.startswith("archive/"):
+            self.send_archived_report(path[len("archive/"):])
+        elif path.endswith(REPORT_SUFFIX):
+            self.send_report(path[:-len(REPORT_SUFFIX)], parameters.get("window", [None])[0])
+        elif path in ["", "index.html"] and "runtype" in parameters:
+            self.send_report(parameters["runtype"][0], parameters.get("window", [None])[0])
+        elif path in ["", "index.html"]:
+            self.send_index()
+        else:
+            self.send_error(404, "Not found")
+
+    def send_index(self):
+        """
+        Send a page linking to the report of each run type.
+        """
+        html = '<html><head align="center">TREND ANALYSIS REPORTS</head><body><ul>' + "".join(
+            ['<li><a href="{0}{1}">{0}</a></li>'.format(runtype, REPORT_SUFFIX) for runtype in self.server.run_types]
+        ) + '</ul></body></html>'
+        self.send_body(html.encode("utf-8"), "text/html; charset=utf-8", {"Cache-Control": "no-cache"})
+
+    def send_report(self, runtype, window):
+        """
+        Send a report, or 304 Not Modified if the client's cached copy (If-None-Match) is current.
+            :param runtype:     (str) run type of the report
+            :param window:      (str or NoneType) number of most recent runs to include, or None for the default
+        """
+        if runtype not in self.server.run_types:
+            self.send_error(404, "Unknown run type {}".format(runtype))
+            return
+        if window is not None:
+            if not window.isdigit() or not int(window):
+                self.send_error(400, "window must be a positive number of runs")
+                return
+            window = int(window)
+        key = (runtype, window)
+        inventory = run_inventory(self.server.input_folder)
+        version = self.server.version()
+        headers = {"ETag": report_etag(key, inventory, version), "Cache-Control": "no-cache",
+                   "Vary": "Accept-Encoding"}
+        if headers["ETag"] in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+            self.send_response(304)
+            for header, value in headers.items():
+                self.send_header(header, value)
+            self.end_headers()
+            return
+        entry = self.server.cache.get(key, inventory, version)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+            self.send_body(entry["html_gz"], "text/html; charset=utf-8", headers)
+        else:
+            self.send_body(entry["html"], "text/html; charset=utf-8", headers)
+
+    def send_image(self, image_name):
+        """
+        Send a plot image of a cached report, or a static image (e.g. the logo) from images_folder.
+            :param image_name:  (str) image file name
+        """
+        image = self.server.cache.image(image_name)
+        if image is not None:
+            # content-hashed plot images never change (see TrendReport.publish_image)
+            self.send_body(image, "image/png", {"Cache-Control": "public, max-age=31536000, immutable"})
+            return
+        image_path = os.path.join(self.server.images_folder, os.path.basename(image_name))
+        if image_name != os.path.basename(image_name) or not os.path.isfile(image_path):
+            self.send_error(404, "Not found")
+            return
+        with open(image_path, "rb") as image_file:
+            self.send_body(image_file.read(), "image/png", {"Cache-Control": "public, max-age=86400"})
+
+    def send_archived_report(self, name):
+        """
+        Send an archived report PDF, wherever archive maintenance has stored it.
+            :param name:    (str) report name
+        """
+        report = archive_maintenance.open_report(self.server.archive_folder, name)
+        if report is None:
+            self.send_error(404, "Not found")
+            return
+        # archived reports never change
+        self.send_body(report, "application/pdf", {"Cache-Control": "public, max-age=31536000, immutable"})
+
+    def send_body(self, body, content_type, headers):
+        """
+        Send a 200 response.
+            :param body:            (bytes) response body
+            :param content_type:    (str) Content-Type of the body
+            :param headers:         (dict) additional headers
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(host, port, cache, input_folder, images_folder, archive_folder, run_types, version):
+    """
+    Serve trend reports until interrupted.
+        :param host:            (str) address to listen on
+        :param port:            (int) port to listen on
+        :param cache:           (RenderCache) rendered reports
+        :param input_folder:    (str or list) path to MultiQC data per run, or list of paths
+        :param images_folder:   (str) path to viapath logo
+        :param archive_folder:  (str) path to archived report PDFs
+        :param run_types:       (list) run types that can be requested
+        :param version:         (function) returns the current template version
+    """
+    server = ReportServer((host, port), cache, input_folder, images_folder, archive_folder, run_types, version)
+    print("serving trend reports on http://{}:{}/".format(host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
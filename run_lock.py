@@ -0,0 +1,79 @@
+"""
+Run lock with work coalescing for overlapping cron invocations of read_qc_files.py.
+
+Only one instance holds the lock (an fcntl lock, released by the operating system if the process dies). An invocation
+that cannot take the lock records a rerun request and exits immediately, rather than redoing the same work and racing
+on the same output files. The running instance checks for a rerun request when it finishes, and runs once more if new
+runfolders have arrived, so any number of overlapping invocations are coalesced into at most one extra run.
+"""
+import datetime
+import fcntl
+import os
+
+
+class RunLock(object):
+    """
+    A class holding an exclusive, non-blocking fcntl lock on a lock file, with a rerun request marker file.
+
+    Attributes:
+        lock_path       (str) path to the lock file
+        rerun_path      (str) path to the rerun request marker (lock_path + ".rerun")
+        lock_file       (file or NoneType) open lock file while the lock is held, else None
+    """
+
+    def __init__(self, lock_path):
+        """
+        The constructor for RunLock class
+        """
+        self.lock_path = lock_path
+        self.rerun_path = lock_path + ".rerun"
+        self.lock_file = None
+
+    def acquire(self, request_rerun=True):
+        """
+        Try to take the lock without waiting. If another instance holds it, record a rerun request.
+            :param request_rerun:   (bool) record a rerun request if another instance holds the lock
+            :return:                (bool) True if the lock was taken, False if another instance holds it
+        """
+        lock_file = open(self.lock_path, "a+")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lock_file.close()
+            if request_rerun:
+                self.request_rerun()
+            return False
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write("{} pid {}\n".format(datetime.datetime.now().strftime('%d-%B-%Y %H:%M'), os.getpid()))
+        lock_file.flush()
+        self.lock_file = lock_file
+        return True
+
+    def request_rerun(self):
+        """
+        Record that a rerun was requested while the lock was held.
+        """
+        with open(self.rerun_path, "a") as rerun_file:
+            rerun_file.write("{} pid {}: rerun requested\n".format(
+                datetime.datetime.now().strftime('%d-%B-%Y %H:%M'), os.getpid()))
+
+    def take_rerun_request(self):
+        """
+        Check for, and clear, a rerun request.
+            :return:    (bool) True if a rerun was requested since the request was last cleared
+        """
+        try:
+            os.remove(self.rerun_path)
+            return True
+        except OSError:
+            return False
+
+    def release(self):
+        """
+        Release the lock (if held).
+        """
+        if self.lock_file is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
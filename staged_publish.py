@@ -0,0 +1,130 @@
+"""
+Staged publishing of trend reports.
+
+A report is built in hidden build folders: one in the output folder (html, pre-compressed html, data exports and
+fingerprint) and one in the images folder (plots). Nothing is written to the published files while the report is
+built, so a report that fails part way leaves the published report untouched. Once the report is complete, publish
+moves it into place with os.rename, which replaces a published file atomically (build folders are created inside the
+folders they publish to, so each rename is within one filesystem):
+    1. Plots are renamed into the images folder. Plot names are content-hashed (see TrendReport.publish_image), so a
+       new plot never replaces an image used by the published html, and is not seen until the new html links to it.
+    2. A list of the published plots is recorded in the images manifest (.{name}_images.json in the output folder).
+    3. The remaining files are renamed into the output folder, the html last but for the fingerprint (the report is
+       switched to the new version by the rename of its html), and the fingerprint (marking the report as published)
+       last of all.
+Images are only removed once they are used by neither the new report nor the previous one, so a reader that loaded
+the previous html just before it was replaced can still fetch its plots. Reports of different run types are built in
+separate build folders, so can be built at the same time.
+"""
+import json
+import os
+import shutil
+import tempfile
+import time
+
+BUILD_PREFIX = ".build_"
+
+
+def remove_stale_builds(folder, name, max_age):
+    """
+    Remove build folders left in a folder by builds that did not finish (e.g. killed processes).
+        :param folder:      (str) path to the folder builds are published to
+        :param name:        (str) name of the report the builds were for
+        :param max_age:     (float) build folders last modified more than this many seconds ago are removed
+    """
+    for build_name in os.listdir(folder):
+        build_folder = os.path.join(folder, build_name)
+        if build_name.startswith("{}{}_".format(BUILD_PREFIX, name)) and \
+                time.time() - os.path.getmtime(build_folder) > max_age:
+            shutil.rmtree(build_folder, ignore_errors=True)
+
+
+class ReportStage(object):
+    """
+    A class staging the files of a report, and publishing them together once the report is complete.
+
+    Attributes:
+        output_folder           (str) path the report html and other files are published to
+        images_folder           (str) path the report plots are published to
+        name                    (str) name of the report (run type)
+        build_folder            (str) path to the hidden folder in output_folder the report files are built in
+        images_build_folder     (str) path to the hidden folder in images_folder the report plots are built in
+        published               (bool) True once the staged files have been published
+    """
+
+    def __init__(self, output_folder, images_folder, name, stale_build_age=86400):
+        """
+        The constructor for ReportStage class
+        """
+        self.output_folder = output_folder
+        self.images_folder = images_folder
+        self.name = name
+        for folder in [output_folder, images_folder]:
+            remove_stale_builds(folder, name, stale_build_age)
+        self.build_folder = tempfile.mkdtemp(prefix="{}{}_".format(BUILD_PREFIX, name), dir=output_folder)
+        self.images_build_folder = tempfile.mkdtemp(prefix="{}{}_".format(BUILD_PREFIX, name), dir=images_folder)
+        self.published = False
+
+    def path(self, file_name):
+        """
+        Return the path to build a report file at.
+            :param file_name:   (str) name of the file once published in output_folder
+            :return:            (str) path in the build folder
+        """
+        return os.path.join(self.build_folder, file_name)
+
+    def image_path(self, image_name):
+        """
+        Return the path to build a plot at.
+            :param image_name:  (str) name of the plot once published in images_folder
+            :return:            (str) path in the images build folder
+        """
+        return os.path.join(self.images_build_folder, image_name)
+
+    def manifest_path(self):
+        """
+        Return the path to the images manifest, listing the plots used by the published report.
+            :return:    (str) output_folder/.{name}_images.json
+        """
+        return os.path.join(self.output_folder, ".{}_images.json".format(self.name))
+
+    def published_images(self):
+        """
+        Return the plots used by the published report.
+            :return:    (list) image names, empty if the report has not been published by a staged build
+        """
+        try:
+            with open(self.manifest_path()) as manifest_file:
+                return json.load(manifest_file)
+        except (IOError, OSError, ValueError):
+            return []
+
+    def publish(self, last=()):
+        """
+        Publish the staged report: plots first, then the images manifest, then the other files.
+            :param last:    (list) names of staged files to publish after the others, in order (e.g. the html, then the
+                                   fingerprint)
+            :return:        (set) names of the plots used by the new or previous report, which must not be removed
+        """
+        previous_images = self.published_images()
+        images = sorted(os.listdir(self.images_build_folder))
+        for image_name in images:
+            os.rename(self.image_path(image_name), os.path.join(self.images_folder, image_name))
+        manifest_name = os.path.basename(self.manifest_path())
+        with open(self.path(manifest_name), "w") as manifest_file:
+            json.dump(images, manifest_file)
+        file_names = [manifest_name] + [file_name for file_name in sorted(os.listdir(self.build_folder))
+                                        if file_name not in last and file_name != manifest_name] + \
+            [file_name for file_name in last if os.path.exists(self.path(file_name))]
+        for file_name in file_names:
+            os.rename(self.path(file_name), os.path.join(self.output_folder, file_name))
+        self.published = True
+        self.discard()
+        return set(previous_images) | set(images)
+
+    def discard(self):
+        """
+        Remove the build folders (and any files not published).
+        """
+        for folder in [self.build_folder, self.images_build_folder]:
+            shutil.rmtree(folder, ignore_errors=True)
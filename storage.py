@@ -0,0 +1,504 @@
+"""
+Storage of the MultiQC data read by trend reports (runfolders in the input roots).
+
+An input root (input_folder in config) may be a local folder, or a prefix in S3-compatible object storage written as
+s3://bucket/prefix (the endpoint of a non-AWS store, e.g. MinIO, is set by s3_endpoint_url in config). Runfolders and
+the files in them are listed and read through the backend of their path, so the rest of the script handles paths to
+both as strings:
+    LocalStorage    lists and reads local (POSIX) paths as before: os.listdir, os.walk, and files read in place
+    S3Storage       lists a runfolder's files in bulk (one paginated prefix listing per runfolder, recording each
+                    object's size and ETag, rather than a round trip per folder as with os.walk on a network mount), and
+                    reads objects through a size-bounded on-disk read-through cache (DiskCache). An object is downloaded
+                    once per version (ETag), after which reads are from local disk; the least recently used objects are
+                    evicted once the cache exceeds storage_cache_mb. Requires boto3
+
+Report outputs (plots, html reports, PDFs and archive_index.html) are served by Apache and published by rename (see
+staged_publish.py), so they stay on local storage.
+"""
+import calendar
+import errno
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+import config
+import profiling
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+S3_SCHEME = "s3://"
+
+
+def split_s3_path(path):
+    """
+    Split an S3 path into its bucket and key.
+        :param path:    (str) s3://bucket/key
+        :return:        (tuple) bucket, key (without leading or trailing /, an empty string for the bucket itself)
+    """
+    bucket, _, key = path[len(S3_SCHEME):].partition("/")
+    return bucket, key.strip("/")
+
+
+class DiskCache(object):
+    """
+    A class caching downloaded files in a local folder, bounded in size. Entries persist across runs, and are evicted
+    least recently used first (by file modification time, updated on each hit).
+
+    Attributes:
+        folder      (str) path to the cache folder
+        max_bytes   (int) size the cached files are kept under (the most recently cached file is never evicted)
+        entries     (OrderedDict) cached file name as key, size (bytes) as value, least recently used first
+        lock        (Lock) guards entries, as files are read from the ReadPlanner thread pool
+    """
+
+    def __init__(self, folder, max_bytes):
+        """
+        The constructor for DiskCache class
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict({})
+        self.lock = threading.Lock()
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        cached = []
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if name.endswith(".tmp"):
+                # a download in progress (e.g. by another worker), or interrupted if over an hour old
+                if time.time() - os.path.getmtime(path) > 3600:
+                    os.remove(path)
+            else:
+                cached.append((os.path.getmtime(path), name, os.path.getsize(path)))
+        for mtime, name, size in sorted(cached):
+            self.entries[name] = size
+
+    def fetch(self, key, download):
+        """
+        Return the local path to a cached file, downloading it first if it is not cached.
+            :param key:         (str) identifies the file's content (e.g. its path and version)
+            :param download:    (function) writes the file to the local path passed to it
+            :return:            (str) path to the cached file
+        """
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        path = os.path.join(self.folder, name)
+        with self.lock:
+            if name in self.entries and os.path.exists(path):
+                self.entries[name] = self.entries.pop(name)
+                os.utime(path, None)
+                profiling.run_log.increment("storage_cache_hits")
+                return path
+        temporary_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+        try:
+            download(temporary_path)
+            os.rename(temporary_path, path)
+        except Exception:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        profiling.run_log.increment("storage_cache_misses")
+        with self.lock:
+            self.entries.pop(name, None)
+            self.entries[name] = os.path.getsize(path)
+            self.evict()
+        return path
+
+    def evict(self):
+        """
+        Remove the least recently used files until the cache is within max_bytes (called holding the lock).
+        """
+        total = sum(self.entries.values())
+        while total > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            total -= size
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError:
+                pass
+            profiling.run_log.increment("storage_cache_evictions")
+
+
+class LocalStorage(object):
+    """
+    A class listing and reading runfolders on local (or network-mounted) storage.
+    """
+
+    def listdir(self, path):
+        """
+        Return the names of the entries in a folder (e.g. the runfolders in an input root).
+            :param path:    (str) path to the folder
+            :return:        (list) entry names
+        """
+        return os.listdir(path)
+
+    def list_files(self, path):
+        """
+        Return paths of all files in a folder (recursively, in os.walk order).
+            :param path:    (str) path to the folder
+            :return:        (list) file paths
+        """
+        file_paths = []
+        for root, dirs, files in os.walk(path):
+            for filename in files:
+                file_paths.append(os.path.join(root, filename))
+        return file_paths
+
+    def getmtime(self, path):
+        """
+        Return the modification time of a file or folder.
+            :param path:    (str) path to the file or folder
+            :return:        (float) seconds since the epoch
+        """
+        return os.path.getmtime(path)
+
+    def getsize(self, path):
+        """
+        Return the size of a file.
+            :param path:    (str) path to the file
+            :return:        (int) size in bytes
+        """
+        return os.path.getsize(path)
+
+    def isdir(self, path):
+        """
+        Return whether a path is a folder.
+            :param path:    (str) path
+            :return:        (bool) True if the path is a folder
+        """
+        return os.path.isdir(path)
+
+    def abspath(self, path):
+        """
+        Return the absolute form of a path.
+            :param path:    (str) path
+            :return:        (str) absolute path
+        """
+        return os.path.abspath(path)
+
+    def local_path(self, path):
+        """
+        Return a local path a file can be opened from (the file itself).
+            :param path:    (str) path to the file
+            :return:        (str) path to the file
+        """
+        return path
+
+    def write_text(self, path, text):
+        """
+        Write a text file.
+            :param path:    (str) path to the file
+            :param text:    (str) file contents
+        """
+        with open(path, "w") as output_file:
+            output_file.write(text)
+
+
+class S3Storage(object):
+    """
+    A class listing and reading runfolders in a bucket of S3-compatible object storage. Folders are key prefixes
+    delimited by /.
+
+    Attributes:
+        bucket      (str) bucket name
+        client      (S3.Client) boto3 client (thread-safe, shared by the ReadPlanner thread pool)
+        cache       (DiskCache) read-through cache objects are read from
+        objects     (dict) key as key, (size, ETag, modification time) as value for objects listed so far, so sizes
+                           and versions need no further request
+        lock        (Lock) guards objects
+    """
+
+    def __init__(self, bucket, client=None, cache=None):
+        """
+        The constructor for S3Storage class
+        """
+        if client is None:
+            if boto3 is None:
+                raise ImportError("boto3 is not installed, s3://{} cannot be read".format(bucket))
+            client = boto3.client("s3", endpoint_url=config.general_config["general"]["s3_endpoint_url"])
+        if cache is None:
+            cache = DiskCache(config.general_config["general"]["storage_cache_folder"],
+                              config.general_config["general"]["storage_cache_mb"] * 1024 * 1024)
+        self.bucket = bucket
+        self.client = client
+        self.cache = cache
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        """
+        Return the S3 path of a key.
+            :param key:     (str) object key or prefix
+            :return:        (str) s3://bucket/key
+        """
+        return "{}{}/{}".format(S3_SCHEME, self.bucket, key)
+
+    def key(self, path):
+        """
+        Return the key of an S3 path in this bucket.
+            :param path:    (str) s3://bucket/key
+            :return:        (str) key
+        """
+        return split_s3_path(path)[1]
+
+    def list_objects(self, path, delimiter=None):
+        """
+        List the objects under a prefix (paginated), recording their metadata.
+            :param path:        (str) path to the prefix (folder)
+            :param delimiter:   (str or NoneType) / to list a single level, None to list recursively
+            :return:            (tuple) keys of the objects, in key order, and sub-prefixes (a single level only)
+        """
+        prefix = self.key(path)
+        prefix = prefix + "/" if prefix else ""
+        arguments = {"Bucket": self.bucket, "Prefix": prefix}
+        if delimiter:
+            arguments["Delimiter"] = delimiter
+        keys = []
+        prefixes = []
+        with profiling.run_log.span("list_objects"):
+            for page in self.client.get_paginator("list_objects_v2").paginate(**arguments):
+                with self.lock:
+                    for listed in page.get("Contents", []):
+                        if not listed["Key"].endswith("/"):
+                            keys.append(listed["Key"])
+                            self.objects[listed["Key"]] = (listed["Size"], listed["ETag"],
+                                                           _timestamp(listed["LastModified"]))
+                prefixes.extend(common["Prefix"] for common in page.get("CommonPrefixes", []))
+        return keys, prefixes
+
+    def head(self, key):
+        """
+        Return the metadata of an object, requesting it if the object has not been listed.
+            :param key:     (str) object key
+            :return:        (tuple) size, ETag, modification time
+
+        Raises OSError if there is no such object.
+        """
+        with self.lock:
+            if key in self.objects:
+                return self.objects[key]
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as error:
+            raise OSError(errno.ENOENT, str(error), self.path(key))
+        metadata = (response["ContentLength"], response["ETag"], _timestamp(response["LastModified"]))
+        with self.lock:
+            self.objects[key] = metadata
+        return metadata
+
+    def listdir(self, path):
+        """
+        Return the names of the entries under a prefix, a single level deep (e.g. the runfolders in an input root).
+            :param path:    (str) path to the prefix (folder)
+            :return:        (list) entry names
+        """
+        keys, prefixes = self.list_objects(path, delimiter="/")
+        return [prefix.rstrip("/").rsplit("/", 1)[-1] for prefix in prefixes] + \
+            [key.rsplit("/", 1)[-1] for key in keys]
+
+    def list_files(self, path):
+        """
+        Return paths of all objects under a prefix, listed in bulk.
+            :param path:    (str) path to the prefix (folder)
+            :return:        (list) object paths, in key order
+        """
+        return [self.path(key) for key in self.list_objects(path)[0]]
+
+    def getmtime(self, path):
+        """
+        Return the modification time of an object, or of the most recently modified object under a prefix.
+            :param path:    (str) path to the object or prefix
+            :return:        (float) seconds since the epoch
+
+        Raises OSError if there is no such object or prefix.
+        """
+        try:
+            return self.head(self.key(path))[2]
+        except OSError:
+            keys = self.list_objects(path)[0]
+            if not keys:
+                raise
+        with self.lock:
+            return max(self.objects[key][2] for key in keys)
+
+    def getsize(self, path):
+        """
+        Return the size of an object.
+            :param path:    (str) path to the object
+            :return:        (int) size in bytes
+        """
+        return self.head(self.key(path))[0]
+
+    def isdir(self, path):
+        """
+        Return whether there are objects under a prefix.
+            :param path:    (str) path to the prefix
+            :return:        (bool) True if any object has the prefix
+        """
+        prefix = self.key(path)
+        response = self.client.list_objects_v2(Bucket=self.bucket, Prefix=prefix + "/" if prefix else "", MaxKeys=1)
+        return bool(response.get("Contents"))
+
+    def abspath(self, path):
+        """
+        Return the normalised form of a path (S3 paths are absolute).
+            :param path:    (str) s3://bucket/key
+            :return:        (str) path without a trailing /
+        """
+        return self.path(self.key(path))
+
+    def local_path(self, path):
+        """
+        Return a local path an object can be opened from, downloading it to the cache if this version of it is not
+        cached.
+            :param path:    (str) path to the object
+            :return:        (str) path to the cached copy of the object
+        """
+        key = self.key(path)
+        size, etag, mtime = self.head(key)
+        try:
+            return self.cache.fetch("{}{}".format(self.path(key), etag),
+                                    lambda temporary_path: self.download(key, etag, temporary_path))
+        except ClientError:
+            # the object changed since it was listed, so its current version is read
+            with self.lock:
+                self.objects.pop(key, None)
+            size, etag, mtime = self.head(key)
+            return self.cache.fetch("{}{}".format(self.path(key), etag),
+                                    lambda temporary_path: self.download(key, etag, temporary_path))
+
+    def download(self, key, etag, temporary_path):
+        """
+        Download a version of an object with a single request (boto3's download_file requests the object's metadata
+        first, a further round trip per object).
+            :param key:             (str) object key
+            :param etag:            (str) ETag of the version to download
+            :param temporary_path:  (str) local path to write the object to
+
+        Raises ClientError if the object no longer has this ETag (checked here too, for stores ignoring If-Match).
+        """
+        response = self.client.get_object(Bucket=self.bucket, Key=key, IfMatch=etag)
+        if response["ETag"] != etag:
+            response["Body"].close()
+            raise ClientError({"Error": {"Code": "PreconditionFailed", "Message": "ETag is not " + etag}}, "GetObject")
+        with open(temporary_path, "wb") as output_file:
+            for chunk in iter(lambda: response["Body"].read(1024 * 1024), b""):
+                output_file.write(chunk)
+
+    def write_text(self, path, text):
+        """
+        Write a text object.
+            :param path:    (str) path to the object
+            :param text:    (str) object contents
+        """
+        key = self.key(path)
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=text.encode("utf-8"))
+        with self.lock:
+            self.objects.pop(key, None)
+
+
+def _timestamp(last_modified):
+    """
+    Return an object's modification time as seconds since the epoch.
+        :param last_modified:   (datetime) LastModified of the object (timezone-aware)
+        :return:                (float) seconds since the epoch
+    """
+    return float(calendar.timegm(last_modified.utctimetuple()))
+
+
+# Backend of local paths
+_local = LocalStorage()
+# S3Storage per bucket, created when a path in the bucket is first used
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def backend(path):
+    """
+    Return the storage backend of a path.
+        :param path:    (str) local path, or s3://bucket/key
+        :return:        (LocalStorage or S3Storage) backend the path is listed and read through
+    """
+    if not path.startswith(S3_SCHEME):
+        return _local
+    bucket = split_s3_path(path)[0]
+    with _buckets_lock:
+        if bucket not in _buckets:
+            _buckets[bucket] = S3Storage(bucket)
+        return _buckets[bucket]
+
+
+def listdir(path):
+    """
+    Return the names of the entries in a folder (see LocalStorage.listdir and S3Storage.listdir).
+        :param path:    (str) path to the folder
+        :return:        (list) entry names
+    """
+    return backend(path).listdir(path)
+
+
+def list_files(path):
+    """
+    Return paths of all files in a folder, recursively (see LocalStorage.list_files and S3Storage.list_files).
+        :param path:    (str) path to the folder
+        :return:        (list) file paths
+    """
+    return backend(path).list_files(path)
+
+
+def getmtime(path):
+    """
+    Return the modification time of a file or folder.
+        :param path:    (str) path to the file or folder
+        :return:        (float) seconds since the epoch
+    """
+    return backend(path).getmtime(path)
+
+
+def getsize(path):
+    """
+    Return the size of a file.
+        :param path:    (str) path to the file
+        :return:        (int) size in bytes
+    """
+    return backend(path).getsize(path)
+
+
+def isdir(path):
+    """
+    Return whether a path is a folder.
+        :param path:    (str) path
+        :return:        (bool) True if the path is a folder
+    """
+    return backend(path).isdir(path)
+
+
+def abspath(path):
+    """
+    Return the absolute form of a path.
+        :param path:    (str) path
+        :return:        (str) absolute path
+    """
+    return backend(path).abspath(path)
+
+
+def local_path(path):
+    """
+    Return a local path a file can be opened from (the file itself, or a cached copy of an object).
+        :param path:    (str) path to the file
+        :return:        (str) local path
+    """
+    return backend(path).local_path(path)
+
+
+def write_text(path, text):
+    """
+    Write a text file.
+        :param path:    (str) path to the file
+        :param text:    (str) file contents
+    """
+    backend(path).write_text(path, text)
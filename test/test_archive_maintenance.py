@@ -0,0 +1,66 @@
+import pytest, sys, os
+import time
+import zipfile
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import archive_maintenance
+
+
+def write_report(archive_folder, name, content, days_old, now):
+    """
+    Write a fake report PDF with a creation date in its metadata, archived days_old days before now.
+    """
+    report_path = os.path.join(archive_folder, name)
+    with open(report_path, "wb") as report_file:
+        report_file.write(b"%PDF-1.4\n" + content + b"\n/CreationDate (D:" + name[:6].encode("utf-8") +
+                          b"090000+01'00')\n%%EOF")
+    os.utime(report_path, (now - days_old * 86400, now - days_old * 86400))
+
+
+def test_compact(tmpdir):
+    """
+    Test that identical reports (apart from their creation dates) are stored once, duplicates staying in the archive
+    folder as hard links, old reports are rolled into monthly bundles, and every report can still be listed and opened
+    by name.
+    """
+    archive_folder = str(tmpdir)
+    now = time.mktime((2021, 4, 20, 12, 0, 0, 0, 0, -1))
+    reports = [("210301_09_00_WES_trend_report.pdf", b"WES march", 50),
+               ("210302_09_00_WES_trend_report.pdf", b"WES march", 49),
+               ("210303_09_00_SWIFT_trend_report.pdf", b"SWIFT march", 48),
+               ("210201_09_00_WES_trend_report.pdf", b"WES february", 78),
+               ("210415_09_00_WES_trend_report.pdf", b"WES april", 5),
+               ("210416_09_00_WES_trend_report.pdf", b"WES april", 4),
+               ("210417_09_00_WES_trend_report.pdf", b"WES march", 3)]
+    contents = {}
+    for name, content, days_old in reports:
+        write_report(archive_folder, name, content, days_old, now)
+        with open(os.path.join(archive_folder, name), "rb") as report_file:
+            contents[name] = report_file.read()
+    counts = archive_maintenance.compact(archive_folder, hot_days=31, now=now)
+    assert dict(counts) == {"deduplicated": 1, "bundled": 4, "hot": 3}
+    assert sorted(archive_maintenance.hot_reports(archive_folder)) == \
+        ["210415_09_00_WES_trend_report.pdf", "210416_09_00_WES_trend_report.pdf", "210417_09_00_WES_trend_report.pdf"]
+    assert os.path.samefile(os.path.join(archive_folder, "210415_09_00_WES_trend_report.pdf"),
+                            os.path.join(archive_folder, "210416_09_00_WES_trend_report.pdf"))
+    assert sorted(os.listdir(os.path.join(archive_folder, "bundles"))) == ["2021-02.zip", "2021-03.zip"]
+    with zipfile.ZipFile(os.path.join(archive_folder, "bundles", "2021-03.zip")) as bundle:
+        assert len(bundle.namelist()) == 2
+    # every report is listed, newest first, and opens with the content of the first identical report
+    assert [name for name, mtime in archive_maintenance.archived_reports(archive_folder)] == \
+        [name for name, content, days_old in sorted(reports, key=lambda report: report[2])]
+    for name, content, days_old in reports:
+        assert content in archive_maintenance.open_report(archive_folder, name)
+    assert archive_maintenance.open_report(archive_folder, "210302_09_00_WES_trend_report.pdf") == \
+        contents["210301_09_00_WES_trend_report.pdf"]
+    assert archive_maintenance.open_report(archive_folder, "missing.pdf") is None
+    assert archive_maintenance.open_report(archive_folder, "../archive_manifest.json") is None
+    # a new report is listed before maintenance has run again, and maintenance is repeatable
+    write_report(archive_folder, "210420_09_00_WES_trend_report.pdf", b"WES new", 0, now)
+    assert archive_maintenance.archived_reports(archive_folder)[0][0] == "210420_09_00_WES_trend_report.pdf"
+    assert dict(archive_maintenance.compact(archive_folder, hot_days=31, now=now)) == \
+        {"deduplicated": 0, "bundled": 0, "hot": 4}
+    counts = archive_maintenance.compact(archive_folder, hot_days=31, now=now + 30 * 86400)
+    assert dict(counts) == {"deduplicated": 0, "bundled": 3, "hot": 1}
+    assert len(archive_maintenance.archived_reports(archive_folder)) == len(reports) + 1
+    assert b"WES april" in archive_maintenance.open_report(archive_folder, "210416_09_00_WES_trend_report.pdf")
@@ -0,0 +1,28 @@
+import pytest, sys, os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import atomic_write
+from atomic_write import write_atomic
+
+try:
+    from unittest import mock  # python 3.3+
+except ImportError:
+    import mock  # python 2.6-3.2
+
+
+def test_write_atomic(tmpdir):
+    """
+    Test that text and bytes are written in place of the previous file, and an interrupted write leaves the previous
+    file intact.
+    """
+    path = str(tmpdir.join("report.html"))
+    write_atomic(path, "first")
+    write_atomic(path, "second")
+    assert tmpdir.join("report.html").read() == "second"
+    write_atomic(path + ".gz", b"\x1f\x8b")
+    assert tmpdir.join("report.html.gz").read_binary() == b"\x1f\x8b"
+    assert os.path.dirname(atomic_write.temporary_path(path)) == str(tmpdir)
+    with mock.patch("atomic_write.os.rename", side_effect=OSError("interrupted")):
+        with pytest.raises(OSError):
+            write_atomic(path, "third")
+    assert tmpdir.join("report.html").read() == "second"
@@ -0,0 +1,122 @@
+import pytest, sys, os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+pytest.importorskip("pytest_benchmark")
+import read_qc_files
+import plot_pool
+from read_qc_files import TrendReport, sorted_runs
+from generate_synthetic_data import generate_input_folder, PANEL_DICT, SEQUENCERS
+import config
+import inspect
+
+try:
+    from unittest import mock  # python 3.3+
+except ImportError:
+    import mock  # python 2.6-3.2
+
+# Benchmarks run against a synthetic input_folder (see generate_synthetic_data.py). To save results so regressions
+# between releases are visible, run with --benchmark-storage=benchmarks --benchmark-save=<release> (see README).
+
+RUNTYPES = ["WES", "CUSTOM_PANELS", "SWIFT", "NEXTSEQ_MARIO", "NEXTSEQ_LUIGI", "MISEQ_ONC", "MISEQ_DNA",
+            "NOVASEQ_PIKACHU"]
+
+
+@pytest.fixture(scope="module")
+def report_folders(tmpdir_factory):
+    """
+    Synthetic input_folder (20 runs per sequencer, 48 samples per run), and output, images and archive folders.
+    """
+    root = tmpdir_factory.mktemp("trend_analysis")
+    folders = {name: str(root.mkdir(name)) for name in ["input", "output", "images", "archive"]}
+    generate_input_folder(folders["input"], dict((sequencer, 20) for sequencer in SEQUENCERS), samples_per_run=48)
+    return folders
+
+
+def trend_report(report_folders, runtype, force=False):
+    """
+    Return a TrendReport for the synthetic input_folder.
+    """
+    return TrendReport(runtype=runtype, panel_dict=PANEL_DICT, input_folder=report_folders["input"],
+                       output_folder=report_folders["output"], images_folder=report_folders["images"],
+                       template_dir=os.path.join(os.path.dirname(read_qc_files.__file__), "html_template"),
+                       archive_folder=report_folders["archive"], logopath="images/viapathlogo.png",
+                       plot_order=config.general_config["general"]["plot_order"],
+                       wkhtmltopdf_path=config.general_config["general"]["wkhtmltopdf_path"], force=force)
+
+
+def test_benchmark_sorted_runs(benchmark):
+    """
+    Classify 10,000 runfolder names (caches cleared each round) and select the most recent runs for each run type
+    and tool, as in one tick.
+    """
+    run_list = ["{:03d}_{:02d}{:02d}{:02d}_{}_{:04d}_AHXXXXXXXX_{}{}".format(
+        number % 1000, 18 + number % 6, 1 + number % 12, 1 + number % 28, sorted(SEQUENCERS)[number % 5], number,
+        ["WES", "NGS", "ONC", "TSO500"][number % 4], number) for number in range(10000)]
+
+    def tick():
+        read_qc_files._run_classifications.clear()
+        read_qc_files._classified_runs_cache.clear()
+        for runtype in RUNTYPES:
+            for tool in config.tool_settings:
+                sorted_runs(run_list, runtype)
+    benchmark(tick)
+
+
+@pytest.mark.parametrize("tool", ["contamination", "fastq_total_sequences", "cluster_density_NextSeq"])
+def test_benchmark_parse_multiqc_output(benchmark, report_folders, tool):
+    """
+    Parse a tool's MultiQC files for the most recent WES runs.
+    """
+    report = trend_report(report_folders, "WES")
+    tool_dict = benchmark(report.parse_multiqc_output, tool)
+    assert any(tool_dict.values())
+
+
+def test_benchmark_normalise_by_kit(benchmark, report_folders):
+    """
+    Normalise total sequences by capture kit for every row of a custom panels run's FastQC table (bound cache cleared
+    each round).
+    """
+    report = trend_report(report_folders, "CUSTOM_PANELS")
+    run = sorted_runs(os.listdir(report_folders["input"]), "CUSTOM_PANELS")[-1]
+    file_path = read_qc_files.find_file_path("multiqc_fastqc.txt", os.path.join(report_folders["input"], run))
+    column_data = read_qc_files.multiqc_parser.read_columns(file_path, ["Total Sequences"])["Total Sequences"]
+
+    def normalise():
+        column_data.bounds.clear()
+        return [report.normalise_by_kit(column_data, row) for row in range(len(column_data))]
+    assert any(benchmark(normalise))
+
+
+@pytest.mark.parametrize("figure_pool_size", [0, 2])
+@pytest.mark.parametrize("tool", ["contamination", "peddy_sex_check"])
+def test_benchmark_plot(benchmark, report_folders, tool, figure_pool_size):
+    """
+    Render a WES box plot or stacked bar chart from parsed data, building a new figure for every plot
+    (figure_pool_size 0) or reusing pooled figures.
+    """
+    report = trend_report(report_folders, "WES")
+    tool_dict = report.parse_multiqc_output(tool)
+
+    def build_plot():
+        # build_plot adds the image location to the tool's dictionary, so each round plots a copy of the parsed data
+        report.dictionary[tool] = tool_dict.copy()
+        report.build_plot(tool)
+    with mock.patch("read_qc_files._figure_pool", plot_pool.FigurePool(figure_pool_size)):
+        benchmark(build_plot)
+    assert os.path.isfile(os.path.join(report_folders["images"],
+                                       os.path.basename(report.dictionary[tool]["image_location"])))
+
+
+@pytest.mark.parametrize("runtype", ["WES", "CUSTOM_PANELS", "SWIFT"])
+def test_benchmark_call_tools(benchmark, report_folders, runtype):
+    """
+    Generate a full trend report end to end, with PDF generation stubbed out. Reports are forced, so every round
+    builds and publishes the report rather than finding it unchanged since the previous round.
+    """
+    def call_tools():
+        report = trend_report(report_folders, runtype, force=True)
+        report.call_tools(inspect.getmembers(report, predicate=inspect.ismethod))
+    with mock.patch("read_qc_files.pdfkit.configuration"), mock.patch("read_qc_files.pdfkit.from_file"):
+        benchmark.pedantic(call_tools, rounds=3, iterations=1)
+    assert os.path.isfile(os.path.join(report_folders["output"], runtype + "_trend_report.html"))
@@ -0,0 +1,45 @@
+import pytest, sys, os, json
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from explain_plan import stage_timings, add_estimates, describe
+from collections import OrderedDict
+
+
+def test_stage_timings(tmpdir):
+    """
+    Test that stage timings are averaged per span over the most recent run logs, skipping unreadable run logs.
+    """
+    for timestamp, wall in [("200101_10_00_00", 100.0), ("200102_10_00_00", 1.0), ("200103_10_00_00", 3.0)]:
+        tmpdir.join(timestamp + "_run_log.json").write(json.dumps(
+            {"summary": {"stages": {"box_plot": {"count": 2, "wall": wall}, "unused": {"count": 0, "wall": 0.0}}}}))
+    tmpdir.join("200104_10_00_00_run_log.json").write("{")
+    tmpdir.join("200105_10_00_00_explain.json").write("{}")
+    assert stage_timings(str(tmpdir), 3) == {"box_plot": 1.0}
+    assert stage_timings(str(tmpdir), 10)["box_plot"] == pytest.approx(104.0 / 6)
+    assert stage_timings(str(tmpdir.join("missing")), 10) == {}
+
+
+def test_time_budget():
+    """
+    Test that reports of non-alerting run types estimated to start once the time budget is spent may be deferred, and
+    deferred PDFs are estimated and described.
+    """
+    def report(runtype, alerting):
+        return OrderedDict([("runtype", runtype), ("reason", "not yet published"), ("rebuild", True), ("runs", []),
+                            ("plots", {"box_plot": ["contamination"] * 4}), ("plots_skipped", []), ("pdf", False),
+                            ("email", False), ("new_runs", []), ("alerting", alerting)])
+    plan = OrderedDict([("reason", "index file updated"), ("distributed", False), ("budget_seconds", 5),
+                        ("scan", OrderedDict([("runfolders", 2)])),
+                        ("reads", OrderedDict([("files", 0), ("requests", 0), ("cache_hits", 0)])),
+                        ("deferred_pdfs", OrderedDict([("run_types", ["MISEQ_ONC"])])),
+                        ("reports", [report("WES", True), report("SWIFT", True), report("MISEQ_ONC", False),
+                                     report("MISEQ_DNA", False)])])
+    add_estimates(plan, {"box_plot": 1.0, "wkhtmltopdf": 3.0}, 1)
+    # 4s per report: MISEQ_ONC is estimated to start after 8s, once the 5s budget is spent
+    assert [report["may_defer"] for report in plan["reports"]] == [False, False, True, True]
+    assert plan["deferred_pdfs"]["estimated_seconds"] == 3.0 and plan["estimated_seconds"] == 19.0
+    description = describe(plan)
+    assert "deferred PDFs: archived for MISEQ_ONC" in description
+    assert "2 reports estimated to start after it" in description
+    plan["budget_seconds"] = 0
+    assert not any(report["may_defer"] for report in add_estimates(plan, {"box_plot": 1.0}, 1)["reports"])
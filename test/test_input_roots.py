@@ -0,0 +1,64 @@
+import pytest, sys, os
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from input_roots import scan_runfolders, describe_timings
+
+try:
+    from unittest import mock  # python 3.3+
+except ImportError:
+    import mock  # python 2.6-3.2
+
+
+def test_scan_runfolders(tmpdir):
+    """
+    Test that runfolders in several roots are merged into one inventory, a runfolder in more than one root is taken
+    from the root where it was modified most recently, and unavailable roots are skipped.
+    """
+    roots = [tmpdir.mkdir("root1"), tmpdir.mkdir("root2")]
+    roots[0].mkdir("001_200101_NB551068_0001_WES")
+    roots[1].mkdir("002_200201_NB551068_0002_WES")
+    for root, mtime in zip(roots, [200, 100]):
+        os.utime(str(root.mkdir("003_200301_NB551068_0003_WES")), (mtime, mtime))
+    timings = {}
+    inventory = scan_runfolders([str(root) for root in roots] + [str(tmpdir.join("unmounted"))], timeout=10,
+                                timings=timings)
+    assert inventory == {"001_200101_NB551068_0001_WES": str(roots[0].join("001_200101_NB551068_0001_WES")),
+                         "002_200201_NB551068_0002_WES": str(roots[1].join("002_200201_NB551068_0002_WES")),
+                         "003_200301_NB551068_0003_WES": str(roots[0].join("003_200301_NB551068_0003_WES"))}
+    assert list(inventory) == sorted(inventory)
+    assert timings[str(roots[0])][0] == 2 and timings[str(tmpdir.join("unmounted"))][0] is None
+    assert "skipped" in describe_timings(timings)
+    # a single root is scanned as before, and is an error if it cannot be listed
+    assert list(scan_runfolders(str(roots[1]), timeout=10)) == ["002_200201_NB551068_0002_WES",
+                                                               "003_200301_NB551068_0003_WES"]
+    with pytest.raises(OSError):
+        scan_runfolders(str(tmpdir.join("unmounted")), timeout=10)
+
+
+def test_slow_root(tmpdir):
+    """
+    Test that a root not listed within the timeout is skipped without holding up the other roots.
+    """
+    fast_root = tmpdir.mkdir("fast")
+    fast_root.mkdir("001_200101_NB551068_0001_WES")
+    slow_root = str(tmpdir.mkdir("slow"))
+    hung = threading.Event()
+    listdir = os.listdir
+
+    def hanging_listdir(path):
+        if path == slow_root:
+            hung.wait(10)
+        return listdir(path)
+
+    with mock.patch("input_roots.os.listdir", side_effect=hanging_listdir):
+        started = time.time()
+        timings = {}
+        try:
+            inventory = scan_runfolders([slow_root, str(fast_root)], timeout=0.5, timings=timings)
+        finally:
+            hung.set()
+    assert time.time() - started < 5
+    assert list(inventory) == ["001_200101_NB551068_0001_WES"]
+    assert timings[slow_root] == (None, "not listed within 0.5s")
@@ -0,0 +1,99 @@
+import pytest, sys, os
+import multiprocessing
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import job_queue
+from job_queue import Worker
+
+
+def log_job(log_path):
+    """
+    Return a job handler appending the job id and worker process id to a log file.
+    """
+    def handler(job, dependency_results):
+        assert all(result["job"] in job["depends_on"] for result in dependency_results.values())
+        with open(log_path, "a") as log_file:
+            log_file.write("{} {}\n".format(job["id"], os.getpid()))
+        time.sleep(0.05)
+        return {"job": job["id"], "pid": os.getpid()}
+    return handler
+
+
+def run_worker(queue_folder, log_path):
+    """
+    Run a worker process until no jobs are pending.
+    """
+    Worker(queue_folder, lease_timeout=60, heartbeat_interval=0.01, poll_interval=0.01).work(
+        log_job(log_path), exit_when_idle=True)
+
+
+def test_workers_share_jobs(tmpdir):
+    """
+    Test that jobs are shared between worker processes, each job is run once, and jobs only run once their
+    dependencies are done.
+    """
+    queue_folder = str(tmpdir.mkdir("queue"))
+    log_path = str(tmpdir.join("jobs.log"))
+    jobs = [{"id": "{}_report".format(runtype), "depends_on": []} for runtype in ["WES", "SWIFT", "MISEQ_DNA"]] + \
+        [{"id": "{}_pdf".format(runtype), "depends_on": ["{}_report".format(runtype)]}
+         for runtype in ["WES", "SWIFT", "MISEQ_DNA"]]
+    batch_folder = job_queue.publish(queue_folder, jobs)
+    processes = [multiprocessing.Process(target=run_worker, args=(queue_folder, log_path)) for worker in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    with open(log_path) as log_file:
+        log = [line.split() for line in log_file]
+    assert sorted(job_id for job_id, pid in log) == sorted(job["id"] for job in jobs)
+    order = [job_id for job_id, pid in log]
+    for runtype in ["WES", "SWIFT", "MISEQ_DNA"]:
+        assert order.index(runtype + "_report") < order.index(runtype + "_pdf")
+    assert len(set(pid for job_id, pid in log)) > 1
+    results, failures, pending = job_queue.batch_status(batch_folder)
+    assert sorted(results) == sorted(job["id"] for job in jobs) and failures == {} and pending == 0
+    assert not [name for name in os.listdir(batch_folder) if name.endswith(".lease")]
+
+
+def test_expired_lease(tmpdir):
+    """
+    Test that a job leased by a worker that has stopped heartbeating is taken over, but a live lease is not.
+    """
+    queue_folder = str(tmpdir.mkdir("queue"))
+    batch_folder = job_queue.publish(queue_folder, [{"id": "dead", "depends_on": []}, {"id": "live", "depends_on": []}])
+    prefixes = dict((job["id"], prefix) for prefix, job in job_queue.batch_jobs(batch_folder))
+    for prefix in prefixes.values():
+        with open(prefix + ".lease", "w") as lease_file:
+            lease_file.write("other-node:1\n")
+    os.utime(prefixes["dead"] + ".lease", (time.time() - 120, time.time() - 120))
+    worker = Worker(queue_folder, lease_timeout=60, heartbeat_interval=0.01, poll_interval=0.01)
+    prefix, job, dependency_results = worker.claim(batch_folder)
+    assert job["id"] == "dead"
+    with open(prefix + ".lease") as lease_file:
+        assert lease_file.read().strip() == worker.worker_id
+    worker.run_job(prefix, job, dependency_results, log_job(str(tmpdir.join("jobs.log"))))
+    assert worker.claim(batch_folder) is None
+    assert job_queue.batch_status(batch_folder)[2] == 1
+
+
+def test_failed_job(tmpdir):
+    """
+    Test that a failing job is recorded as failed, and jobs depending on it are failed without running.
+    """
+    queue_folder = str(tmpdir.mkdir("queue"))
+    batch_folder = job_queue.publish(queue_folder, [{"id": "report", "depends_on": []},
+                                                    {"id": "pdf", "depends_on": ["report"]}])
+    ran = []
+
+    def handler(job, dependency_results):
+        ran.append(job["id"])
+        raise ValueError("no MultiQC data")
+
+    Worker(queue_folder, lease_timeout=60, heartbeat_interval=0.01, poll_interval=0.01).work(handler, batch_folder)
+    results, failures, pending = job_queue.batch_status(batch_folder)
+    assert ran == ["report"] and results == {} and pending == 0
+    assert "ValueError: no MultiQC data" in failures["report"]
+    assert failures["pdf"] == "dependency failed: report"
+    job_queue.remove_batch(batch_folder)
+    assert os.listdir(queue_folder) == []
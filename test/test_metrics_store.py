@@ -0,0 +1,63 @@
+import pytest, sys, os
+from collections import OrderedDict
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import metrics_store
+from metrics_store import MetricsStore
+
+try:
+    from StringIO import StringIO  # python 2
+except ImportError:
+    from io import StringIO  # python 3
+
+
+def row(runtype, run, sample, tool, value):
+    """
+    Return a measurement row in the format returned by trend_export.export_rows.
+    """
+    return OrderedDict([("runtype", runtype), ("run", run), ("sample", sample), ("tool", tool), ("value", value),
+                        ("lower_lim", None), ("upper_lim", 2.0)])
+
+
+def test_metrics_store(tmpdir):
+    """
+    Test that measurements are recorded once per run type, run and tool, and can be queried by each filter.
+    """
+    store = MetricsStore(str(tmpdir.join("qc_metrics.sqlite")))
+    wes_run = "001_200105_A01229_0001_AHXXXXXXXX_WES1"
+    store.record([row("WES", wes_run, "WES1_01_NTCcon", "contamination", 0.5),
+                  row("WES", wes_run, "WES1_02_12345678", "contamination", 1.5),
+                  row("WES", "002_191231_A01229_0002_AHXXXXXXXX_WES2", "WES2_01_1234", "contamination", 2.5),
+                  row("CUSTOM_PANELS", "003_200201_NB551068_0003_AHXXXXXXXX_NGS3", "NGS3_01_1234", "contamination",
+                      3.5),
+                  row("WES", wes_run, "WES1_01_NTCcon", "peddy_sex_check", True)])
+    # runs are included in successive reports, so are recorded again
+    assert store.record([row("WES", wes_run, "WES1_01_NTCcon", "contamination", 0.5),
+                         row("WES", wes_run, "WES1_02_12345678", "contamination", 1.5)]) == 2
+    assert len(store.query()) == 5
+    rows = store.query(runtype="WES", sequencer="A01229", tool="contamination", since="2020-01-01")
+    assert [(result[0], result[4], result[6]) for result in rows] == [("2020-01-05", "WES1_01_NTCcon", 0.5),
+                                                         ("2020-01-05", "WES1_02_12345678", 1.5)]
+    assert [result[3] for result in store.query(until="2019-12-31")] == ["002_191231_A01229_0002_AHXXXXXXXX_WES2"]
+    assert [result[6] for result in store.query(sample="*NTCcon", runtype="WES")] == [0.5, "True"]
+    # indexes are used for the run date, tool and sequencer filters
+    plan = store.connection.execute("EXPLAIN QUERY PLAN SELECT * FROM measurements WHERE tool = ? AND run_date >= ?",
+                                    ["contamination", "2020-01-01"]).fetchall()
+    assert "measurements_tool_date" in str(plan)
+    store.close()
+
+
+def test_write_query_output():
+    """
+    Test table and CSV output of query results.
+    """
+    rows = [("2020-01-05", "WES", "A01229", "run1", "sample1", "contamination", 0.5, None, 2.0)]
+    table = StringIO()
+    metrics_store.write_table(rows, table)
+    lines = table.getvalue().splitlines()
+    assert lines[0].split() == metrics_store.QUERY_COLUMNS
+    assert lines[1].split() == ["2020-01-05", "WES", "A01229", "run1", "sample1", "contamination", "0.5", "2.0"]
+    assert lines[2] == "(1 rows)"
+    csv_output = StringIO()
+    metrics_store.write_csv(rows, csv_output)
+    assert csv_output.getvalue().splitlines()[1] == "2020-01-05,WES,A01229,run1,sample1,contamination,0.5,,2.0"
@@ -0,0 +1,26 @@
+import pytest, sys, os
+from array import array
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import multiqc_parser
+
+
+@pytest.mark.parametrize("mmap_min_bytes", [None, 1])
+def test_read_columns(tmpdir, mmap_min_bytes):
+    """
+    Test that only data rows with a value in each column of interest are kept, numeric columns are stored in compact
+    arrays, and files are read the same way with or without a memory map.
+    """
+    table = tmpdir.join("multiqc_peddy.txt")
+    table.write("Sample\tFREEMIX\terror_sex_check\tother\n"
+                "WES1_01_NA12878_F\t0.01\tFalse\tx\n"
+                "# comment line\n"
+                "\n"
+                "WES1_02_NTCcon_U\t\tTrue\tx\n")
+    column_data = multiqc_parser.read_columns(str(table), ["FREEMIX", "error_sex_check", "missing"],
+                                              text_columns=["error_sex_check"], mmap_min_bytes=mmap_min_bytes)
+    assert sorted(column_data) == ["FREEMIX", "error_sex_check"]
+    assert column_data["FREEMIX"].names == ["WES1_01_NA12878_F"]
+    assert column_data["FREEMIX"].values == array('d', [0.01])
+    assert column_data["error_sex_check"].values == ["False", "True"]
+    assert column_data["error_sex_check"].column_index == 2
@@ -0,0 +1,34 @@
+import pytest, sys, os
+from collections import OrderedDict
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+np = pytest.importorskip("numpy")
+import outliers
+
+
+def test_robust_z_scores():
+    """
+    Test robust z-scores against the median and median absolute deviation, and that identical values are not scored.
+    """
+    z_scores = outliers.robust_z_scores(np.array([1.0, 2.0, 3.0, 4.0, 100.0]))
+    # median 3, median absolute deviation 1
+    assert np.allclose(z_scores, outliers.MAD_SCALE * np.array([-2.0, -1.0, 0.0, 1.0, 97.0]))
+    assert not outliers.robust_z_scores(np.array([5.0, 5.0, 5.0, 9.0])).any()
+
+
+def test_find_outliers():
+    """
+    Test that outliers are flagged per sequencer across all runs, and mapped back to their run and sample.
+    """
+    tool_dict = OrderedDict([("001_200101_NB551068_0001_AHXXXXXXXX_WES1", [1.0, 1.1, 0.9, 1.0]),
+                             ("002_200102_A01229_0002_AHXXXXXXXX_WES2", [5.0, 5.2, 4.8]),
+                             ("003_200103_NB551068_0003_AHXXXXXXXX_WES3", [1.05, 0.95, 9.0, 1.0]),
+                             ("004_200104_A01229_0004_AHXXXXXXXX_WES4", [])])
+    sample_names = dict((run, ["{}_S{}".format(run[-4:], number) for number in range(len(values))])
+                        for run, values in tool_dict.items())
+    flagged = outliers.find_outliers("contamination", tool_dict, sample_names, 3.5)
+    # 5.0 is not an outlier, as A01229 samples are only compared with each other
+    assert [(outlier["run"], outlier["sample"], outlier["sequencer"], outlier["value"]) for outlier in flagged] == \
+        [("003_200103_NB551068_0003_AHXXXXXXXX_WES3", "WES3_S2", "NB551068", 9.0)]
+    assert flagged[0]["z_score"] > 3.5
+    assert outliers.find_outliers("contamination", OrderedDict([("run", [])]), {}, 3.5) == []
@@ -0,0 +1,48 @@
+import pytest, sys, os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+pd = pytest.importorskip("pandas")
+import numpy as np
+from plot_pool import FigurePool, category_proportions
+
+
+def test_figure_reuse(tmpdir):
+    """
+    Test that a figure is reused for plots of the same type with the previous plot's data and legend removed, is not
+    reused for another plot type or once the pool is full, and is dropped if its plot raised an exception.
+    """
+    pool = FigurePool(1)
+    with pool.figure("box_plot") as (figure, axes):
+        axes.boxplot([[1, 2, 3], [4, 5, 60]], labels=["1", "2"])
+        axes.hlines(50, 0, 3, label="limit")
+        axes.legend()
+        figure.savefig(str(tmpdir.join("first.png")))
+    with pool.figure("box_plot") as (reused_figure, reused_axes):
+        assert reused_figure is figure
+        assert not reused_axes.lines and not reused_axes.collections and reused_axes.legend_ is None
+        reused_axes.boxplot([[0.1, 0.2], [0.3, 0.4]], labels=["1", "2"])
+        assert reused_axes.get_ylim()[1] < 1
+        with pool.figure("box_plot") as (second_figure, _):
+            assert second_figure is not figure
+        with pool.figure("stacked_bar") as (bar_figure, _):
+            assert bar_figure is not figure
+    assert len(pool.figures["box_plot"]) == 1
+    with pytest.raises(ValueError):
+        with pool.figure("box_plot") as (figure, axes):
+            raise ValueError("plot failed")
+    assert pool.figures["box_plot"] == []
+    pool.clear()
+    assert pool.figures == {}
+
+
+def test_category_proportions():
+    """
+    Test that category proportions match those counted with pandas (value_counts per run) for runs of different sizes.
+    """
+    values_by_run = [[True, True, False], [True] * 5, [False, True, False, False]]
+    categories, proportions = category_proportions(values_by_run)
+    expected = pd.DataFrame(values_by_run).apply(lambda x: pd.value_counts(x, normalize=True), axis=1).T.fillna(0)
+    assert list(categories) == list(expected.index)
+    assert np.allclose(proportions, expected.values)
+    categories, proportions = category_proportions([["True", "False"], []])
+    assert list(categories) == ["False", "True"] and list(proportions[:, 1]) == [0, 0]
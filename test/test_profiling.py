@@ -0,0 +1,55 @@
+import pytest, sys, os, json
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from profiling import RunLog
+import profiling
+
+
+def test_run_log_spans(tmpdir):
+    """
+    Test that nested spans inherit run type and tool, bytes are attributed per run type and tool, and the run log,
+    per-stage profiles and Chrome trace are written.
+    """
+    run_log = RunLog()
+    run_log.enable_profiling()
+    with run_log.span("main"):
+        with run_log.span("tool", runtype="WES", tool="contamination"):
+            with run_log.span("return_columns") as record:
+                run_log.add_bytes(100)
+            assert record["runtype"] == "WES" and record["tool"] == "contamination"
+    summary = run_log.summary()
+    assert summary["stages"]["return_columns"]["count"] == 1
+    assert summary["runtypes"]["WES"]["contamination"]["bytes_read"] == 100
+    run_log_path = run_log.write_outputs(str(tmpdir))
+    with open(run_log_path) as run_log_file:
+        assert len(json.load(run_log_file)["spans"]) == 3
+    profile_folder = run_log_path.replace("_run_log.json", "_profile")
+    assert sorted(os.listdir(profile_folder)) == ["main.prof", "return_columns.prof", "tool.prof", "trace.json"]
+    # run logs started in the same second are kept apart by name
+    assert run_log.write_outputs(str(tmpdir), "WES_report") == run_log_path.replace("_run_log.json",
+                                                                                    "_WES_report_run_log.json")
+
+
+def test_memory_tracking(tmpdir):
+    """
+    Test that spans record memory use when memory tracking is enabled, attributed per run type and tool, with the peak
+    allocated memory of nested spans included in the enclosing span.
+    """
+    run_log = RunLog()
+    run_log.enable_memory_tracking()
+    try:
+        with run_log.span("main") as main_record:
+            with run_log.span("tool", runtype="WES", tool="contamination") as tool_record:
+                data = [float(value) for value in range(200000)]
+                del data
+    finally:
+        if profiling.tracemalloc is not None:
+            profiling.tracemalloc.stop()
+    assert tool_record["rss"] > 0 and tool_record["rss_peak_increase"] >= 0
+    if "traced_peak" in tool_record:
+        assert tool_record["traced_peak"] > 4000000
+        assert main_record["traced_peak"] >= tool_record["traced_peak"]
+    assert "rss" in run_log.summary()["memory"]["WES"]["contamination"]
+    assert "WES contamination: RSS" in run_log.memory_report()
+    with open(run_log.write_outputs(str(tmpdir))) as run_log_file:
+        assert json.load(run_log_file)["peak_rss"] > 0
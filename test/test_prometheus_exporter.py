@@ -0,0 +1,35 @@
+import pytest, sys, os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from profiling import RunLog
+import prometheus_exporter
+
+
+def test_write_textfile(tmpdir):
+    """
+    Test that stage durations, counters, report ages and QC medians are written to the .prom file.
+    """
+    run_log = RunLog()
+    with run_log.span("box_plot", runtype="WES", tool="contamination"):
+        run_log.increment("plots_rendered")
+    tmpdir.join("WES_trend_report.html").write("")
+    prom_path = str(tmpdir.join("trend_analysis.prom"))
+    prometheus_exporter.write_textfile(prom_path, run_log, True, str(tmpdir), ["WES", "SWIFT"],
+                                       {"WES": {"contamination": 0.005}})
+    with open(prom_path) as prom_file:
+        metrics = prom_file.read()
+    assert 'trend_analysis_stage_duration_seconds{stage="box_plot"}' in metrics
+    assert 'trend_analysis_plots_rendered{runtype="WES"} 1.0' in metrics
+    assert 'trend_analysis_report_age_seconds{runtype="WES"}' in metrics
+    assert 'runtype="SWIFT"' not in metrics
+    assert 'trend_analysis_qc_median{runtype="WES",tool="contamination"} 0.005' in metrics
+    assert 'trend_analysis_last_run_success 1.0' in metrics
+    assert sorted(os.listdir(str(tmpdir))) == ["WES_trend_report.html", "trend_analysis.prom"]
+    # run types not reported by a run export the medians saved with their published report
+    tmpdir.join("SWIFT_qc_medians.json").write('{"contamination": 0.01}')
+    tmpdir.join("MISEQ_ONC_qc_medians.json").write("{")
+    prometheus_exporter.write_textfile(prom_path, RunLog(), True, str(tmpdir), ["WES", "SWIFT", "MISEQ_ONC"], {})
+    with open(prom_path) as prom_file:
+        metrics = prom_file.read()
+    assert 'trend_analysis_qc_median{runtype="SWIFT",tool="contamination"} 0.01' in metrics
+    assert 'trend_analysis_qc_median{runtype="WES"' not in metrics and 'runtype="MISEQ_ONC"' not in metrics
@@ -1,8 +1,23 @@
 import pytest, sys, os
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
-from read_qc_files import arg_parse
+from read_qc_files import arg_parse, sorted_runs, ReadPlanner, TrendReport, run_coalesced
+from run_lock import RunLock
+from generate_synthetic_data import generate_input_folder, PANEL_DICT, SEQUENCERS
+import config
 import argparse
+import inspect
+import gzip
+import re
+from collections import OrderedDict
+import read_qc_files
+import job_queue
+import metrics_store
+import rebuild_requests
+import input_roots
+import multiprocessing
+import time
+import json
 
 try:
     from unittest import mock  # python 3.3+
@@ -21,3 +36,629 @@ def test_arg_parse():
     with mock.patch('sys.argv', ['read_qc_files', "--dev"]):
         dev_args = arg_parse()
         assert dev_args.dev == True
+
+
+def test_sorted_runs():
+    """
+    Test that runfolders are classified into every matching run type and the most recent runs returned oldest first.
+    """
+    run_list = ["001_200101_NB551068_0001_WES", "002_200301_NB551068_0002_NGS", "003_200201_NB552085_0003_NGS_WES",
+                "004_200401_M02353_0004_ONC", "not_a_runfolder", "005_200501_A01229_0005_TSO500"]
+    assert sorted_runs(run_list, "WES") == ["001_200101_NB551068_0001_WES", "003_200201_NB552085_0003_NGS_WES"]
+    assert sorted_runs(run_list, "CUSTOM_PANELS") == ["002_200301_NB551068_0002_NGS"]
+    assert sorted_runs(run_list, "NEXTSEQ_MARIO") == ["001_200101_NB551068_0001_WES", "002_200301_NB551068_0002_NGS"]
+    assert sorted_runs(run_list, "TSO500") == ["005_200501_A01229_0005_TSO500"]
+    assert sorted_runs(run_list, "MISEQ_DNA") == []
+    # only the x most recent runs are returned
+    many_runs = ["{:03d}_2001{:02d}_NB551068_WES".format(number, number) for number in range(1, 13)]
+    number_of_runs = config.general_config["general"]["number_of_runs_to_include"]
+    assert sorted_runs(many_runs, "WES") == many_runs[-number_of_runs:]
+    # runs after the cutoff date are excluded
+    assert sorted_runs(many_runs, "WES", as_of=200108) == many_runs[8 - number_of_runs:8]
+
+
+def trend_report(input_folder, runtype, read_plan=None):
+    """
+    Return a TrendReport reading from input_folder (only parsing methods are used, so output paths are not needed).
+    """
+    return TrendReport(runtype=runtype, panel_dict=PANEL_DICT, input_folder=input_folder, output_folder=input_folder,
+                       images_folder=input_folder, template_dir=input_folder, archive_folder=input_folder,
+                       logopath="images/viapathlogo.png", plot_order=config.general_config["general"]["plot_order"],
+                       wkhtmltopdf_path=config.general_config["general"]["wkhtmltopdf_path"], read_plan=read_plan)
+
+
+def test_read_planner(tmpdir):
+    """
+    Test that the read planner reads each file once, saves reads for files shared between tools/run types, and
+    returns the same parsed data as reading files directly.
+    """
+    generate_input_folder(str(tmpdir), dict((sequencer, 6) for sequencer in SEQUENCERS), samples_per_run=6)
+    run_types = config.general_config["general"]["run_types"]
+    plot_order = config.general_config["general"]["plot_order"]
+    read_plan = ReadPlanner(str(tmpdir), io_concurrency=4)
+    read_plan.build_plan(run_types, plot_order)
+    read_plan.execute()
+    assert read_plan.requests > len(read_plan.plan)
+    for runtype in run_types:
+        for tool in plot_order:
+            if config.tool_settings[tool]["report_type"][runtype] and \
+                    config.tool_settings[tool]["function"] == "parse_multiqc_output":
+                assert trend_report(str(tmpdir), runtype, read_plan).parse_multiqc_output(tool) == \
+                    trend_report(str(tmpdir), runtype).parse_multiqc_output(tool)
+    read_plan.close()
+
+
+def test_input_roots(tmpdir):
+    """
+    Test that reports read from several input roots parse the same data as from a single input folder, and emails
+    record their logfile in the runfolder's own root.
+    """
+    single_folder = str(tmpdir.mkdir("single"))
+    runs = generate_input_folder(single_folder, {"NB551068": 4, "M02353": 2}, samples_per_run=4)
+    roots = [str(tmpdir.mkdir("root1")), str(tmpdir.mkdir("root2"))]
+    generate_input_folder(roots[0], {"NB551068": 4, "M02353": 2}, samples_per_run=4)
+    for run in runs[::2]:
+        os.rename(os.path.join(roots[0], run), os.path.join(roots[1], run))
+    roots.append(str(tmpdir.join("unmounted")))
+    plot_order = config.general_config["general"]["plot_order"]
+    read_plan = ReadPlanner(roots, io_concurrency=4)
+    read_plan.build_plan(["WES", "SWIFT"], plot_order)
+    read_plan.execute()
+    for runtype in ["WES", "SWIFT"]:
+        for tool in plot_order:
+            if config.tool_settings[tool]["report_type"][runtype] and \
+                    config.tool_settings[tool]["function"] == "parse_multiqc_output":
+                assert trend_report(roots, runtype, read_plan).parse_multiqc_output(tool) == \
+                    trend_report(single_folder, runtype).parse_multiqc_output(tool)
+    read_plan.close()
+    email = read_qc_files.Emails(roots, "WES", *[""] * 7)
+    with mock.patch.object(read_qc_files.Emails, "send_email"):
+        email.call_tools()
+    for run in sorted_runs(runs, "WES"):
+        assert os.path.isfile(os.path.join(roots[1 if runs.index(run) % 2 == 0 else 0], run, "email_logfile"))
+    assert email.check_sent(sorted_runs(list(email.runfolders), "WES")) == []
+
+
+def test_run_coalesced(tmpdir):
+    """
+    Test that the running instance runs once more if a rerun was requested and new runfolders have arrived, and not if
+    no new runfolders have arrived, and that a run with nothing to do does not scan the input roots.
+    """
+    input_folder = tmpdir.mkdir("input")
+    input_folder.mkdir("001_200101_NB551068_0001_WES1")
+    lock = RunLock(str(tmpdir.join("trend_analysis.lock")))
+    assert lock.acquire()
+    inputs = {"input_folder": str(input_folder), "rebuild_folder": str(tmpdir.join("rebuild_requests"))}
+
+    def overlapping_run(args, inputs, tool_medians, force_update=False, runfolders=None):
+        # an invocation started during the first run, when a new runfolder has arrived
+        runfolders = runfolders or input_roots.scan_runfolders(inputs["input_folder"])
+        if not force_update:
+            input_folder.mkdir("002_200102_NB551068_0002_WES2")
+            assert not RunLock(lock.lock_path).acquire()
+        return runfolders
+    with mock.patch("read_qc_files.run", side_effect=overlapping_run) as run:
+        run_coalesced(argparse.Namespace(dev=False), inputs, lock, {})
+    assert [call[0][3] for call in run.call_args_list] == [False, True]
+    # rerun requested, but no new runfolders
+    assert not RunLock(lock.lock_path).acquire()
+    with mock.patch("read_qc_files.run", return_value=input_roots.scan_runfolders(str(input_folder))) as run:
+        run_coalesced(argparse.Namespace(dev=False), inputs, lock, {})
+    assert run.call_count == 1
+    assert not lock.take_rerun_request()
+    # a run with nothing to do scans nothing, and a rerun requested during it runs again
+    inputs = dict(inputs, input_folder=str(tmpdir.join("unavailable")), index_file="", run_frequency=1)
+    assert not RunLock(lock.lock_path).acquire()
+    with mock.patch("read_qc_files.get_panel_dict", return_value=PANEL_DICT), \
+            mock.patch("read_qc_files.check_for_update", return_value=False), \
+            mock.patch("read_qc_files.input_roots.scan_runfolders") as scan_runfolders, \
+            mock.patch("read_qc_files.run", wraps=read_qc_files.run) as run:
+        run_coalesced(argparse.Namespace(dev=False, force=False), inputs, lock, {})
+    assert run.call_count == 2 and not scan_runfolders.called
+    lock.release()
+
+
+def test_metrics_unavailable(tmpdir):
+    """
+    Test that a missing textfile collector folder does not fail a run or hide the exception a run raised, and the run
+    lock is still released.
+    """
+    args = argparse.Namespace(command=None, explain=False, worker=False, profile=False, memory_report=False)
+    inputs = dict(config.general_config["general"], lock_file=str(tmpdir.join("trend_analysis.lock")),
+                  run_log_folder=str(tmpdir.join("run_logs")), output_folder=str(tmpdir),
+                  prometheus_textfile=str(tmpdir.join("missing", "trend_analysis.prom")))
+    with mock.patch("read_qc_files.arg_parse", return_value=args), \
+            mock.patch("read_qc_files.get_inputs", return_value=inputs):
+        with mock.patch("read_qc_files.run_coalesced"):
+            read_qc_files.main()
+        with mock.patch("read_qc_files.run_coalesced", side_effect=ValueError("run failed")):
+            with pytest.raises(ValueError):
+                read_qc_files.main()
+    lock = RunLock(inputs["lock_file"])
+    assert lock.acquire()
+    lock.release()
+
+
+def test_run_scans_once(tmpdir):
+    """
+    Test that a run scans the input roots once, and every read, report and email of the run uses that run inventory.
+    """
+    folders = dict((name, str(tmpdir.mkdir(name))) for name in ["input", "output", "images", "archive"])
+    runs = generate_input_folder(folders["input"], {"NB551068": 3, "M02353": 2}, samples_per_run=4)
+    inputs = dict(config.general_config["general"], input_folder=folders["input"], output_folder=folders["output"],
+                  images_folder=folders["images"], archive_folder=folders["archive"], distributed=False, index_file="",
+                  metrics_db=str(tmpdir.join("qc_metrics.sqlite")), run_types=["WES", "SWIFT", "NEXTSEQ_MARIO"],
+                  rebuild_folder=str(tmpdir.join("rebuild_requests")), wes_email="", oncology_ops_email="",
+                  custom_panels_email="", email_subject="", reports_hyperlink="",
+                  template_dir=os.path.join(os.path.dirname(read_qc_files.__file__), "html_template"))
+    lock = RunLock(str(tmpdir.join("trend_analysis.lock")))
+    assert lock.acquire()
+    scan_runfolders = input_roots.scan_runfolders
+    with mock.patch("read_qc_files.get_panel_dict", return_value=PANEL_DICT), \
+            mock.patch("read_qc_files.pdfkit.configuration"), mock.patch("read_qc_files.pdfkit.from_file"), \
+            mock.patch("read_qc_files.Emails.send_email"), \
+            mock.patch("read_qc_files.input_roots.scan_runfolders", side_effect=scan_runfolders) as scan:
+        run_coalesced(argparse.Namespace(dev=False, force=True), inputs, lock, {})
+    lock.release()
+    assert scan.call_count == 1
+    for runtype in ["WES", "SWIFT"]:
+        assert os.path.isfile(os.path.join(folders["output"], runtype + "_trend_report.html"))
+        for run in sorted_runs(runs, runtype):
+            assert os.path.isfile(os.path.join(folders["input"], run, "email_logfile"))
+
+
+def test_report_fingerprint(tmpdir):
+    """
+    Test that a report is only republished and archived when its content changes, or when forced.
+    """
+    folders = dict((name, str(tmpdir.mkdir(name))) for name in ["input", "output", "images", "archive"])
+    generate_input_folder(folders["input"], {"NB551068": 3}, samples_per_run=4)
+
+    def publish(force=False):
+        report = TrendReport(runtype="WES", panel_dict=PANEL_DICT, input_folder=folders["input"],
+                             output_folder=folders["output"], images_folder=folders["images"],
+                             template_dir=os.path.join(os.path.dirname(read_qc_files.__file__), "html_template"),
+                             archive_folder=folders["archive"], logopath="images/viapathlogo.png",
+                             plot_order=config.general_config["general"]["plot_order"],
+                             wkhtmltopdf_path=config.general_config["general"]["wkhtmltopdf_path"], force=force)
+        with mock.patch("read_qc_files.pdfkit.configuration"), mock.patch("read_qc_files.pdfkit.from_file") as pdf:
+            report.call_tools(inspect.getmembers(report, predicate=inspect.ismethod))
+        return pdf.call_count
+    assert publish() == 1
+    with open(os.path.join(folders["output"], "WES_trend_data.csv")) as export_file:
+        assert len(export_file.readlines()) > 1
+    with open(os.path.join(folders["output"], "WES_qc_medians.json")) as medians_file:
+        assert "contamination" in json.load(medians_file)
+    # unchanged runs, data and templates
+    assert publish() == 0
+    assert publish(force=True) == 1
+    assert not [name for folder in [folders["output"], folders["images"]] for name in os.listdir(folder)
+                if name.startswith(".build_")]
+    # a report failing part way leaves the published report and its images untouched
+    published = [sorted(os.listdir(folders[folder])) for folder in ["output", "images"]]
+    with mock.patch.object(TrendReport, "generate_report", side_effect=IOError("disk full")):
+        with pytest.raises(IOError):
+            publish(force=True)
+    assert [sorted(os.listdir(folders[folder])) for folder in ["output", "images"]] == published
+    # a new run changes the included runs and data
+    generate_input_folder(folders["input"], {"NB551068": 4}, samples_per_run=4, seed=2)
+    assert publish() == 1
+    assert publish() == 0
+
+
+def test_publish_images_and_html(tmpdir):
+    """
+    Test that published images have content-hashed names, unused images are removed, html is written with an
+    identical pre-compressed copy, and the .htaccess file proxies archived reports to the report server's port.
+    """
+    report = trend_report(str(tmpdir), "WES")
+    report.images_folder = str(tmpdir)
+    image_path = report.return_image_paths("contamination")[0]
+    stale_images = ["WES_contamination.png", "WES_contamination.0123456789abcdef.png", "WES_properly_paired.png"]
+    for image_name in stale_images + ["SWIFT_contamination.png", "viapathlogo.png"]:
+        tmpdir.join(image_name).write("old plot")
+    with open(image_path, "w") as image_file:
+        image_file.write("new plot")
+    html_image_path = report.publish_image("contamination")
+    assert re.match(r"^images/WES_contamination\.[0-9a-f]{16}\.png$", html_image_path)
+    assert not os.path.isfile(image_path)
+    report.dictionary["contamination"] = OrderedDict([("image_location", html_image_path)])
+    assert html_image_path in report.populate_html_template("contamination")
+    report.remove_unused_images()
+    assert sorted(os.listdir(str(tmpdir))) == sorted([os.path.basename(html_image_path), "SWIFT_contamination.png",
+                                                      "viapathlogo.png"])
+    html_path = str(tmpdir.join("WES_trend_report.html"))
+    read_qc_files.write_html(html_path, "<html>report</html>")
+    with gzip.open(html_path + ".gz", "rb") as compressed_file:
+        assert compressed_file.read() == tmpdir.join("WES_trend_report.html").read("rb") == b"<html>report</html>"
+    read_qc_files.write_htaccess(str(tmpdir), 8081)
+    htaccess = tmpdir.join(".htaccess").read()
+    assert "http://localhost:8081/archive/$1" in htaccess and "[0-9a-f]{16}" in htaccess
+
+
+def test_backfill(tmpdir):
+    """
+    Test that backfill regenerates a report as of each run date in the range, in a folder per date, using a process
+    pool, without writing to the live output folder, and writes a run log of the reports backfilled.
+    """
+    folders = dict((name, str(tmpdir.mkdir(name)))
+                   for name in ["input", "output", "images", "archive", "backfill", "run_logs"])
+    runs = generate_input_folder(folders["input"], {"NB551068": 4}, samples_per_run=4)
+    wes_dates = sorted(read_qc_files.run_date(run) for run in runs if "WES" in run.split("_")[-1])
+    inputs = dict(config.general_config["general"], input_folder=folders["input"], output_folder=folders["output"],
+                  images_folder=folders["images"], archive_folder=folders["archive"],
+                  backfill_folder=folders["backfill"], backfill_processes=2, run_log_folder=folders["run_logs"],
+                  template_dir=os.path.join(os.path.dirname(read_qc_files.__file__), "html_template"))
+    args = argparse.Namespace(command="backfill", since="2020-01-01", until="2020-12-31", runtype="WES", force=False)
+    assert read_qc_files.backfill_dates(runs, "WES", 200101, 201231) == wes_dates
+    assert read_qc_files.backfill_dates(runs, "WES", None, 201231) == [201231]
+    with mock.patch("read_qc_files.get_panel_dict", return_value=PANEL_DICT), \
+            mock.patch("read_qc_files.pdfkit.configuration"), mock.patch("read_qc_files.pdfkit.from_file"), \
+            mock.patch("read_qc_files.arg_parse", return_value=args), \
+            mock.patch("read_qc_files.get_inputs", return_value=inputs):
+        read_qc_files.main()
+    as_of_folders = sorted(os.listdir(folders["backfill"]))
+    assert as_of_folders == ["20{}-{}-{}".format(str(date)[:2], str(date)[2:4], str(date)[4:]) for date in wes_dates]
+    for as_of_folder in as_of_folders:
+        assert os.path.isfile(os.path.join(folders["backfill"], as_of_folder, "WES_trend_report.html"))
+    # the report as of the first run date only includes that run
+    with open(os.path.join(folders["backfill"], as_of_folders[0], "WES_trend_data.csv")) as export_file:
+        assert set(line.split(",")[1] for line in export_file.readlines()[1:]) == \
+            set(run for run in runs if read_qc_files.run_date(run) == wes_dates[0])
+    assert os.listdir(folders["output"]) == []
+    with open(os.path.join(folders["run_logs"], os.listdir(folders["run_logs"])[0])) as run_log_file:
+        run_log = json.load(run_log_file)
+    assert run_log["summary"]["stages"]["backfill"]["count"] >= 1
+    assert run_log["counters"]["reports_backfilled"]["WES"] >= len(wes_dates)
+    # each job is built from the run inventory scanned by backfill, rather than scanning the input roots again
+    runfolders = input_roots.scan_runfolders(folders["input"])
+    with mock.patch("read_qc_files.input_roots.scan_runfolders") as scan_runfolders, \
+            mock.patch("read_qc_files.pdfkit.configuration"), mock.patch("read_qc_files.pdfkit.from_file"):
+        try:
+            read_qc_files.backfill_report("WES", wes_dates[-1], inputs, PANEL_DICT, True, runfolders)
+        finally:
+            read_qc_files._backfill_read_plan.close()
+            read_qc_files._backfill_read_plan = None
+    assert not scan_runfolders.called
+
+
+def test_outliers_in_report_and_email(tmpdir):
+    """
+    Test that outlier samples are listed at the top of the report, and in the email body for new runs only.
+    """
+    report = trend_report(str(tmpdir), "WES")
+    report.outliers = [OrderedDict([("tool", "contamination"), ("run", "run1"), ("sample", "sample1"),
+                                    ("sequencer", "A01229"), ("value", 9.0), ("z_score", 12.5)])]
+    assert "<td>run1</td><td>sample1</td><td>A01229</td><td>9</td><td>12.50</td>" in report.outlier_table()
+    email = read_qc_files.Emails(input_folder=str(tmpdir), runtype="WES", wes_email="", oncology_ops_email="",
+                                 custom_panels_email="", mokaguys_email="", email_subject="",
+                                 email_message=config.general_config["general"]["email_message"], hyperlink="",
+                                 outliers=report.outliers)
+    assert "run1 sample1: 9 (z-score 12.50)" in email.describe_outliers(["run1", "run2"])
+    assert email.describe_outliers(["run2"]) == ""
+
+
+def test_render_report(tmpdir):
+    """
+    Test that a report rendered on demand includes the requested number of runs and its plot images, without
+    publishing or archiving anything, and a run log of the render is written.
+    """
+    folders = dict((name, str(tmpdir.mkdir(name))) for name in ["input", "images", "archive", "run_logs"])
+    runs = generate_input_folder(folders["input"], {"NB551068": 8}, samples_per_run=4)
+    inputs = dict(config.general_config["general"], input_folder=folders["input"], images_folder=folders["images"],
+                  archive_folder=folders["archive"], run_log_folder=folders["run_logs"],
+                  template_dir=os.path.join(os.path.dirname(read_qc_files.__file__), "html_template"))
+    read_plan = ReadPlanner(folders["input"])
+    try:
+        html, images = read_qc_files.render_report("WES", 2, inputs, PANEL_DICT, read_plan)
+    finally:
+        read_plan.close()
+    wes_runs = sorted_runs(runs, "WES", number_of_runs=len(runs))
+    assert len(wes_runs) > 2
+    assert all(run.encode("utf-8") in html for run in wes_runs[-2:])
+    assert wes_runs[0].encode("utf-8") not in html
+    image_names = re.findall(r'src="images/(WES_[^"]+\.png)"', html.decode("utf-8"))
+    assert image_names and set(image_names) == set(images)
+    assert os.listdir(folders["images"]) == [] and os.listdir(folders["archive"]) == []
+    run_logs = os.listdir(folders["run_logs"])
+    assert [name.split("_", 4)[-1] for name in run_logs] == ["render_WES_run_log.json"]
+    with open(os.path.join(folders["run_logs"], run_logs[0])) as run_log_file:
+        assert json.load(run_log_file)["summary"]["stages"]["render"]["count"] == 1
+
+
+def distributed_worker(inputs):
+    """
+    Run a distributed mode worker process once a batch is published, until no jobs are pending.
+    """
+    worker = job_queue.Worker(inputs["queue_folder"], inputs["lease_timeout"], inputs["heartbeat_interval"],
+                              inputs["queue_poll_interval"])
+    while not worker.batches():
+        time.sleep(0.01)
+    worker.work(lambda job, dependency_results: read_qc_files.run_job(job, dependency_results, inputs),
+                exit_when_idle=True)
+
+
+def test_run_distributed(tmpdir):
+    """
+    Test that reports are generated by a worker process alongside the coordinator, which then records measurements,
+    updates the archive index and sends emails.
+    """
+    folders = dict((name, str(tmpdir.mkdir(name))) for name in ["input", "output", "images", "archive", "queue"])
+    generate_input_folder(folders["input"], {"NB551068": 3, "M02353": 2}, samples_per_run=4)
+    run_types = ["WES", "CUSTOM_PANELS", "SWIFT", "MISEQ_ONC"]
+    inputs = dict(config.general_config["general"], input_folder=folders["input"], output_folder=folders["output"],
+                  images_folder=folders["images"], archive_folder=folders["archive"], queue_folder=folders["queue"],
+                  metrics_db=str(tmpdir.join("qc_metrics.sqlite")), run_types=run_types, queue_poll_interval=0.01,
+                  heartbeat_interval=0.1, wes_email="", oncology_ops_email="", custom_panels_email="",
+                  email_subject="", reports_hyperlink="",
+                  template_dir=os.path.join(os.path.dirname(read_qc_files.__file__), "html_template"))
+    tool_medians = {}
+    with mock.patch("read_qc_files.pdfkit.configuration"), mock.patch("read_qc_files.pdfkit.from_file"), \
+            mock.patch("read_qc_files.Emails") as emails:
+        process = multiprocessing.Process(target=distributed_worker, args=(inputs,))
+        process.start()
+        try:
+            read_qc_files.run_distributed(inputs, PANEL_DICT, tool_medians)
+        finally:
+            process.join()
+    for runtype in run_types:
+        assert os.path.isfile(os.path.join(folders["output"], runtype + "_trend_report.html"))
+    assert os.path.isfile(os.path.join(folders["output"], "archive_index.html"))
+    assert os.listdir(folders["queue"]) == []
+    assert sorted(call[1]["runtype"] for call in emails.call_args_list) == sorted(run_types)
+    assert "WES" in tool_medians
+    store = metrics_store.MetricsStore(inputs["metrics_db"])
+    try:
+        assert set(row[1] for row in store.query()) == set(run_types)
+    finally:
+        store.close()
+
+
+def test_worker_run_logs(tmpdir):
+    """
+    Test that a worker writes a run log of each job it runs, with the job's stage timing.
+    """
+    inputs = dict(config.general_config["general"], queue_folder=str(tmpdir.mkdir("queue")),
+                  run_log_folder=str(tmpdir.join("run_logs")))
+    jobs = [{"id": "WES_report", "stage": "report", "runtype": "WES"},
+            {"id": "WES_pdf", "stage": "pdf", "runtype": "WES"}]
+
+    def work(run, exit_when_idle=False):
+        for job in jobs:
+            run(job, {})
+    with mock.patch("read_qc_files.job_queue.Worker.work", side_effect=work), \
+            mock.patch("read_qc_files.run_job", return_value=None):
+        read_qc_files.worker(inputs)
+    run_logs = sorted(os.listdir(inputs["run_log_folder"]))
+    # run logs are named by run start time (yymmdd_HH_MM_SS) and job
+    assert [name.split("_", 4)[-1] for name in run_logs] == ["WES_pdf_run_log.json", "WES_report_run_log.json"]
+    with open(os.path.join(inputs["run_log_folder"], run_logs[0])) as run_log_file:
+        assert list(json.load(run_log_file)["summary"]["stages"]) == ["pdf"]
+
+
+def test_ingest(tmpdir):
+    """
+    Test that an ingested runfolder's measurements are recorded without scanning the input folder, and the next run
+    rebuilds only the reports of its run types.
+    """
+    folders = dict((name, str(tmpdir.mkdir(name))) for name in ["input", "output", "images", "archive"])
+    runs = generate_input_folder(folders["input"], {"NB551068": 3, "M02353": 2}, samples_per_run=4)
+    wes_run = sorted_runs(runs, "WES")[-1]
+    inputs = dict(config.general_config["general"], input_folder=folders["input"], output_folder=folders["output"],
+                  images_folder=folders["images"], archive_folder=folders["archive"], distributed=False, index_file="",
+                  rebuild_folder=str(tmpdir.join("rebuild_requests")), metrics_db=str(tmpdir.join("qc_metrics.sqlite")),
+                  template_dir=os.path.join(os.path.dirname(read_qc_files.__file__), "html_template"))
+    with mock.patch("read_qc_files.input_roots.scan_runfolders") as scan_runfolders:
+        run_types = read_qc_files.ingest_run(os.path.join(folders["input"], wes_run), inputs, PANEL_DICT)
+    assert not scan_runfolders.called
+    assert run_types == ["WES", "NEXTSEQ_MARIO"]
+    store = metrics_store.MetricsStore(inputs["metrics_db"])
+    try:
+        rows = store.query()
+        assert rows and set(row[3] for row in rows) == set([wes_run])
+        assert set(row[1] for row in rows) == set(run_types)
+    finally:
+        store.close()
+    # the index file has not been updated, so only the ingested run types are rebuilt
+    with mock.patch("read_qc_files.get_panel_dict", return_value=PANEL_DICT), \
+            mock.patch("read_qc_files.check_for_update", return_value=False), \
+            mock.patch("read_qc_files.run_reports") as run_reports:
+        read_qc_files.run(argparse.Namespace(dev=False, force=False), inputs, {})
+        assert run_reports.call_args[0][0]["run_types"] == run_types
+        assert set(run_reports.call_args[0][2].needed) == set(sorted_runs(runs, "WES") +
+                                                              sorted_runs(runs, "NEXTSEQ_MARIO"))
+        # requests are cleared once handled
+        read_qc_files.run(argparse.Namespace(dev=False, force=False), inputs, {})
+        assert run_reports.call_count == 1
+    assert read_qc_files.ingest_run(os.path.join(folders["input"], sorted_runs(runs, "MISEQ_ONC")[0]),
+                                    dict(inputs, run_types=["WES"]), PANEL_DICT) == []
+    # the ingest command scans nothing else and leaves the rebuilds to the running instance, requesting it rerun
+    lock = RunLock(str(tmpdir.join("trend_analysis.lock")))
+    assert lock.acquire()
+    args = argparse.Namespace(command="ingest", runfolder=os.path.join(folders["input"], wes_run), explain=False)
+    with mock.patch("read_qc_files.arg_parse", return_value=args), \
+            mock.patch("read_qc_files.get_inputs", return_value=dict(
+                inputs, lock_file=lock.lock_path, run_log_folder=str(tmpdir.join("run_logs")))), \
+            mock.patch("read_qc_files.get_panel_dict", return_value=PANEL_DICT), \
+            mock.patch("read_qc_files.input_roots.scan_runfolders") as scan_runfolders, \
+            mock.patch("read_qc_files.run_coalesced") as run_coalesced:
+        read_qc_files.main()
+    assert not scan_runfolders.called and not run_coalesced.called
+    assert lock.take_rerun_request() and os.listdir(str(tmpdir.join("run_logs")))
+    assert list(rebuild_requests.pending_rebuilds(inputs["rebuild_folder"])) == sorted(run_types)
+    lock.release()
+
+
+def test_explain(tmpdir):
+    """
+    Test that an explain run plans the reports to rebuild, plots, PDFs and emails with costs estimated from run log
+    timings, without publishing, archiving or sending anything, and plans no work for an unchanged report.
+    """
+    folders = dict((name, str(tmpdir.mkdir(name))) for name in ["input", "output", "images", "archive", "run_logs"])
+    generate_input_folder(folders["input"], {"NB551068": 3, "M02353": 2}, samples_per_run=4)
+    with open(os.path.join(folders["run_logs"], "200101_10_00_00_run_log.json"), "w") as run_log_file:
+        json.dump({"summary": {"stages": {"box_plot": {"count": 4, "wall": 2.0}, "read_multiqc_file":
+                                          {"count": 10, "wall": 1.0}}}}, run_log_file)
+    inputs = dict(config.general_config["general"], input_folder=folders["input"], output_folder=folders["output"],
+                  images_folder=folders["images"], archive_folder=folders["archive"], run_types=["WES", "SWIFT"],
+                  run_log_folder=folders["run_logs"], distributed=False, index_file="", wes_email="", reports_hyperlink="",
+                  oncology_ops_email="", custom_panels_email="", email_subject="", io_concurrency=2,
+                  rebuild_folder=str(tmpdir.join("rebuild_requests")),
+                  template_dir=os.path.join(os.path.dirname(read_qc_files.__file__), "html_template"))
+    args = argparse.Namespace(dev=False, force=False)
+    with mock.patch("read_qc_files.get_panel_dict", return_value=PANEL_DICT), \
+            mock.patch("read_qc_files.check_for_update", return_value=True), \
+            mock.patch("read_qc_files.smtplib.SMTP") as smtp:
+        plan = read_qc_files.explain(args, inputs)
+        assert not smtp.called
+    assert [report["runtype"] for report in plan["reports"]] == ["WES", "SWIFT"]
+    wes = plan["reports"][0]
+    assert wes["rebuild"] and wes["reason"] == "not yet published" and wes["pdf"]
+    assert "contamination" in wes["plots"]["box_plot"] and wes["email"] and wes["new_runs"] == wes["runs"]
+    assert plan["reads"]["files"] > 0 and plan["reads"]["cache_hits"] == plan["reads"]["requests"] - plan["reads"]["files"]
+    # 0.5s per box plot, 0.1s per file read (2 at a time)
+    assert wes["estimated_seconds"] == 0.5 * len(wes["plots"]["box_plot"])
+    assert plan["reads"]["estimated_seconds"] == pytest.approx(0.1 * plan["reads"]["files"] / 2)
+    assert "stacked_bar" in plan["stages_without_timings"]
+    assert os.listdir(folders["output"]) == [] and os.listdir(folders["archive"]) == []
+    assert not [name for run in os.listdir(folders["input"]) for name in os.listdir(os.path.join(folders["input"], run))
+                if name == "email_logfile"]
+    explain_paths = [name for name in os.listdir(folders["run_logs"]) if name.endswith("_explain.json")]
+    with open(os.path.join(folders["run_logs"], explain_paths[0])) as plan_file:
+        assert json.load(plan_file)["reports"][0]["plots"] == wes["plots"]
+    # once published, the WES report is unchanged
+    report = TrendReport(runtype="WES", panel_dict=PANEL_DICT, input_folder=folders["input"],
+                         output_folder=folders["output"], images_folder=folders["images"],
+                         template_dir=inputs["template_dir"], archive_folder=folders["archive"],
+                         logopath="images/viapathlogo.png", plot_order=inputs["plot_order"],
+                         wkhtmltopdf_path=inputs["wkhtmltopdf_path"])
+    with mock.patch("read_qc_files.pdfkit.configuration"), mock.patch("read_qc_files.pdfkit.from_file"):
+        report.call_tools(inspect.getmembers(report, predicate=inspect.ismethod))
+    with mock.patch("read_qc_files.get_panel_dict", return_value=PANEL_DICT), \
+            mock.patch("read_qc_files.check_for_update", return_value=True):
+        wes = read_qc_files.explain(args, inputs)["reports"][0]
+    assert not wes["rebuild"] and wes["reason"] == "unchanged" and not wes["pdf"] and wes["plots"] == {}
+    assert "contamination" in wes["plots_skipped"] and wes["estimated_seconds"] == 0
+    with mock.patch("read_qc_files.get_panel_dict", return_value=PANEL_DICT), \
+            mock.patch("read_qc_files.check_for_update", return_value=False):
+        assert read_qc_files.explain(args, inputs)["reports"] == []
+        # a run archiving PDFs deferred by the previous run's time budget is planned, as a run would archive them
+        rebuild_requests.request_pdf(inputs["rebuild_folder"], "WES")
+        plan = read_qc_files.explain(args, dict(inputs, tick_budget_seconds=60))
+    assert plan["reports"] == [] and plan["deferred_pdfs"]["run_types"] == ["WES"]
+    assert "PDFs deferred by the time budget" in plan["reason"] and plan["budget_seconds"] == 60
+
+
+def test_memory_budget(tmpdir):
+    """
+    Test that with a memory budget, files are read one run type at a time and cached data is dropped once the budget
+    is exceeded, and that reports release each tool's parsed data once its html module is built.
+    """
+    folders = dict((name, str(tmpdir.mkdir(name))) for name in ["input", "output", "images", "archive"])
+    generate_input_folder(folders["input"], {"NB551068": 3}, samples_per_run=4)
+    inputs = dict(config.general_config["general"], input_folder=folders["input"], output_folder=folders["output"],
+                  images_folder=folders["images"], archive_folder=folders["archive"],
+                  metrics_db=str(tmpdir.join("qc_metrics.sqlite")), run_types=["WES", "CUSTOM_PANELS"],
+                  memory_budget_mb=1, wes_email="", oncology_ops_email="", custom_panels_email="", email_subject="",
+                  reports_hyperlink="", rebuild_folder=str(tmpdir.join("rebuild_requests")),
+                  template_dir=os.path.join(os.path.dirname(read_qc_files.__file__), "html_template"))
+    read_plan = ReadPlanner(folders["input"])
+    reports = []
+    with mock.patch("read_qc_files.pdfkit.configuration"), mock.patch("read_qc_files.pdfkit.from_file"), \
+            mock.patch("read_qc_files.Emails"), \
+            mock.patch("read_qc_files.release_memory", side_effect=read_qc_files.release_memory) as release_memory, \
+            mock.patch("read_qc_files.TrendReport", side_effect=lambda **kwargs: reports.append(
+                TrendReport(**kwargs)) or reports[-1]):
+        try:
+            read_qc_files.run_reports(inputs, PANEL_DICT, read_plan, {})
+        finally:
+            read_plan.close()
+    assert release_memory.call_count == 2
+    # the plan only holds the files of the run type reported since cached data was last dropped
+    assert read_plan.reads and set(read_plan.needed) == set(sorted_runs(os.listdir(folders["input"]), "CUSTOM_PANELS"))
+    for report in reports:
+        assert os.path.isfile(os.path.join(folders["output"], report.runtype + "_trend_report.html"))
+        assert all(set(tool_data) <= set(["image_location"]) for tool_data in report.dictionary.values())
+        assert report.sample_names == OrderedDict({})
+
+
+def test_report_priority(tmpdir):
+    """
+    Test that alerting run types are reported and emailed first and PDFs archived after them, and that once the time
+    budget is spent, non-alerting reports and PDFs are deferred to the next run.
+    """
+    folders = dict((name, str(tmpdir.mkdir(name))) for name in ["input", "output", "images", "archive"])
+    generate_input_folder(folders["input"], {"NB551068": 3}, samples_per_run=4)
+    inputs = dict(config.general_config["general"], input_folder=folders["input"], output_folder=folders["output"],
+                  images_folder=folders["images"], archive_folder=folders["archive"],
+                  metrics_db=str(tmpdir.join("qc_metrics.sqlite")), run_types=["NEXTSEQ_MARIO", "WES"],
+                  rebuild_folder=str(tmpdir.join("rebuild_requests")), wes_email="", oncology_ops_email="",
+                  custom_panels_email="", email_subject="", reports_hyperlink="",
+                  template_dir=os.path.join(os.path.dirname(read_qc_files.__file__), "html_template"))
+    events = []
+
+    def emails(**kwargs):
+        email = mock.Mock()
+        email.call_tools.side_effect = lambda: events.append(("email", kwargs["runtype"]))
+        return email
+
+    def run_reports(force=False, **kwargs):
+        read_plan = ReadPlanner(folders["input"])
+        read_plan.build_plan(inputs["run_types"], inputs["plot_order"])
+        read_plan.execute()
+        with mock.patch("read_qc_files.pdfkit.configuration"), \
+                mock.patch("read_qc_files.pdfkit.from_file", side_effect=lambda html, pdf, **_: events.append(
+                    ("pdf", os.path.basename(html).split("_trend_report")[0]))), \
+                mock.patch("read_qc_files.Emails", side_effect=emails):
+            try:
+                read_qc_files.run_reports(dict(inputs, **kwargs), PANEL_DICT, read_plan, {}, force)
+            finally:
+                read_plan.close()
+    run_reports()
+    # PDFs are archived alongside the NEXTSEQ_MARIO report, once WES has been reported and emailed
+    assert events[0] == ("email", "WES")
+    assert sorted(events) == [("email", "NEXTSEQ_MARIO"), ("email", "WES"), ("pdf", "NEXTSEQ_MARIO"), ("pdf", "WES")]
+    assert os.path.isfile(os.path.join(folders["output"], "archive_index.html"))
+    # with the budget spent once WES is reported, its PDF and the NEXTSEQ_MARIO report are deferred
+    del events[:]
+    run_reports(tick_budget_seconds=1e-6, force=True)
+    assert events == [("email", "WES")]
+    assert list(rebuild_requests.pending_rebuilds(inputs["rebuild_folder"])) == ["NEXTSEQ_MARIO"]
+    assert list(rebuild_requests.pending_pdfs(inputs["rebuild_folder"])) == ["WES"]
+    # the next run archives the deferred PDF, even though the WES report is not rebuilt
+    del events[:]
+    run_reports(run_types=["NEXTSEQ_MARIO"])
+    assert sorted(events) == [("email", "NEXTSEQ_MARIO"), ("pdf", "WES")]
+    assert rebuild_requests.pending_pdfs(inputs["rebuild_folder"]) == {}
+
+
+def test_archive(tmpdir):
+    """
+    Test that archive maintenance bundles old reports, archive_index.html still links to every report, a run log of
+    the reports bundled is written, and maintenance is skipped while the run lock is held.
+    """
+    folders = dict((name, str(tmpdir.mkdir(name))) for name in ["output", "archive", "run_logs"])
+    names = ["200101_09_00_WES_trend_report.pdf", "200102_09_00_WES_trend_report.pdf"]
+    for name in names:
+        with open(os.path.join(folders["archive"], name), "wb") as report_file:
+            report_file.write(b"%PDF-1.4 " + name.encode("utf-8"))
+    os.utime(os.path.join(folders["archive"], names[0]), (time.time() - 90 * 86400, time.time() - 90 * 86400))
+    inputs = dict(config.general_config["general"], output_folder=folders["output"],
+                  archive_folder=folders["archive"], archive_hot_days=31, run_log_folder=folders["run_logs"],
+                  lock_file=str(tmpdir.join("trend_analysis.lock")))
+    lock = RunLock(inputs["lock_file"])
+    with mock.patch("read_qc_files.arg_parse", return_value=argparse.Namespace(command="archive")), \
+            mock.patch("read_qc_files.get_inputs", return_value=inputs):
+        assert lock.acquire()
+        read_qc_files.main()
+        assert os.listdir(folders["output"]) == [] and not lock.take_rerun_request()
+        lock.release()
+        read_qc_files.main()
+    assert os.path.isfile(os.path.join(folders["archive"], "bundles", "2020-01.zip"))
+    with open(os.path.join(folders["output"], "archive_index.html")) as index_file:
+        index_html = index_file.read()
+    assert re.findall(r'href="archive/([^"]+)"', index_html) == [names[1], names[0]]
+    with open(os.path.join(folders["run_logs"], os.listdir(folders["run_logs"])[0])) as run_log_file:
+        run_log = json.load(run_log_file)
+    assert run_log["summary"]["stages"]["archive_maintenance"]["count"] >= 1
+    assert run_log["counters"]["archive_reports_bundled"]["all"] >= 1
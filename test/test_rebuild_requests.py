@@ -0,0 +1,22 @@
+import pytest, sys, os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from rebuild_requests import request_rebuild, pending_rebuilds, clear_requests
+
+
+def test_rebuild_requests(tmpdir):
+    """
+    Test that requests are grouped by run type, and only handled requests are cleared.
+    """
+    rebuild_folder = str(tmpdir.join("rebuild_requests"))
+    assert pending_rebuilds(rebuild_folder) == {}
+    request_rebuild(rebuild_folder, "WES", "001_200101_NB551068_0001_WES1")
+    request_rebuild(rebuild_folder, "NEXTSEQ_MARIO", "001_200101_NB551068_0001_WES1")
+    request_rebuild(rebuild_folder, "WES", "002_200102_NB551068_0002_WES2")
+    requests = pending_rebuilds(rebuild_folder)
+    assert list(requests) == ["NEXTSEQ_MARIO", "WES"] and len(requests["WES"]) == 2
+    # a request recorded while the handled requests were being rebuilt is kept
+    request_rebuild(rebuild_folder, "SWIFT", "003_200103_M02353_0001_ONC1")
+    clear_requests(requests)
+    assert list(pending_rebuilds(rebuild_folder)) == ["SWIFT"]
+    assert not [name for name in os.listdir(rebuild_folder) if name.endswith(".tmp")]
@@ -0,0 +1,46 @@
+import pytest, sys, os
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from report_scheduler import TickScheduler
+
+
+def test_scheduler_order():
+    """
+    Test that alerting run types are reported first, and PDFs are only started once they are done.
+    """
+    archived = []
+    scheduler = TickScheduler(["WES", "SWIFT"], pdf_concurrency=2)
+    try:
+        assert scheduler.order(["MISEQ_DNA", "SWIFT", "NEXTSEQ_MARIO", "WES"]) == ["SWIFT", "WES", "MISEQ_DNA",
+                                                                                  "NEXTSEQ_MARIO"]
+        assert scheduler.start_report("SWIFT")
+        scheduler.queue_pdf("SWIFT", lambda: archived.append("SWIFT"))
+        assert scheduler.start_report("WES")
+        # a PDF deferred by the previous run is replaced by that of the republished report
+        scheduler.queue_pdf("WES", lambda: archived.append("WES previous"))
+        scheduler.queue_pdf("WES", lambda: archived.append("WES"))
+        time.sleep(0.05)
+        assert archived == []
+        assert scheduler.start_report("MISEQ_DNA")
+        scheduler.queue_pdf("MISEQ_DNA", lambda: archived.append("MISEQ_DNA"))
+        assert scheduler.finish()
+    finally:
+        scheduler.close()
+    assert sorted(archived) == ["MISEQ_DNA", "SWIFT", "WES"] and scheduler.deferred == []
+
+
+def test_scheduler_budget():
+    """
+    Test that once the time budget is spent, non-alerting reports and PDFs are deferred, but alerting reports are not.
+    """
+    scheduler = TickScheduler(["WES"], budget=0.01)
+    try:
+        time.sleep(0.02)
+        assert scheduler.start_report("WES")
+        scheduler.queue_pdf("WES", lambda: None)
+        assert not scheduler.start_report("MISEQ_DNA")
+        assert not scheduler.finish()
+    finally:
+        scheduler.close()
+    assert sorted(scheduler.deferred) == [("pdf", "WES"), ("report", "MISEQ_DNA")]
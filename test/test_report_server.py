@@ -0,0 +1,110 @@
+import pytest, sys, os
+import gzip
+import io
+import threading
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from report_server import RenderCache, ReportServer, run_inventory
+
+try:
+    from httplib import HTTPConnection  # python 2
+except ImportError:
+    from http.client import HTTPConnection
+
+
+def test_render_cache():
+    """
+    Test that reports are rendered once per run inventory and template version, and the least recently used report
+    is evicted.
+    """
+    renders = []
+
+    def render(runtype, window):
+        renders.append((runtype, window))
+        return "{} {}".format(runtype, window).encode("utf-8"), {runtype + "_plot.png": b"png"}
+
+    cache = RenderCache(render, max_entries=2)
+    assert cache.get(("WES", None), "inventory1")["html"] == b"WES None"
+    assert cache.get(("WES", None), "inventory1")["html"] == b"WES None"
+    assert renders == [("WES", None)] and cache.hits == 1
+    # a changed inventory invalidates the cached report
+    cache.get(("WES", None), "inventory2")
+    assert renders == [("WES", None)] * 2
+    # as does a changed template version
+    cache.get(("WES", None), "inventory2", "version2")
+    assert renders == [("WES", None)] * 3
+    cache.get(("SWIFT", 10), "inventory2")
+    cache.get(("WES", None), "inventory2")
+    cache.get(("MISEQ_DNA", None), "inventory2")
+    # SWIFT was least recently used, so was evicted
+    assert list(cache.entries) == [("WES", None), ("MISEQ_DNA", None)]
+    assert cache.image("WES_plot.png") == b"png"
+    assert cache.image("SWIFT_plot.png") is None
+
+
+def test_report_server(tmpdir):
+    """
+    Test that reports are rendered on request, revalidated using ETags, and re-rendered when a runfolder arrives.
+    """
+    input_folder = tmpdir.mkdir("input")
+    input_folder.mkdir("001_200101_NB551068_0001_WES")
+    images_folder = tmpdir.mkdir("images")
+    images_folder.join("viapathlogo.png").write_binary(b"logo")
+    archive_folder = tmpdir.mkdir("archive")
+    archive_folder.join("210101_09_00_WES_trend_report.pdf").write_binary(b"%PDF-1.4 report")
+    renders = []
+
+    def render(runtype, window):
+        renders.append((runtype, window))
+        return '<img src="images/{}_plot.0123456789abcdef.png">'.format(runtype).encode("utf-8"), \
+            {runtype + "_plot.0123456789abcdef.png": b"plot"}
+
+    server = ReportServer(("localhost", 0), RenderCache(render, 4), str(input_folder), str(images_folder),
+                          str(archive_folder), ["WES", "SWIFT"], lambda: "version")
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    def get(path, headers=None):
+        connection = HTTPConnection("localhost", server.server_port)
+        connection.request("GET", path, headers=headers or {})
+        response = connection.getresponse()
+        result = response.status, dict((header.lower(), value) for header, value in response.getheaders()), \
+            response.read()
+        connection.close()
+        return result
+
+    try:
+        assert b"WES_trend_report.html" in get("/")[2]
+        assert renders == []
+        status, headers, body = get("/WES_trend_report.html")
+        assert status == 200 and body.startswith(b"<img") and renders == [("WES", None)]
+        etag = headers["etag"]
+        # revalidating an unchanged report does not render it again
+        assert get("/WES_trend_report.html", {"If-None-Match": etag})[0] == 304
+        assert get("/WES_trend_report.html")[2] == body
+        assert renders == [("WES", None)]
+        status, headers, body = get("/WES_trend_report.html", {"Accept-Encoding": "gzip"})
+        assert headers["content-encoding"] == "gzip"
+        assert gzip.GzipFile(fileobj=io.BytesIO(body)).read().startswith(b"<img")
+        status, headers, body = get("/images/WES_plot.0123456789abcdef.png")
+        assert body == b"plot" and "immutable" in headers["cache-control"]
+        assert get("/images/viapathlogo.png")[2] == b"logo"
+        assert get("/images/missing.png")[0] == 404
+        assert get("/archive/210101_09_00_WES_trend_report.pdf")[2] == b"%PDF-1.4 report"
+        assert get("/archive/missing.pdf")[0] == 404
+        # query parameters select the run type and window
+        assert get("/?runtype=SWIFT&window=20")[0] == 200
+        assert renders[-1] == ("SWIFT", 20)
+        assert get("/MISEQ_DNA_trend_report.html")[0] == 404
+        assert get("/WES_trend_report.html?window=none")[0] == 400
+        # a new runfolder changes the inventory, so the report is rendered again with a new ETag
+        inventory = run_inventory(str(input_folder))
+        input_folder.mkdir("002_200201_NB551068_0002_WES")
+        assert run_inventory(str(input_folder)) != inventory
+        status, headers, body = get("/WES_trend_report.html", {"If-None-Match": etag})
+        assert status == 200 and headers["etag"] != etag
+        assert renders[-1] == ("WES", None) and len(renders) == 3
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
@@ -0,0 +1,44 @@
+import pytest, sys, os
+import subprocess
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from run_lock import RunLock
+
+
+def test_run_lock(tmpdir):
+    """
+    Test that a second instance cannot take the lock, records a rerun request instead, and that the request is cleared
+    once taken.
+    """
+    lock_path = str(tmpdir.join("trend_analysis.lock"))
+    running, overlapping = RunLock(lock_path), RunLock(lock_path)
+    assert running.acquire()
+    assert not running.take_rerun_request()
+    assert not overlapping.acquire()
+    assert not overlapping.acquire()
+    # any number of overlapping invocations are coalesced into one rerun request
+    assert running.take_rerun_request()
+    assert not running.take_rerun_request()
+    # an invocation that only needs the lock (e.g. archive maintenance) can skip without requesting a rerun
+    assert not overlapping.acquire(request_rerun=False)
+    assert not running.take_rerun_request()
+    running.release()
+    assert overlapping.acquire()
+    overlapping.release()
+
+
+def test_run_lock_other_process(tmpdir):
+    """
+    Test that the lock is held against other processes, and released when the holding process exits.
+    """
+    lock_path = str(tmpdir.join("trend_analysis.lock"))
+    script = "import sys; sys.path.insert(0, {!r}); from run_lock import RunLock; " \
+             "sys.exit(0 if RunLock({!r}).acquire() else 1)".format(
+                 os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)), lock_path)
+    lock = RunLock(lock_path)
+    assert lock.acquire()
+    assert subprocess.call([sys.executable, "-c", script]) == 1
+    assert lock.take_rerun_request()
+    lock.release()
+    assert subprocess.call([sys.executable, "-c", script]) == 0
+    assert RunLock(lock_path).acquire()
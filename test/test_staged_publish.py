@@ -0,0 +1,71 @@
+import pytest, sys, os
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from staged_publish import ReportStage
+
+try:
+    from unittest import mock  # python 3.3+
+except ImportError:
+    import mock  # python 2.6-3.2
+
+
+def stage_report(output_folder, images_folder, image_name, html):
+    """
+    Return a stage holding a plot, html and fingerprint.
+    """
+    stage = ReportStage(str(output_folder), str(images_folder), "WES")
+    with open(stage.image_path(image_name), "w") as image_file:
+        image_file.write(image_name)
+    for file_name, content in [("WES_trend_report.html", html), ("WES_trend_report.fingerprint", html)]:
+        with open(stage.path(file_name), "w") as staged_file:
+            staged_file.write(content)
+    return stage
+
+
+def test_publish(tmpdir):
+    """
+    Test that staged files are not visible until published, plots are published before the html and the fingerprint
+    last, and the plots of the previous report are kept.
+    """
+    output_folder, images_folder = tmpdir.mkdir("output"), tmpdir.mkdir("images")
+    stage = stage_report(output_folder, images_folder, "WES_contamination.1111111111111111.png", "first")
+    assert sorted(name for name in os.listdir(str(output_folder)) if not name.startswith(".build_")) == []
+    renames = []
+    rename = os.rename
+
+    def record_rename(source, destination):
+        renames.append(os.path.basename(destination))
+        rename(source, destination)
+
+    with mock.patch("staged_publish.os.rename", side_effect=record_rename):
+        keep = stage.publish(last=["WES_trend_report.html", "WES_trend_report.fingerprint"])
+    assert renames == ["WES_contamination.1111111111111111.png", ".WES_images.json", "WES_trend_report.html",
+                       "WES_trend_report.fingerprint"]
+    assert keep == set(["WES_contamination.1111111111111111.png"])
+    assert output_folder.join("WES_trend_report.html").read() == "first"
+    assert sorted(os.listdir(str(output_folder))) == [".WES_images.json", "WES_trend_report.fingerprint",
+                                                      "WES_trend_report.html"]
+    assert os.listdir(str(images_folder)) == ["WES_contamination.1111111111111111.png"]
+    stage = stage_report(output_folder, images_folder, "WES_contamination.2222222222222222.png", "second")
+    assert stage.publish(last=["WES_trend_report.html", "WES_trend_report.fingerprint"]) == set(
+        ["WES_contamination.1111111111111111.png", "WES_contamination.2222222222222222.png"])
+    assert output_folder.join("WES_trend_report.html").read() == "second"
+
+
+def test_discard(tmpdir):
+    """
+    Test that a discarded build leaves the published report untouched, and stale build folders are removed.
+    """
+    output_folder, images_folder = tmpdir.mkdir("output"), tmpdir.mkdir("images")
+    output_folder.join("WES_trend_report.html").write("published")
+    stage = stage_report(output_folder, images_folder, "WES_contamination.1111111111111111.png", "unfinished")
+    stage.discard()
+    assert os.listdir(str(output_folder)) == ["WES_trend_report.html"] and os.listdir(str(images_folder)) == []
+    assert output_folder.join("WES_trend_report.html").read() == "published"
+    stale_build = output_folder.mkdir(".build_WES_killed")
+    os.utime(str(stale_build), (time.time() - 2 * 86400, time.time() - 2 * 86400))
+    live_build = output_folder.mkdir(".build_SWIFT_running")
+    os.utime(str(live_build), (time.time() - 2 * 86400, time.time() - 2 * 86400))
+    ReportStage(str(output_folder), str(images_folder), "WES").discard()
+    assert sorted(os.listdir(str(output_folder))) == [".build_SWIFT_running", "WES_trend_report.html"]
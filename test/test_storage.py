@@ -0,0 +1,141 @@
+import pytest, sys, os
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import storage
+from storage import DiskCache, S3Storage, split_s3_path
+from input_roots import scan_runfolders
+
+try:
+    from unittest import mock  # python 3.3+
+except ImportError:
+    import mock  # python 2.6-3.2
+
+
+def write_download(contents, downloads):
+    """
+    Return a download function writing contents, recording each download.
+    """
+    def download(path):
+        downloads.append(contents)
+        with open(path, "w") as output_file:
+            output_file.write(contents)
+    return download
+
+
+def test_disk_cache(tmpdir):
+    """
+    Test that files are downloaded once, the least recently used files are evicted once the cache exceeds its size,
+    and cached files are kept across instances in their order of use.
+    """
+    folder = str(tmpdir.join("cache"))
+    cache = DiskCache(folder, 10)
+    downloads = []
+    first = cache.fetch("a@1", write_download("aaaa", downloads))
+    cache.fetch("b@1", write_download("bbbb", downloads))
+    assert cache.fetch("a@1", write_download("aaaa", downloads)) == first and downloads == ["aaaa", "bbbb"]
+    assert open(first).read() == "aaaa"
+    # a was used more recently than b, so b is evicted
+    cache.fetch("c@1", write_download("cccc", downloads))
+    assert list(cache.entries) == [os.path.basename(first), os.path.basename(cache.fetch("c@1", None))]
+    assert len(os.listdir(folder)) == 2
+    # a new version of a file is a new entry, evicting the least recently used file (the previous version)
+    second = cache.fetch("a@2", write_download("AAAA", downloads))
+    assert open(second).read() == "AAAA" and not os.path.exists(first)
+    last_used = cache.fetch("c@1", None)
+    os.utime(second, (time.time() + 60, time.time() + 60))
+    tmpdir.join("cache", "interrupted.tmp").write("")
+    os.utime(str(tmpdir.join("cache", "interrupted.tmp")), (0, 0))
+    reloaded = DiskCache(folder, 10)
+    assert list(reloaded.entries) == [os.path.basename(last_used), os.path.basename(second)]
+    assert "interrupted.tmp" not in os.listdir(folder)
+    # a file larger than the cache is kept until the next file is cached
+    reloaded.fetch("large@1", write_download("x" * 20, downloads))
+    assert list(reloaded.entries.values()) == [20]
+
+
+def test_local_storage(tmpdir):
+    """
+    Test that local paths are listed in os.walk order, read in place and written as before.
+    """
+    runfolder = tmpdir.mkdir("001_200101_NB551068_0001_WES")
+    runfolder.mkdir("multiqc_data").join("multiqc_general_stats.txt").write("Sample\n")
+    runfolder.join("email_logfile").write("")
+    walked = [os.path.join(root, name) for root, dirs, files in os.walk(str(runfolder)) for name in files]
+    assert storage.list_files(str(runfolder)) == walked
+    assert storage.listdir(str(tmpdir)) == ["001_200101_NB551068_0001_WES"]
+    assert storage.isdir(str(runfolder)) and not storage.isdir(str(runfolder.join("email_logfile")))
+    path = str(runfolder.join("multiqc_data", "multiqc_general_stats.txt"))
+    assert storage.local_path(path) == path and storage.getsize(path) == 7
+    storage.write_text(str(runfolder.join("email_logfile")), "email sent")
+    assert runfolder.join("email_logfile").read() == "email sent"
+    assert split_s3_path("s3://bucket/input/run/") == ("bucket", "input/run")
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    """
+    Return a boto3 client of a mocked S3 (moto), with a bucket of two runfolders.
+    """
+    boto3 = pytest.importorskip("boto3")
+    moto = pytest.importorskip("moto")
+    for variable in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN"]:
+        monkeypatch.setenv(variable, "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    mock_s3 = getattr(moto, "mock_aws", None) or moto.mock_s3
+    with mock_s3():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="qc-data")
+        for run in ["001_200101_NB551068_0001_WES", "002_200201_NB551068_0002_WES"]:
+            client.put_object(Bucket="qc-data", Key="input/{}/multiqc_data/multiqc_general_stats.txt".format(run),
+                              Body=b"Sample\t" + run.encode("utf-8") + b"\n")
+        yield client
+
+
+def test_s3_storage(tmpdir, s3_client):
+    """
+    Test that runfolders in object storage are listed in bulk, objects are read through the cache and downloaded
+    again only once changed, and email logfiles are written back.
+    """
+    s3 = S3Storage("qc-data", client=s3_client, cache=DiskCache(str(tmpdir.join("cache")), 1024))
+    assert sorted(s3.listdir("s3://qc-data/input")) == ["001_200101_NB551068_0001_WES", "002_200201_NB551068_0002_WES"]
+    path = "s3://qc-data/input/001_200101_NB551068_0001_WES/multiqc_data/multiqc_general_stats.txt"
+    assert s3.list_files("s3://qc-data/input/001_200101_NB551068_0001_WES/") == [path]
+    with mock.patch.object(s3_client, "head_object", side_effect=AssertionError("listed objects need no request")):
+        assert s3.getsize(path) == len("Sample\t001_200101_NB551068_0001_WES\n")
+        local_path = s3.local_path(path)
+    assert open(local_path).read() == "Sample\t001_200101_NB551068_0001_WES\n"
+    with mock.patch.object(s3_client, "get_object", side_effect=AssertionError("cached, not downloaded")):
+        assert s3.local_path(path) == local_path
+    s3_client.put_object(Bucket="qc-data", Key=path[len("s3://qc-data/"):], Body=b"Sample\tchanged\n")
+    s3.list_files("s3://qc-data/input/001_200101_NB551068_0001_WES")
+    assert open(s3.local_path(path)).read() == "Sample\tchanged\n"
+    # an object changed after it was listed, before it was downloaded, is read as it is now
+    s3_client.put_object(Bucket="qc-data", Key=path[len("s3://qc-data/"):], Body=b"Sample\tlisted\n")
+    s3.list_files("s3://qc-data/input/001_200101_NB551068_0001_WES")
+    s3_client.put_object(Bucket="qc-data", Key=path[len("s3://qc-data/"):], Body=b"Sample\tchanged again\n")
+    with mock.patch.object(s3_client, "get_object", wraps=s3_client.get_object) as get_object:
+        assert open(s3.local_path(path)).read() == "Sample\tchanged again\n"
+    assert get_object.call_count == 2
+    assert not [name for name in os.listdir(str(tmpdir.join("cache"))) if name.endswith(".tmp")]
+    s3.write_text("s3://qc-data/input/001_200101_NB551068_0001_WES/email_logfile", "email sent")
+    assert open(s3.local_path("s3://qc-data/input/001_200101_NB551068_0001_WES/email_logfile")).read() == "email sent"
+    assert s3.isdir("s3://qc-data/input/001_200101_NB551068_0001_WES") and not s3.isdir("s3://qc-data/input/missing")
+    assert s3.getmtime("s3://qc-data/input/001_200101_NB551068_0001_WES") > 0
+    with pytest.raises(OSError):
+        s3.getmtime("s3://qc-data/input/missing")
+
+
+def test_s3_input_root(tmpdir, s3_client):
+    """
+    Test that an input root in object storage is scanned and merged with a local root like a local root.
+    """
+    local_root = tmpdir.mkdir("local")
+    local_root.mkdir("003_200301_NB551068_0003_WES")
+    with mock.patch.dict(storage.config.general_config["general"],
+                         {"storage_cache_folder": str(tmpdir.join("cache")), "s3_endpoint_url": None}), \
+            mock.patch.dict(storage._buckets, clear=True):
+        inventory = scan_runfolders(["s3://qc-data/input", str(local_root)], timeout=10)
+    assert inventory == {"001_200101_NB551068_0001_WES": "s3://qc-data/input/001_200101_NB551068_0001_WES",
+                         "002_200201_NB551068_0002_WES": "s3://qc-data/input/002_200201_NB551068_0002_WES",
+                         "003_200301_NB551068_0003_WES": str(local_root.join("003_200301_NB551068_0003_WES"))}
@@ -0,0 +1,42 @@
+import pytest, sys, os
+import csv
+import json
+from collections import OrderedDict
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import trend_export
+import config
+
+
+def test_export_rows():
+    """
+    Test that one row is exported per measurement of tools parsed from MultiQC outputs, with limits from config.
+    """
+    dictionary = OrderedDict([("run_names", {"1 oldest": "run1"}),
+                              ("contamination", OrderedDict([("run1", [1.5, 2.5]), ("run2", [])]))])
+    sample_names = OrderedDict([("contamination", OrderedDict([("run1", ["sample1", "sample2"]), ("run2", [])]))])
+    rows = list(trend_export.export_rows("WES", dictionary, sample_names))
+    assert [(row["run"], row["sample"], row["tool"], row["value"]) for row in rows] == \
+        [("run1", "sample1", "contamination", 1.5), ("run1", "sample2", "contamination", 2.5)]
+    upper_lim = config.tool_settings["contamination"]["upper_lim"]
+    assert rows[0]["upper_lim"] == (upper_lim if upper_lim is not False else None)
+    assert list(rows[0].keys()) == trend_export.EXPORT_COLUMNS
+
+
+def test_write_exports(tmpdir):
+    """
+    Test that CSV and JSON-lines exports contain the same rows, and that Parquet is skipped if pyarrow is missing.
+    """
+    rows = [OrderedDict([("runtype", "WES"), ("run", "run1"), ("sample", "sample{}".format(number)),
+                         ("tool", "peddy_sex_check"), ("value", number % 2 == 0), ("lower_lim", None),
+                         ("upper_lim", None)]) for number in range(3)]
+    assert trend_export.write_exports(str(tmpdir), "WES", iter(rows), parquet=trend_export.pyarrow is None) == 3
+    paths = trend_export.export_paths(str(tmpdir), "WES")
+    assert sorted(os.listdir(str(tmpdir))) == sorted(os.path.basename(path) for path in paths.values())
+    with open(paths["jsonl"]) as jsonl_file:
+        assert [json.loads(line) for line in jsonl_file] == [json.loads(json.dumps(row)) for row in rows]
+    with open(paths["csv"]) as csv_file:
+        csv_rows = list(csv.reader(csv_file))
+    assert csv_rows[0] == trend_export.EXPORT_COLUMNS
+    assert csv_rows[1] == ["WES", "run1", "sample0", "peddy_sex_check", "True", "", ""]
+    assert len(csv_rows) == 4
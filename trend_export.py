@@ -0,0 +1,105 @@
+"""
+Machine-readable export of the data behind each trend report.
+
+One row is written per measurement (run type, run, sample, tool, value and the tool's limits from config), streamed
+from the data already parsed for the report, so other systems can consume the trend data with a single file read
+instead of re-parsing MultiQC outputs. CSV and JSON-lines files are always written; Parquet is written if enabled in
+config and pyarrow is installed.
+"""
+import csv
+import json
+import os
+import sys
+from collections import OrderedDict
+import config as config
+import atomic_write
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Columns of each exported row
+EXPORT_COLUMNS = ["runtype", "run", "sample", "tool", "value", "lower_lim", "upper_lim"]
+
+
+def export_rows(runtype, dictionary, sample_names):
+    """
+    Yield one row per measurement in the parsed report data.
+        :param runtype:         (str) run type of the report
+        :param dictionary:      (OrderedDict) TrendReport.dictionary - tool as key, dictionary of run: measurements as
+                                              value
+        :param sample_names:    (OrderedDict) TrendReport.sample_names - tool as key, dictionary of run: sample (or
+                                              lane) name of each measurement as value
+        :return:                (generator) OrderedDict rows with EXPORT_COLUMNS as keys
+
+    Only tools with per-sample measurements (those parsed from MultiQC outputs) are exported. Limits not defined for a
+    tool are exported as None.
+    """
+    for tool in dictionary:
+        if tool not in sample_names:
+            continue
+        lower_lim = config.tool_settings[tool]["lower_lim"]
+        upper_lim = config.tool_settings[tool]["upper_lim"]
+        for run, measurements in dictionary[tool].items():
+            for sample, value in zip(sample_names[tool].get(run, []), measurements):
+                yield OrderedDict([("runtype", runtype), ("run", run), ("sample", sample), ("tool", tool),
+                                   ("value", value), ("lower_lim", lower_lim if lower_lim is not False else None),
+                                   ("upper_lim", upper_lim if upper_lim is not False else None)])
+
+
+def export_paths(output_folder, runtype, parquet=False):
+    """
+    Return the paths of the export files for a run type.
+        :param output_folder:   (str) path to the html trend reports (exports are saved alongside the reports)
+        :param runtype:         (str) run type of the report
+        :param parquet:         (bool) include the Parquet export
+        :return:                (OrderedDict) format as key, path as value
+    """
+    paths = OrderedDict([("csv", os.path.join(output_folder, runtype + "_trend_data.csv")),
+                         ("jsonl", os.path.join(output_folder, runtype + "_trend_data.jsonl"))])
+    if parquet:
+        paths["parquet"] = os.path.join(output_folder, runtype + "_trend_data.parquet")
+    return paths
+
+
+def write_exports(output_folder, runtype, rows, parquet=False):
+    """
+    Write the export files for a run type in a single pass over the rows. Each file is written to a temporary file and
+    renamed into place, so readers never see a partially written export.
+        :param output_folder:   (str) path to the html trend reports
+        :param runtype:         (str) run type of the report
+        :param rows:            (iterable) rows returned by export_rows
+        :param parquet:         (bool) also write a Parquet export (skipped with a message if pyarrow is not installed)
+        :return:                (int) number of rows exported
+    """
+    if parquet and pyarrow is None:
+        print("pyarrow is not installed, {} trend data not exported as Parquet".format(runtype))
+        parquet = False
+    paths = export_paths(output_folder, runtype, parquet)
+    # rows are streamed to temporary files, renamed into place once every format is written (see atomic_write.py)
+    temporary_paths = dict((export_format, atomic_write.temporary_path(path)) for export_format, path in paths.items())
+    parquet_columns = OrderedDict((column, []) for column in EXPORT_COLUMNS)
+    row_count = 0
+    # csv module needs a binary file in python 2, and a text file without newline translation in python 3
+    csv_file = open(temporary_paths["csv"], "wb") if sys.version_info[0] < 3 else \
+        open(temporary_paths["csv"], "w", newline="")
+    with csv_file, open(temporary_paths["jsonl"], "w") as jsonl_file:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(EXPORT_COLUMNS)
+        for row in rows:
+            csv_writer.writerow(["" if value is None else value for value in row.values()])
+            jsonl_file.write(json.dumps(row) + "\n")
+            if parquet:
+                for column, value in row.items():
+                    parquet_columns[column].append(value)
+            row_count += 1
+    if parquet:
+        # values are booleans for some tools, so are stored as text to keep a single column type
+        parquet_columns["value"] = [None if value is None else repr(value) if isinstance(value, float) else str(value)
+                                    for value in parquet_columns["value"]]
+        pyarrow.parquet.write_table(pyarrow.Table.from_pydict(parquet_columns), temporary_paths["parquet"])
+    for export_format, path in paths.items():
+        os.rename(temporary_paths[export_format], path)
+    return row_count